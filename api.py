@@ -0,0 +1,205 @@
+"""Read-only API for Flask Cafe's venues and cities.
+
+    GET /api/v1/cafes
+    GET /api/v1/restaurants
+    GET /api/v1/cities
+
+Query string:
+    fields    comma-separated fields to send, e.g. fields=id,name,city; only
+              their columns are read from the database (default: all)
+    city      only venues in this city, by code
+    state     only venues in this state
+    limit     items per page (default 50, at most 500)
+    after     the cursor from the previous page
+
+Venues and cities come in name order, a page at a time:
+
+    {"data": [{"id": 1, "name": "...", "city": {"code", "name", "state"},
+               ...}, ...],
+     "next": "/api/v1/cafes?limit=50&after=WyJBY21lIiw0Ml0" or null}
+
+Pages are fetched by keyset rather than OFFSET. The cursor holds the sort
+key (name, id) of the page's last item, and the next page starts after it,
+so a deep page costs no more than the first, and venues added meanwhile
+don't make items repeat or go missing.
+
+A venue's city is read in the same query, by a join, rather than one
+query per venue.
+
+Clients sending `Accept: application/msgpack` get pages as MessagePack
+instead (see serialization.py).
+"""
+
+import base64
+import binascii
+from urllib.parse import urlencode
+
+import orjson
+from flask import request
+
+from models import db, City, venue_conditions
+
+VENUE_COLUMNS = ("id", "name", "description", "url", "address", "image_url",
+                 "latitude", "longitude")
+VENUE_FIELDS = (*VENUE_COLUMNS, "city")
+CITY_FIELDS = ("code", "name", "state")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class InvalidQuery(ValueError):
+    """A bad API query string; the message is sent back with a 400."""
+
+
+#######################################
+# query string
+
+
+def parse_fields(value, allowed):
+    """Return the fields listed in `value` (all of `allowed` if empty), in
+    the order of `allowed`."""
+
+    # tolerate stray commas, e.g. fields=id,
+    fields = set(value.split(",")) - {""} if value else set()
+
+    if not fields:
+        return allowed
+
+    unknown = fields.difference(allowed)
+
+    if unknown:
+        raise InvalidQuery(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return tuple(field for field in allowed if field in fields)
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_LIMIT
+
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+
+    if not 1 <= limit <= MAX_LIMIT:
+        raise InvalidQuery(f"limit must be from 1 to {MAX_LIMIT}")
+
+    return limit
+
+
+def encode_cursor(values):
+    data = base64.urlsafe_b64encode(orjson.dumps(list(values)))
+    return data.decode().rstrip("=")
+
+
+def decode_cursor(cursor, types):
+    """Return the sort key in `cursor`, checking its values are of
+    `types`."""
+
+    try:
+        values = orjson.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        values = None
+
+    if (not isinstance(values, list) or len(values) != len(types)
+            or not all(type(value) is type_
+                       for value, type_ in zip(values, types))):
+        raise InvalidQuery("Invalid cursor")
+
+    return values
+
+
+#######################################
+# pages
+
+
+def fetch_page(query, sort_columns, after, limit):
+    """Run `query`, which selects `sort_columns` first, ordered by them and
+    starting after the sort key `after`. Returns its first `limit` rows,
+    and the cursor for the next page or None."""
+
+    if after:
+        query = query.where(db.tuple_(*sort_columns) > db.tuple_(*after))
+
+    rows = db.session.execute(
+        query.order_by(*sort_columns).limit(limit + 1)).all()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][:len(sort_columns)])
+
+
+def venue_page(model, fields, city_code=None, state=None, after=None,
+               limit=DEFAULT_LIMIT):
+    """Return a page of venues of `model` as dicts of `fields`, and the
+    next page's cursor."""
+
+    columns = [getattr(model, field) for field in fields if field != "city"]
+    names = [field for field in fields if field != "city"]
+    embed_city = "city" in fields
+
+    sort_columns = (model.name, model.id)
+    query = db.select(*sort_columns, *columns)
+
+    if embed_city:
+        query = query.add_columns(City.code, City.name, City.state)
+
+    if embed_city or state:
+        query = query.join(model.city)
+
+    query = query.where(*venue_conditions(model, city_code, state))
+
+    if after:
+        after = decode_cursor(after, (str, int))
+
+    rows, next_cursor = fetch_page(query, sort_columns, after, limit)
+
+    start, end = len(sort_columns), len(sort_columns) + len(columns)
+    items = []
+
+    for row in rows:
+        item = dict(zip(names, row[start:end]))
+
+        if embed_city:
+            item["city"] = dict(zip(CITY_FIELDS, row[end:]))
+
+        items.append(item)
+
+    return items, next_cursor
+
+
+def city_page(fields, after=None, limit=DEFAULT_LIMIT):
+    """Return a page of cities as dicts of `fields`, and the next page's
+    cursor."""
+
+    sort_columns = (City.name, City.code)
+    query = db.select(*sort_columns,
+                      *(getattr(City, field) for field in fields))
+
+    if after:
+        after = decode_cursor(after, (str, str))
+
+    rows, next_cursor = fetch_page(query, sort_columns, after, limit)
+
+    return ([dict(zip(fields, row[len(sort_columns):])) for row in rows],
+            next_cursor)
+
+
+def page_body(items, next_cursor):
+    """The response body for a page: its items, and the URL of the next
+    page (the same query, after the cursor)."""
+
+    next_url = None
+
+    # not url_for, which would take args such as `endpoint` or `_anchor`
+    # as its own
+    if next_cursor:
+        query = urlencode({**request.args.to_dict(), "after": next_cursor})
+        next_url = f"{request.script_root}{request.path}?{query}"
+
+    return {"data": items, "next": next_url}
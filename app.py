@@ -1,44 +1,166 @@
 """Flask App for Flask Cafe."""
 
 import os
-from dotenv import load_dotenv
+from importlib import import_module
 
-from flask import Flask, render_template, flash, redirect, jsonify, session, g
-from flask import request
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Flask, Blueprint, render_template, flash, redirect, jsonify
+from flask import session, g, request, Response, stream_with_context, abort
+from flask import current_app
+from flask.cli import AppGroup
+from flask.helpers import get_debug_flag
 
 from models import db, connect_db, Cafe, Restaurant, City, User
+from models import venue_cards, find_nearby
 
 from forms import CSRFProtectForm, CafeInfoForm, UserSignupForm, LoginForm
 from forms import ProfileEditForm, AddCityForm, RestaurantInfoForm
 
+from config import CONFIGS
+from throttle import Throttle
+from templating import init_template_cache, init_streaming, stream_page
+from compression import init_compression
+from assets import init_assets
+from preload import init_preload, preload, script, map_image, paint_timings
+from preload import VARIANTS
+from database import init_engine, pool_stats, init_read_routing, REPLICA_BIND
+from exporter import export_chunks, export_filename, EXPORTS, FORMATS
+from invalidation import bus
+from cache import cache, get_or_404
+from serialization import init_serialization, respond, request_data
+from api import venue_page, city_page, page_body, parse_fields, parse_limit
+from api import InvalidQuery, VENUE_FIELDS, CITY_FIELDS
+from catalog import catalog, list_cards, list_facets, list_cities
+from catalog import get_city_or_404, get_venue_or_404
+
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Unauthorized
+from werkzeug.exceptions import Unauthorized, ServiceUnavailable
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+bp = Blueprint("main", __name__)
+
+throttle = Throttle()
+
+
+#######################################
+# app factory
+
+
+def create_app(config=None):
+    """Create and set up the Flask Cafe app.
+
+    `config` is a profile name from config.CONFIGS or a config object. It
+    defaults to FLASK_CONFIG, or else "development" when FLASK_DEBUG is on
+    and "production" when it isn't.
+    """
+
+    if config is None:
+        config = os.environ.get("FLASK_CONFIG") or (
+            "development" if get_debug_flag() else "production")
+
+    if isinstance(config, str):
+        config = CONFIGS[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['TRUSTED_PROXIES'])
+
+    # before the toolbar, so pages are compressed after it adds itself
+    init_compression(app)
+    init_serialization(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    init_template_cache(app)
+    init_streaming(app)
+    init_assets(app)
+    init_preload(app)
+
+    connect_db(app)
+    init_read_routing(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            init_engine(engine)
+
+    throttle.init_app(app)
+    bus.init_app(app)
+    cache.init_app(app)
+    catalog.init_app(app)
 
-load_dotenv()
+    app.cli = LazyGroup(CLI_COMMANDS)
+    app.register_blueprint(bp)
 
-app = Flask(__name__)
+    return app
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL")
-app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY")
 
-if app.debug:
-    app.config['SQLALCHEMY_ECHO'] = True
+#######################################
+# CLI commands
+
+
+class LazyGroup(AppGroup):
+    """CLI group that only imports a command's module when it's run.
+
+    Web workers never use the CLI, so they skip loading Flask-Migrate
+    (Alembic) and the import/export/generate tooling.
+    """
+
+    def __init__(self, lazy_commands, **kwargs):
+        super().__init__(**kwargs)
+        self.lazy_commands = lazy_commands
+
+    def list_commands(self, ctx):
+        return sorted({*super().list_commands(ctx), *self.lazy_commands})
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_commands and name not in self.commands:
+            self.add_command(self.lazy_commands[name](), name)
+
+        return super().get_command(ctx, name)
+
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+def lazy_import(module, name):
+    """Return a loader for the command `name` in `module`."""
 
-toolbar = DebugToolbarExtension(app)
+    return lambda: getattr(import_module(module), name)
+
+
+def migrate_cli():
+    """Set up Flask-Migrate on the current app; returns `flask db`."""
+
+    from flask_migrate import Migrate
+    from flask_migrate.cli import db as db_cli
+
+    Migrate(current_app, db)
+
+    return db_cli
+
+
+CLI_COMMANDS = {
+    "db": migrate_cli,
+    "import": lazy_import("importer", "import_cli"),
+    "maps": lazy_import("importer", "maps_cli"),
+    "export": lazy_import("exporter", "export_cli"),
+    "generate": lazy_import("datagen", "generate_cli"),
+    "templates": lazy_import("templating", "templates_cli"),
+    "static": lazy_import("compression", "static_cli"),
+    "assets": lazy_import("assets", "assets_cli"),
+}
 
-connect_db(app)
 
 #######################################
 # auth & auth routes
 
 CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in!"
+THROTTLED_MSG = "Too many attempts! Please wait a minute and try again."
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -49,7 +171,7 @@ def add_user_to_g():
         g.user = None
 
 
-@app.before_request
+@bp.before_app_request
 def add_csrf_form_to_g():
     """Adds csrf protection form to Flask global"""
 
@@ -69,7 +191,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handles user signup.
 
@@ -86,6 +208,13 @@ def signup():
     form = UserSignupForm()
 
     if form.validate_on_submit():
+        throttled = throttle.hit(signup_ip=request.remote_addr)
+
+        if throttled:
+            flash(THROTTLED_MSG, 'danger')
+            return (render_template('auth/signup-form.html', form=form), 429,
+                    {"Retry-After": throttle.retry_after(throttled)})
+
         try:
             user = User.register(
                 username=form.username.data,
@@ -115,19 +244,32 @@ def signup():
         return render_template('auth/signup-form.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handles user login and redirects to cafe list on success."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
+        throttled = throttle.hit(
+            login_ip=request.remote_addr,
+            login_user=form.username.data.lower(),
+        )
+
+        if throttled:
+            flash(THROTTLED_MSG, 'danger')
+            return (render_template('auth/login-form.html', form=form), 429,
+                    {"Retry-After": throttle.retry_after(throttled)})
+
         user = User.authenticate(
             form.username.data,
             form.password.data
         )
 
         if user:
+            # saves the rehashed password if the cost factor changed
+            db.session.commit()
+
             do_login(user)
 
             flash(f"Hello, {user.username}!", "success")
@@ -138,7 +280,7 @@ def login():
     return render_template('auth/login-form.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to login page."""
 
@@ -159,48 +301,86 @@ def logout():
 #######################################
 # homepage and error pages
 
-@app.get("/")
+@bp.get("/")
 def homepage():
     """Show homepage."""
 
     return render_template("homepage.html")
 
 
-@app.errorhandler(Unauthorized)
+@bp.app_errorhandler(Unauthorized)
 def page_unauthorized(e):
     """Shows Unauthorized page."""
 
     return render_template('unauthorized.html'), 401
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(ServiceUnavailable)
+def page_service_unavailable(e):
+    """Shows 503 page, e.g. when too many passwords are being hashed."""
+
+    return render_template('503.html'), 503, {"Retry-After": "5"}
+
+
+@bp.app_errorhandler(404)
 def page_not_found(e):
     """Shows 404 NOT FOUND page."""
 
     return render_template('404.html'), 404
 
 
+#######################################
+# list filters
+
+
+def get_list_filters():
+    """Read city, state, and liked-only filters from the query string."""
+
+    return {
+        "city": request.args.get("city") or None,
+        "state": request.args.get("state", "").upper() or None,
+        "liked": "1" if request.args.get("liked") == "1" else None,
+    }
+
+
+# rows fetched per round trip when streaming a list page
+LIST_YIELD_PER = 100
+
+
 #######################################
 # cafes
 
 
-@app.get('/cafes')
+@bp.get('/cafes')
 def cafe_list():
-    """Return list of all cafes."""
+    """Return list of cafes, optionally filtered by city, state, or
+    liked-only through the query string."""
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    cafes = Cafe.query.order_by('name').all()
+    filters = get_list_filters()
+    liked_by = g.user if filters["liked"] else None
 
-    return render_template(
+    cafes = list_cards(
+        Cafe,
+        city_code=filters["city"],
+        state=filters["state"],
+        liked_by=liked_by,
+        yield_per=LIST_YIELD_PER,
+    )
+
+    return stream_page(
         'cafe/list.html',
         cafes=cafes,
+        facets=list_facets(Cafe, liked_by=liked_by),
+        filters=filters,
     )
 
 
-@app.get('/cafes/<int:cafe_id>')
+@bp.get('/cafes/<int:cafe_id>')
+@preload(lambda cafe_id: [script("cafeLikes.js"), map_image("cafe", cafe_id)])
 def cafe_detail(cafe_id):
     """Show detail for cafe."""
 
@@ -208,7 +388,7 @@ def cafe_detail(cafe_id):
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = get_venue_or_404(Cafe, cafe_id)
 
     return render_template(
         'cafe/detail.html',
@@ -216,7 +396,7 @@ def cafe_detail(cafe_id):
     )
 
 
-@app.route('/cafes/add', methods=['GET', 'POST'])
+@bp.route('/cafes/add', methods=['GET', 'POST'])
 def add_cafe():
     """Renders form for adding a cafe or handles adding of a cafe"""
 
@@ -249,6 +429,7 @@ def add_cafe():
         db.session.add(cafe)
 
         db.session.flush()
+        cafe.geocode()
         cafe.save_cafe_map()
 
         db.session.commit()
@@ -259,7 +440,7 @@ def add_cafe():
     return render_template('cafe/add-form.html', form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=['GET', 'POST'])
+@bp.route('/cafes/<int:cafe_id>/edit', methods=['GET', 'POST'])
 def edit_cafe(cafe_id):
     """Renders form for editing a cafe or handles editing of a cafe"""
 
@@ -290,9 +471,10 @@ def edit_cafe(cafe_id):
         if not form.image_url.data:
             cafe.image_url = Cafe.image_url.default.arg
 
-        # only generate new map if address has changed
+        # only geocode and generate new map if address has changed
         if original_address != form.address.data:
             db.session.flush()
+            cafe.geocode()
             cafe.save_cafe_map()
 
         db.session.commit()
@@ -307,7 +489,7 @@ def edit_cafe(cafe_id):
     return render_template('cafe/edit-form.html', form=form, cafe=cafe)
 
 
-@app.post('/cafes/<int:cafe_id>/delete')
+@bp.post('/cafes/<int:cafe_id>/delete')
 def delete_cafe(cafe_id):
     """Deletes cafe. Only admins may perform this action"""
 
@@ -336,23 +518,37 @@ def delete_cafe(cafe_id):
 # restaurants
 
 
-@app.get('/restaurants')
+@bp.get('/restaurants')
 def restaurant_list():
-    """Return list of all restaurants."""
+    """Return list of restaurants, optionally filtered by city, state, or
+    liked-only through the query string."""
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    restaurants = Restaurant.query.order_by('name').all()
+    filters = get_list_filters()
+    liked_by = g.user if filters["liked"] else None
 
-    return render_template(
+    restaurants = list_cards(
+        Restaurant,
+        city_code=filters["city"],
+        state=filters["state"],
+        liked_by=liked_by,
+        yield_per=LIST_YIELD_PER,
+    )
+
+    return stream_page(
         'restaurant/list.html',
         restaurants=restaurants,
+        facets=list_facets(Restaurant, liked_by=liked_by),
+        filters=filters,
     )
 
 
-@app.get('/restaurants/<int:restaurant_id>')
+@bp.get('/restaurants/<int:restaurant_id>')
+@preload(lambda restaurant_id: [script("restaurantLikes.js"),
+                                map_image("restaurant", restaurant_id)])
 def restaurant_detail(restaurant_id):
     """Show detail for restaurant."""
 
@@ -360,7 +556,7 @@ def restaurant_detail(restaurant_id):
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    restaurant = Restaurant.query.get_or_404(restaurant_id)
+    restaurant = get_venue_or_404(Restaurant, restaurant_id)
 
     return render_template(
         'restaurant/detail.html',
@@ -368,7 +564,7 @@ def restaurant_detail(restaurant_id):
     )
 
 
-@app.route('/restaurants/add', methods=['GET', 'POST'])
+@bp.route('/restaurants/add', methods=['GET', 'POST'])
 def add_restaurant():
     """Renders form for adding a restaurant or handles adding of a restaurant"""
 
@@ -401,6 +597,7 @@ def add_restaurant():
         db.session.add(restaurant)
 
         db.session.flush()
+        restaurant.geocode()
         restaurant.save_restaurant_map()
 
         db.session.commit()
@@ -411,7 +608,7 @@ def add_restaurant():
     return render_template('restaurant/add-form.html', form=form)
 
 
-@app.route('/restaurants/<int:restaurant_id>/edit', methods=['GET', 'POST'])
+@bp.route('/restaurants/<int:restaurant_id>/edit', methods=['GET', 'POST'])
 def edit_restaurant(restaurant_id):
     """Renders form for editing a restaurant or handles editing of a restaurant"""
 
@@ -442,9 +639,10 @@ def edit_restaurant(restaurant_id):
         if not form.image_url.data:
             restaurant.image_url = Restaurant.image_url.default.arg
 
-        # only generate new map if address has changed
+        # only geocode and generate new map if address has changed
         if original_address != form.address.data:
             db.session.flush()
+            restaurant.geocode()
             restaurant.save_restaurant_map()
 
         db.session.commit()
@@ -459,7 +657,7 @@ def edit_restaurant(restaurant_id):
     return render_template('restaurant/edit-form.html', form=form, restaurant=restaurant)
 
 
-@app.post('/restaurants/<int:restaurant_id>/delete')
+@bp.post('/restaurants/<int:restaurant_id>/delete')
 def delete_restaurant(restaurant_id):
     """Deletes restaurant. Only admins may perform this action"""
 
@@ -488,7 +686,7 @@ def delete_restaurant(restaurant_id):
 #######################################
 # cities
 
-@app.get('/cities')
+@bp.get('/cities')
 def city_list():
     """Render list of all cities."""
 
@@ -496,14 +694,33 @@ def city_list():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    cities = City.query.order_by('name').all()
+    cities = list_cities()
 
     return render_template(
         'city/list.html',
         cities=cities,
     )
 
-@app.route('/cities/add', methods=['GET', 'POST'])
+
+@bp.get('/cities/<city_code>')
+def city_detail(city_code):
+    """Show cafes and restaurants in a city."""
+
+    if not g.user:
+        flash(NOT_LOGGED_IN_MSG, "danger")
+        return redirect("/login")
+
+    city = get_city_or_404(city_code)
+
+    return render_template(
+        'city/detail.html',
+        city=city,
+        cafes=list(list_cards(Cafe, city_code=city.code)),
+        restaurants=list(list_cards(Restaurant, city_code=city.code)),
+    )
+
+
+@bp.route('/cities/add', methods=['GET', 'POST'])
 def add_city():
     """Renders form for adding a city or handles adding of a city"""
 
@@ -534,7 +751,7 @@ def add_city():
 # profile
 
 
-@app.get('/profile')
+@bp.get('/profile')
 def user_profile():
     """Renders user profile page."""
 
@@ -542,10 +759,16 @@ def user_profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    return render_template('profile/detail.html')
+    return stream_page(
+        'profile/detail.html',
+        liked_cafes=venue_cards(
+            Cafe, liked_by=g.user, yield_per=LIST_YIELD_PER),
+        liked_restaurants=venue_cards(
+            Restaurant, liked_by=g.user, yield_per=LIST_YIELD_PER),
+    )
 
 
-@app.route('/profile/edit', methods=['GET', 'POST'])
+@bp.route('/profile/edit', methods=['GET', 'POST'])
 def edit_profile():
     """Renders form for editing user profile or handles edit POST request"""
 
@@ -577,7 +800,7 @@ def edit_profile():
 # API likes
 
 
-@app.get("/api/likes-cafe")
+@bp.get("/api/likes-cafe")
 def check_cafe_like():
     """Given a cafe_id in the URL query string, check to see whether the
     current user likes that cafe. Returns JSON: {"likes": true|false}"""
@@ -588,19 +811,19 @@ def check_cafe_like():
 
     cafe_id = int(request.args.get("q"))
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = get_or_404(Cafe, cafe_id)
 
     if g.user.has_liked_cafe(cafe):
-        return jsonify({
+        return respond({
             "likes": "true"
         })
     else:
-        return jsonify({
+        return respond({
             "likes": "false"
         })
 
 
-@app.post('/api/likes-cafe-toggle')
+@bp.post('/api/likes-cafe-toggle')
 def toggle_cafe_like():
     """Like and unlike a cafe"""
 
@@ -608,7 +831,7 @@ def toggle_cafe_like():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/")
 
-    cafe_id = int(request.json.get("cafe_id"))
+    cafe_id = int(request_data().get("cafe_id"))
 
     cafe = Cafe.query.get_or_404(cafe_id)
 
@@ -616,14 +839,14 @@ def toggle_cafe_like():
         g.user.liked_cafes.remove(cafe)
         db.session.commit()
 
-        return jsonify({"unliked": cafe_id})
+        return respond({"unliked": cafe_id})
     else:
         g.user.liked_cafes.append(cafe)
         db.session.commit()
 
-        return jsonify({"liked": cafe_id})
+        return respond({"liked": cafe_id})
 
-@app.get("/api/likes-restaurant")
+@bp.get("/api/likes-restaurant")
 def check_restaurant_like():
     """Given a restaurant_id in the URL query string, check to see whether the
     current user likes that restaurant. Returns JSON: {"likes": true|false}"""
@@ -634,19 +857,19 @@ def check_restaurant_like():
 
     restaurant_id = int(request.args.get("q"))
 
-    restaurant = Restaurant.query.get_or_404(restaurant_id)
+    restaurant = get_or_404(Restaurant, restaurant_id)
 
     if g.user.has_liked_restaurant(restaurant):
-        return jsonify({
+        return respond({
             "likes": "true"
         })
     else:
-        return jsonify({
+        return respond({
             "likes": "false"
         })
 
 
-@app.post('/api/likes-restaurant-toggle')
+@bp.post('/api/likes-restaurant-toggle')
 def toggle_restaurant_like():
     """Like and unlike a restaurant"""
 
@@ -654,7 +877,7 @@ def toggle_restaurant_like():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/")
 
-    restaurant_id = int(request.json.get("restaurant_id"))
+    restaurant_id = int(request_data().get("restaurant_id"))
 
     restaurant = Restaurant.query.get_or_404(restaurant_id)
 
@@ -662,9 +885,214 @@ def toggle_restaurant_like():
         g.user.liked_restaurants.remove(restaurant)
         db.session.commit()
 
-        return jsonify({"unliked": restaurant_id})
+        return respond({"unliked": restaurant_id})
     else:
         g.user.liked_restaurants.append(restaurant)
         db.session.commit()
 
-        return jsonify({"liked": restaurant_id})
\ No newline at end of file
+        return respond({"liked": restaurant_id})
+
+
+#######################################
+# API nearby
+
+NEARBY_DEFAULT_RADIUS_KM = 1
+NEARBY_MAX_RADIUS_KM = 50
+NEARBY_LIMIT = 50
+
+
+@bp.get('/api/nearby')
+def nearby_venues():
+    """Given lat, lng and an optional radius (km, default 1) in the URL query
+    string, find cafes and restaurants within that radius.
+
+    Returns JSON ordered by distance:
+    {"venues": [{"type", "id", "name", "city", "distance_km"}, ...]}"""
+
+    if not g.user:
+        flash(NOT_LOGGED_IN_MSG, "danger")
+        return redirect("/login")
+
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    radius = request.args.get(
+        "radius", default=NEARBY_DEFAULT_RADIUS_KM, type=float)
+
+    if (lat is None or lng is None or not -90 <= lat <= 90
+            or not -180 <= lng <= 180 or radius is None or radius <= 0):
+        return respond({"error": "lat, lng and radius must be valid"}, 400)
+
+    radius = min(radius, NEARBY_MAX_RADIUS_KM)
+
+    nearby = [("cafe", venue, distance) for venue, distance
+              in find_nearby(Cafe, lat, lng, radius, NEARBY_LIMIT)]
+    nearby += [("restaurant", venue, distance) for venue, distance
+               in find_nearby(Restaurant, lat, lng, radius, NEARBY_LIMIT)]
+
+    nearby.sort(key=lambda item: item[2])
+    nearby = nearby[:NEARBY_LIMIT]
+
+    return respond({
+        "venues": [{
+            "type": type,
+            "id": venue.id,
+            "name": venue.name,
+            "city": venue.get_city_state(),
+            "latitude": venue.latitude,
+            "longitude": venue.longitude,
+            "distance_km": round(distance, 3),
+        } for type, venue, distance in nearby]
+    })
+
+
+#######################################
+# API v1
+
+
+@bp.get('/api/v1/cafes')
+def api_cafes():
+    """Return a page of cafes; see api.py for the query string."""
+
+    return venue_api_page(Cafe)
+
+
+@bp.get('/api/v1/restaurants')
+def api_restaurants():
+    """Return a page of restaurants; see api.py for the query string."""
+
+    return venue_api_page(Restaurant)
+
+
+def venue_api_page(model):
+    if not g.user:
+        return respond({"error": NOT_LOGGED_IN_MSG}, 401)
+
+    try:
+        items, next_cursor = venue_page(
+            model,
+            parse_fields(request.args.get("fields"), VENUE_FIELDS),
+            city_code=request.args.get("city"),
+            state=request.args.get("state"),
+            after=request.args.get("after"),
+            limit=parse_limit(request.args.get("limit")),
+        )
+    except InvalidQuery as error:
+        return respond({"error": str(error)}, 400)
+
+    return respond(page_body(items, next_cursor))
+
+
+@bp.get('/api/v1/cities')
+def api_cities():
+    """Return a page of cities; see api.py for the query string."""
+
+    if not g.user:
+        return respond({"error": NOT_LOGGED_IN_MSG}, 401)
+
+    try:
+        items, next_cursor = city_page(
+            parse_fields(request.args.get("fields"), CITY_FIELDS),
+            after=request.args.get("after"),
+            limit=parse_limit(request.args.get("limit")),
+        )
+    except InvalidQuery as error:
+        return respond({"error": str(error)}, 400)
+
+    return respond(page_body(items, next_cursor))
+
+
+#######################################
+# API metrics
+
+
+@bp.get('/api/metrics')
+def metrics():
+    """Return operational counters as JSON. Only admins may perform this
+    action.
+
+    {"throttle": {"login_ip": <rejected attempts>, ...},
+     "db_pool": {"checked_out", "overflow", "wait_avg_ms", ...},
+     "db_replica_pool": {...},
+     "cache": {"hits", "misses", "evictions", ...},
+     "paint": {"preload": {"count", "p50_ms", "p90_ms"}, "none": {...}}}
+
+    Pool stats, cache counts and paint times are for the worker process
+    that answered.
+    The replica pool is only included when a replica is configured, and
+    paint times in preload instrumentation mode."""
+
+    if not g.user:
+        flash(NOT_LOGGED_IN_MSG, "danger")
+        return redirect("/login")
+
+    if not g.user.admin:
+        raise Unauthorized()
+
+    stats = {
+        "throttle": throttle.counters(),
+        "db_pool": pool_stats(db.engine),
+        "cache": cache.stats(),
+    }
+
+    if REPLICA_BIND in db.engines:
+        stats["db_replica_pool"] = pool_stats(db.engines[REPLICA_BIND])
+
+    if current_app.config['PRELOAD_INSTRUMENT']:
+        stats["paint"] = paint_timings.summary()
+
+    return jsonify(stats)
+
+
+@bp.post('/api/metrics/paint')
+def record_paint():
+    """Record a page's first contentful paint time, as reported by the
+    browser in preload instrumentation mode.
+
+    Takes JSON {"variant": "preload" or "none", "fcp_ms": <number>}."""
+
+    if not current_app.config['PRELOAD_INSTRUMENT']:
+        abort(404)
+
+    # sent with navigator.sendBeacon, which can't set a JSON content type
+    data = request.get_json(force=True, silent=True) or {}
+    variant = data.get("variant")
+    ms = data.get("fcp_ms")
+
+    if (variant not in VARIANTS or not isinstance(ms, (int, float))
+            or not 0 <= ms < 60_000):
+        abort(400)
+
+    paint_timings.record(variant, ms)
+
+    return "", 204
+
+
+#######################################
+# API exports
+
+
+@bp.get('/api/export/<entity>.<format>')
+def export_table(entity, format):
+    """Stream a catalog or likes table as CSV or JSON lines. Only admins may
+    perform this action.
+
+    Add ?gzip=1 to download it gzipped."""
+
+    if not g.user:
+        flash(NOT_LOGGED_IN_MSG, "danger")
+        return redirect("/login")
+
+    if not g.user.admin:
+        raise Unauthorized()
+
+    if entity not in EXPORTS or format not in FORMATS:
+        abort(404)
+
+    gzip = request.args.get("gzip") == "1"
+    filename = export_filename(entity, format, gzip)
+
+    return Response(
+        stream_with_context(export_chunks(entity, format, gzip)),
+        mimetype="application/gzip" if gzip else FORMATS[format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
@@ -0,0 +1,236 @@
+"""Static asset pipeline for Flask Cafe.
+
+Bootstrap, its Bootswatch theme, jQuery and Popper are vendored into
+static/vendor/ at pinned versions, rather than loaded from CDNs on every
+page view. `flask assets vendor` fetches them again (e.g. after bumping a
+version in VENDOR).
+
+`flask assets build` minifies and concatenates the files in each of
+BUNDLES, and writes the result to static/dist/ under a name containing a
+hash of its content (e.g. app.3f2a9c1b0d.css), along with a manifest.json
+mapping bundle names to those files. Since a file's name changes whenever
+its content does, browsers are told to cache anything in static/dist/ for a
+year without checking back.
+
+Templates link to bundles with `asset_urls(name)` (or `asset_url(name)` for
+single-file bundles). Until the bundles are built, and always in debug
+mode, they link to the source files instead, so edits show up without a
+rebuild.
+
+Config:
+    ASSETS_BUNDLED    link to built bundles (default: when not debugging)
+"""
+
+import hashlib
+import json
+import os
+import re
+
+import click
+from flask import current_app, request, url_for
+from flask.cli import AppGroup
+
+DIST_DIR = "dist"
+MANIFEST = "manifest.json"
+
+# a year, the most browsers will honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+VENDOR = {
+    "vendor/bootswatch-litera-4.6.1.min.css":
+        "https://cdn.jsdelivr.net/npm/bootswatch@4.6.1/dist/litera/bootstrap.min.css",
+    "vendor/jquery-3.5.1.min.js":
+        "https://cdn.jsdelivr.net/npm/jquery@3.5.1/dist/jquery.min.js",
+    "vendor/popper-1.16.1.min.js":
+        "https://cdn.jsdelivr.net/npm/popper.js@1.16.1/dist/umd/popper.min.js",
+    "vendor/bootstrap-4.6.1.min.js":
+        "https://cdn.jsdelivr.net/npm/bootstrap@4.6.1/dist/js/bootstrap.min.js",
+}
+
+# bundle name: source files under static/, in load order
+BUNDLES = {
+    "app.css": [
+        "vendor/bootswatch-litera-4.6.1.min.css",
+        "style.css",
+    ],
+    "vendor.js": [
+        "vendor/jquery-3.5.1.min.js",
+        "vendor/popper-1.16.1.min.js",
+        "vendor/bootstrap-4.6.1.min.js",
+    ],
+    "cafeLikes.js": ["cafeLikes.js"],
+    "restaurantLikes.js": ["restaurantLikes.js"],
+    "RCTracker.ico": ["RCTracker.ico"],
+    "RCTracker.png": ["images/RCTracker.png"],
+}
+
+# source maps aren't vendored, so links to them would just 404
+SOURCE_MAP_COMMENT = re.compile(rb"^[ \t]*(//|/\*)# sourceMappingURL=.*$",
+                                re.MULTILINE)
+
+
+def init_assets(app):
+    """Add the asset template helpers and caching headers to the app."""
+
+    app.config.setdefault('ASSETS_BUNDLED', not app.debug)
+
+    app.extensions["assets"] = (load_manifest(app)
+                                if app.config['ASSETS_BUNDLED'] else {})
+
+    app.add_template_global(asset_urls)
+    app.add_template_global(asset_url)
+    app.after_request(cache_forever)
+
+
+def load_manifest(app):
+    """Return the built bundles' {name: path under static/}, or {}."""
+
+    path = os.path.join(app.static_folder, DIST_DIR, MANIFEST)
+
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_urls(name):
+    """URLs to load the bundle `name` from: the built file if there is one,
+    or else each of its sources."""
+
+    manifest = current_app.extensions["assets"]
+
+    if name in manifest:
+        return [url_for("static", filename=manifest[name])]
+
+    return [url_for("static", filename=source) for source in BUNDLES[name]]
+
+
+def asset_url(name):
+    """URL of the single-file bundle `name`."""
+
+    [url] = asset_urls(name)
+    return url
+
+
+def cache_forever(response):
+    """after_request hook: fingerprinted files never change, so let
+    browsers and proxies keep them for good."""
+
+    filename = (request.view_args or {}).get("filename", "")
+
+    if (request.endpoint == "static"
+            and filename.startswith(DIST_DIR + "/")
+            and response.status_code in (200, 304)):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+
+    return response
+
+
+def minify(name, data):
+    """Minify CSS or JS source, unless it already is."""
+
+    if ".min." in name:
+        return data
+
+    if name.endswith(".css"):
+        import rcssmin
+        return rcssmin.cssmin(data)
+
+    if name.endswith(".js"):
+        import rjsmin
+        return rjsmin.jsmin(data)
+
+    return data
+
+
+def build_bundle(static_folder, sources):
+    """Return the contents of a bundle made from `sources`."""
+
+    parts = []
+
+    for source in sources:
+        with open(os.path.join(static_folder, source), "rb") as file:
+            data = file.read()
+
+        parts.append(SOURCE_MAP_COMMENT.sub(b"", minify(source, data)).strip()
+                     if source.endswith((".css", ".js")) else data)
+
+    if len(parts) == 1:
+        return parts[0]
+
+    # the semicolon stops one script running into the next
+    separator = b";\n" if sources[0].endswith(".js") else b"\n"
+    return separator.join(parts) + b"\n"
+
+
+def fingerprint(name, data):
+    """Return `name` with a hash of `data` before its extension."""
+
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:10]
+
+    return f"{stem}.{digest}{ext}"
+
+
+def build_assets(static_folder):
+    """Build every bundle into static/dist/ and write the manifest;
+    returns it."""
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+
+    manifest = {}
+
+    for name, sources in BUNDLES.items():
+        data = build_bundle(static_folder, sources)
+        filename = fingerprint(name, data)
+
+        # earlier builds are left in place, for pages rendered by workers
+        # that haven't restarted yet
+        with open(os.path.join(dist, filename), "wb") as file:
+            file.write(data)
+
+        manifest[name] = f"{DIST_DIR}/{filename}"
+
+    with open(os.path.join(dist, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    return manifest
+
+
+#######################################
+# CLI
+
+
+assets_cli = AppGroup('assets', help="Manage CSS/JS assets.")
+
+
+@assets_cli.command('build')
+def build_command():
+    """Minify, bundle and fingerprint static assets."""
+
+    manifest = build_assets(current_app.static_folder)
+
+    for name, path in manifest.items():
+        size = os.path.getsize(os.path.join(current_app.static_folder, path))
+        click.echo(f"{name:20} {path:40} {size / 1024:8.1f} KB")
+
+
+@assets_cli.command('vendor')
+def vendor_command():
+    """Download the pinned third-party assets into static/vendor/."""
+
+    import requests
+
+    for path, url in VENDOR.items():
+        resp = requests.get(url, timeout=30)
+        resp.raise_for_status()
+
+        with open(os.path.join(current_app.static_folder, path), "wb") as file:
+            file.write(resp.content)
+
+        click.echo(f"{path} <- {url}")
@@ -0,0 +1,387 @@
+"""Micro-benchmarks for Flask Cafe hot paths.
+
+Drives routes through the Flask test client and model methods directly,
+against a synthetic dataset of configurable size, and reports ops/sec,
+latency percentiles and SQL queries per operation.
+
+Usage:
+    python bench.py                            # run, compare to baseline
+    python bench.py --save-baseline            # run, store as new baseline
+    python bench.py --cafes 10000 --only cafe_list --iterations 50
+    python bench.py --formats                  # also compare JSON/msgpack
+
+Uses its own database (BENCH_DATABASE_URL, default flaskcafe_bench), which
+is dropped and regenerated on every run. Exits with status 1 if any
+benchmark regressed past --threshold compared to the baseline.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+os.environ["DATABASE_URL"] = os.environ.get(
+    "BENCH_DATABASE_URL", "postgresql:///flaskcafe_bench")
+os.environ["FLASK_DEBUG"] = "0"
+os.environ["GEOCODER"] = "local"
+
+import msgpack
+import orjson
+from sqlalchemy import event
+
+from app import create_app, CURR_USER_KEY
+from datagen import DataGenerator, CAFE_WORDS, RESTAURANT_WORDS
+from datagen import DEFAULT_PASSWORD
+from models import db, Cafe, Restaurant, User, CafeLike, RestaurantLike
+from api import MAX_LIMIT, VENUE_FIELDS, venue_page, page_body
+from serialization import pack
+
+# the production profile, so hashing uses the same cost as --bcrypt-rounds
+app = create_app("production")
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.app_context().push()
+
+DEFAULT_BASELINE = "bench_baseline.json"
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark. It's called with the BenchContext each op."""
+
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class QueryCounter:
+    """Counts SQL statements sent to the database."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+class BenchContext:
+    """Dataset handles shared by the benchmarks."""
+
+    def __init__(self, user_ids, cafe_ids, restaurant_ids):
+        self.user_ids = user_ids
+        self.cafe_ids = cafe_ids
+        self.restaurant_ids = restaurant_ids
+
+        self.user = db.session.get(User, user_ids[0])
+        self.cafe_id = cafe_ids[len(cafe_ids) // 2]
+        self.restaurant_id = restaurant_ids[len(restaurant_ids) // 2]
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+
+def build_dataset(args):
+    """Regenerate the benchmark database; returns a BenchContext."""
+
+    db.drop_all()
+    db.create_all()
+
+    generator = DataGenerator(seed=args.seed, bcrypt_rounds=args.bcrypt_rounds)
+    generator.generate_cities(args.cities)
+
+    cafe_ids = generator.generate_venues(Cafe, args.cafes, CAFE_WORDS)
+    restaurant_ids = generator.generate_venues(
+        Restaurant, args.cafes, RESTAURANT_WORDS)
+    user_ids = generator.generate_users(args.users)
+
+    generator.generate_likes(
+        CafeLike, "cafe_id", args.likes, user_ids, cafe_ids)
+    generator.generate_likes(
+        RestaurantLike, "restaurant_id", args.likes, user_ids, restaurant_ids)
+
+    return BenchContext(user_ids, cafe_ids, restaurant_ids)
+
+
+#######################################
+# benchmarks
+
+
+@benchmark("cafe_list")
+def bench_cafe_list(ctx):
+    resp = ctx.client.get("/cafes")
+    assert resp.status_code == 200
+
+    # the page is streamed; render all of it
+    resp.get_data()
+
+
+@benchmark("api_cafes")
+def bench_api_cafes(ctx):
+    resp = ctx.client.get("/api/v1/cafes")
+    assert resp.status_code == 200
+
+
+def get_all_pages(ctx, url, msgpack_format=False):
+    headers = {"Accept": "application/msgpack"} if msgpack_format else {}
+
+    while url:
+        resp = ctx.client.get(url, headers=headers)
+        assert resp.status_code == 200
+        url = (msgpack.unpackb(resp.data) if msgpack_format
+               else resp.json)["next"]
+
+
+# every cafe, as cafe_list shows them
+@benchmark("api_cafes_all")
+def bench_api_cafes_all(ctx):
+    get_all_pages(ctx, f"/api/v1/cafes?limit={MAX_LIMIT}")
+
+
+@benchmark("api_cafes_all_msgpack")
+def bench_api_cafes_all_msgpack(ctx):
+    get_all_pages(ctx, f"/api/v1/cafes?limit={MAX_LIMIT}",
+                  msgpack_format=True)
+
+
+@benchmark("api_cafes_all_names")
+def bench_api_cafes_all_names(ctx):
+    get_all_pages(ctx, f"/api/v1/cafes?limit={MAX_LIMIT}&fields=id,name")
+
+
+@benchmark("cafe_detail")
+def bench_cafe_detail(ctx):
+    resp = ctx.client.get(f"/cafes/{ctx.cafe_id}")
+    assert resp.status_code == 200
+
+
+@benchmark("check_cafe_like")
+def bench_check_cafe_like(ctx):
+    resp = ctx.client.get(f"/api/likes-cafe?q={ctx.cafe_id}")
+    assert resp.status_code == 200
+
+
+@benchmark("toggle_cafe_like")
+def bench_toggle_cafe_like(ctx):
+    resp = ctx.client.post("/api/likes-cafe-toggle",
+                           json={"cafe_id": ctx.cafe_id})
+    assert resp.status_code == 200
+
+
+@benchmark("user_authenticate")
+def bench_user_authenticate(ctx):
+    assert User.authenticate(ctx.user.username, DEFAULT_PASSWORD)
+
+
+@benchmark("get_city_state")
+def bench_get_city_state(ctx):
+    db.session.expire_all()
+    cafe = db.session.get(Cafe, ctx.cafe_id)
+    assert cafe.get_city_state()
+
+
+#######################################
+# running & reporting
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at `fraction` (0-1) of an already sorted list."""
+
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_benchmark(func, ctx, counter, iterations, warmup):
+    """Time `iterations` calls of func; returns a dict of results."""
+
+    for _ in range(warmup):
+        func(ctx)
+
+    timings = []
+    queries_before = counter.count
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(ctx)
+        timings.append(time.perf_counter() - start)
+
+    total = sum(timings)
+    timings.sort()
+
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / total if total else 0,
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+        "queries_per_op": (counter.count - queries_before) / iterations,
+    }
+
+
+def compare_formats(iterations):
+    """Encode and decode a full page of the cafe API in each format; returns
+    {format: {"encode_ms", "decode_ms", "bytes", "gzip_bytes"}}."""
+
+    with app.test_request_context("/api/v1/cafes"):
+        items, next_cursor = venue_page(Cafe, VENUE_FIELDS, limit=MAX_LIMIT)
+        body = page_body(items, next_cursor)
+
+        formats = {
+            "json_stdlib": (
+                lambda: json.dumps(body, separators=(",", ":")).encode(),
+                json.loads),
+            "json": (lambda: app.json.response(body).get_data(),
+                     orjson.loads),
+            "msgpack": (lambda: pack(body), msgpack.unpackb),
+        }
+
+        results = {}
+
+        for name, (encode, decode) in formats.items():
+            data = encode()
+            assert decode(data) == body
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                encode()
+            encode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                decode(data)
+            decode_time = time.perf_counter() - start
+
+            results[name] = {
+                "encode_ms": encode_time / iterations * 1000,
+                "decode_ms": decode_time / iterations * 1000,
+                "bytes": len(data),
+                "gzip_bytes": len(gzip.compress(data, 6)),
+            }
+
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """Compare results to a baseline; returns a list of messages."""
+
+    regressions = []
+
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+
+        if result["ops_per_sec"] < before["ops_per_sec"] * (1 - threshold):
+            regressions.append(
+                f"{name}: {result['ops_per_sec']:.1f} ops/sec, "
+                f"was {before['ops_per_sec']:.1f}")
+
+        if result["queries_per_op"] > before["queries_per_op"]:
+            regressions.append(
+                f"{name}: {result['queries_per_op']:.1f} queries/op, "
+                f"was {before['queries_per_op']:.1f}")
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cities", type=int, default=20)
+    parser.add_argument("--cafes", type=int, default=1000,
+                        help="cafes (and restaurants) to generate")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--likes", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12,
+                        help="cost of generated passwords (affects "
+                             "user_authenticate)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS),
+                        help="run just this benchmark (repeatable)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed ops/sec drop vs. baseline (0.2 = 20%%)")
+    parser.add_argument("--output", help="also write results JSON here")
+    parser.add_argument("--formats", action="store_true",
+                        help="also compare API response formats")
+    args = parser.parse_args(argv)
+
+    ctx = build_dataset(args)
+    counter = QueryCounter(db.engine)
+
+    results = {}
+
+    print(f"{'benchmark':<20} {'ops/sec':>10} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'queries':>8}")
+
+    for name in args.only or BENCHMARKS:
+        result = run_benchmark(BENCHMARKS[name], ctx, counter,
+                               args.iterations, args.warmup)
+        results[name] = result
+
+        print(f"{name:<20} {result['ops_per_sec']:>10.1f} "
+              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['queries_per_op']:>8.1f}")
+
+    if args.formats:
+        formats = compare_formats(args.iterations)
+
+        print(f"\n{'format':<20} {'encode ms':>10} {'decode ms':>10} "
+              f"{'bytes':>10} {'gzipped':>10}")
+
+        for name, result in formats.items():
+            print(f"{name:<20} {result['encode_ms']:>10.2f} "
+                  f"{result['decode_ms']:>10.2f} {result['bytes']:>10} "
+                  f"{result['gzip_bytes']:>10}")
+
+    report = {
+        "dataset": {"cities": args.cities, "cafes": args.cafes,
+                    "users": args.users, "likes": args.likes,
+                    "seed": args.seed},
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline.")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+
+    if baseline.get("dataset") != report["dataset"]:
+        print("\nWarning: baseline was recorded with a different dataset.")
+
+    regressions = find_regressions(
+        results, baseline["results"], args.threshold)
+
+    if regressions:
+        print("\nREGRESSIONS:")
+        for message in regressions:
+            print(f"  {message}")
+        return 1
+
+    print("\nNo regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
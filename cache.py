@@ -0,0 +1,789 @@
+"""Caching for Flask Cafe.
+
+`cache` stores picklable values under string keys, in one of several
+backends chosen by CACHE_BACKEND:
+
+    memory    a bounded LRU in each worker process (the default)
+    sqlite    a SQLite file, shared by all workers on a host
+    redis     a Redis server (or anything speaking its protocol), shared by
+              every host
+    null      stores nothing; every lookup misses
+
+    cache.set("greeting", "hello", ttl=60)
+    cache.get("greeting")                   # "hello", for a minute
+    cache.get_many(["greeting", "other"])   # {"greeting": "hello"}
+    cache.delete("greeting")
+
+Entries can carry version tags. Each tag has a version number, stored in
+the cache too, and an entry is only returned while all of its tags still
+have the versions they had when it was stored. `cache.invalidate(tag)`
+gives a tag a new version, so every entry carrying it is dropped at once,
+without having to know their keys.
+
+`@cache.memoize` caches a function's results by its arguments. Catalog
+lookups are tagged with the venue's entity ("cafe") and key ("cafe:12"),
+and the cache subscribes to the invalidation bus (see invalidation.py), so
+a change to a venue from any worker invalidates it everywhere:
+
+    cafe = get_or_404(Cafe, cafe_id)
+
+Backend errors (say, Redis being down) are logged and treated as misses;
+pages then fall back to the database rather than failing.
+
+Config:
+    CACHE_BACKEND         memory, sqlite, redis or null (default memory)
+    CACHE_DEFAULT_TTL     seconds entries live without a ttl (default 300)
+    CACHE_MAX_BYTES       memory backend's size limit (default 32 MB)
+    CACHE_SQLITE_PATH     SQLite file (default: in the instance folder)
+    CACHE_SQLITE_MAX_ENTRIES  entries the SQLite file may hold
+                          (default 100000)
+    CACHE_REDIS_URL       redis://[:password@]host[:port][/db]; clear()
+                          flushes the whole db, so give the cache its own
+    CACHE_REDIS_TIMEOUT   seconds to wait for Redis (default 1)
+"""
+
+import functools
+import os
+import pickle
+import random
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, unquote
+
+from invalidation import bus, ENTITIES
+from models import db
+
+# returned by lookups for a miss, so that None can be cached
+MISSING = object()
+
+# prefix of the keys tag versions are stored under
+TAG_PREFIX = "tag:"
+
+# rough per-entry cost of the memory backend's dict slot, tuple and objects
+ENTRY_OVERHEAD = 200
+
+# fraction of SQLite writes that also clear out expired entries
+PRUNE_CHANCE = 0.01
+
+# SQLite's limit on parameters in one statement is 999 in older versions
+SQLITE_BATCH = 500
+
+
+class CacheError(Exception):
+    """A cache backend failed, e.g. Redis replied with an error."""
+
+
+#######################################
+# backends
+#
+# Backends store bytes: the Cache pickles values, so every backend holds
+# exactly what it's given, and callers can't change a cached value by
+# changing what they got back. A ttl of None means no expiry.
+
+
+class NullBackend:
+    """Stores nothing."""
+
+    per_process = False
+
+    def get_many(self, keys):
+        return {}
+
+    def set_many(self, items, ttl):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class MemoryBackend:
+    """A least-recently-used cache of at most `max_bytes`, counting keys,
+    values and ENTRY_OVERHEAD for each entry."""
+
+    # other workers' writes only reach it through the invalidation bus
+    per_process = True
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        # key: (data, expires_at); least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _size(self, key, data):
+        return len(key) + len(data) + ENTRY_OVERHEAD
+
+    def _remove(self, key):
+        data, expires_at = self._entries.pop(key)
+        self.bytes -= self._size(key, data)
+
+    def get_many(self, keys):
+        found = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+
+                if entry is None:
+                    continue
+
+                data, expires_at = entry
+
+                if expires_at is not None and expires_at <= now:
+                    self._remove(key)
+                    self.expirations += 1
+                    continue
+
+                self._entries.move_to_end(key)
+                found[key] = data
+
+        return found
+
+    def set_many(self, items, ttl):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            for key, data in items.items():
+                if key in self._entries:
+                    self._remove(key)
+
+                size = self._size(key, data)
+
+                # would push everything else out
+                if size > self.max_bytes:
+                    continue
+
+                self._entries[key] = (data, expires_at)
+                self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at);
+"""
+
+
+class SQLiteBackend:
+    """A SQLite file shared by every worker on the host, holding at most
+    `max_entries`. When full, the entries closest to expiring go first."""
+
+    per_process = False
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per thread, reopened after gunicorn forks
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None or self._local.pid != os.getpid():
+            self._check_file()
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+
+            # losing the last writes in a power cut is fine for a cache
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SQLITE_SCHEMA)
+
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def _check_file(self):
+        """Create the file, readable only by us, or make sure nobody else
+        can have written to it: values read from it are unpickled."""
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT
+                     | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            stat = os.fstat(fd)
+        finally:
+            os.close(fd)
+
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+            raise CacheError(
+                f"{self.path} is not owned by this user, or others can "
+                "write to it")
+
+    def get_many(self, keys):
+        conn = self._connect()
+        keys = list(keys)
+        found = {}
+
+        for start in range(0, len(keys), SQLITE_BATCH):
+            batch = keys[start:start + SQLITE_BATCH]
+            placeholders = ", ".join("?" * len(batch))
+
+            found.update(conn.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({placeholders}) "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (*batch, time.time())))
+
+        return found
+
+    def set_many(self, items, ttl):
+        conn = self._connect()
+        expires_at = None if ttl is None else time.time() + ttl
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) "
+            "VALUES (?, ?, ?)",
+            [(key, data, expires_at) for key, data in items.items()])
+
+        if random.random() < PRUNE_CHANCE:
+            self._prune(conn)
+
+    def _prune(self, conn):
+        """Delete expired entries, then the ones closest to expiring until
+        there are at most max_entries."""
+
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+
+        [count] = conn.execute("SELECT count(*) FROM cache").fetchone()
+        excess = count - self.max_entries
+
+        if excess > 0:
+            # entries that never expire (tag versions) go last
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                "ORDER BY expires_at IS NULL, expires_at LIMIT ?)",
+                (excess,))
+            self.evictions += excess
+
+    def delete_many(self, keys):
+        self._connect().executemany("DELETE FROM cache WHERE key = ?",
+                                    [(key,) for key in keys])
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache")
+
+    def stats(self):
+        [count] = self._connect().execute(
+            "SELECT count(*) FROM cache").fetchone()
+
+        return {"entries": count, "evictions": self.evictions}
+
+
+class RedisBackend:
+    """A Redis server, spoken to directly over its wire protocol (RESP)."""
+
+    per_process = False
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = parts.password and unquote(parts.password)
+        self.db = int(parts.path.strip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per thread, reopened after gunicorn forks
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port),
+                                            timeout=self.timeout)
+            conn = sock.makefile("rwb")
+
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+            try:
+                if self.password:
+                    self._execute(("AUTH", self.password))
+                if self.db:
+                    self._execute(("SELECT", self.db))
+            except Exception:
+                self._disconnect()
+                raise
+
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+
+        if conn is not None:
+            conn.close()
+
+    def _execute(self, *commands):
+        """Send `commands` in one pipeline; returns their replies."""
+
+        conn = self._connect()
+
+        try:
+            conn.write(b"".join(encode_command(command)
+                                for command in commands))
+            conn.flush()
+
+            replies = [read_reply(conn) for command in commands]
+        except (OSError, CacheError):
+            # a half-read reply would confuse the next command
+            self._disconnect()
+            raise
+
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+
+        return replies
+
+    def get_many(self, keys):
+        keys = list(keys)
+
+        if not keys:
+            return {}
+
+        [values] = self._execute(("MGET", *keys))
+
+        return {key: value for key, value in zip(keys, values)
+                if value is not None}
+
+    def set_many(self, items, ttl):
+        expiry = () if ttl is None else ("PX", max(1, round(ttl * 1000)))
+
+        if items:
+            self._execute(*[("SET", key, data, *expiry)
+                            for key, data in items.items()])
+
+    def delete_many(self, keys):
+        if keys:
+            self._execute(("DEL", *keys))
+
+    def clear(self):
+        self._execute(("FLUSHDB",))
+
+    def stats(self):
+        [count] = self._execute(("DBSIZE",))
+
+        return {"entries": count}
+
+
+def encode_command(args):
+    """Encode a command as a RESP array of bulk strings."""
+
+    parts = [b"*%d\r\n" % len(args)]
+
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = b"%d" % arg
+
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+    return b"".join(parts)
+
+
+def read_reply(conn):
+    """Read one RESP reply from `conn`. Error replies are returned as
+    CacheErrors, so the rest of a pipeline can still be read."""
+
+    line = conn.readline()
+
+    if not line.endswith(b"\r\n"):
+        raise CacheError("Connection closed by Redis")
+
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b"+":
+        return rest.decode()
+
+    if kind == b"-":
+        return CacheError(rest.decode())
+
+    if kind == b":":
+        return int(rest)
+
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+
+        data = conn.read(length + 2)
+        return data[:-2]
+
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+
+        return [read_reply(conn) for _ in range(length)]
+
+    raise CacheError(f"Unexpected reply from Redis: {line!r}")
+
+
+#######################################
+# cache
+
+
+class Cache:
+    """Tagged, expiring cache in front of the configured backend."""
+
+    def __init__(self):
+        self.app = None
+        self.backend = NullBackend()
+        self.default_ttl = 300
+        self.counters = dict.fromkeys(
+            ("hits", "misses", "sets", "deletes", "errors"), 0)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.config.setdefault(
+            'CACHE_SQLITE_PATH', os.path.join(app.instance_path, "cache.sqlite3"))
+        app.config.setdefault('CACHE_SQLITE_MAX_ENTRIES', 100_000)
+        app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('CACHE_REDIS_TIMEOUT', 1)
+
+        self.app = app
+        self.backend = make_backend(app.config)
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        self.reset_counters()
+
+    def _listen(self):
+        """Make sure this process hears of other workers' changes, if the
+        backend lives in this process. The catalog starts the invalidation
+        bus too, but only when the snapshot is on."""
+
+        # threads don't survive gunicorn forking workers, so once per pid
+        if self.backend.per_process and self._pid != os.getpid():
+            self._pid = os.getpid()
+            bus.start()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def reset_counters(self):
+        with self._lock:
+            for name in self.counters:
+                self.counters[name] = 0
+
+    def _failed(self, action):
+        self._count("errors")
+        self.app.logger.exception("Cache %s failed", action)
+
+    def stats(self):
+        """Hit, miss, set, delete and error counts for this process, and
+        the backend's own stats (entries, evictions, ...)."""
+
+        with self._lock:
+            stats = dict(self.counters)
+
+        try:
+            stats.update(self.backend.stats())
+        except Exception:
+            self._failed("stats")
+
+        return stats
+
+    ########################
+    # tags
+
+    def _tag_versions(self, tags, found):
+        """Current {tag: version} for `tags`, from the tag entries among
+        `found` (fetched along with the values), creating any missing."""
+
+        versions = {}
+        missing = {}
+
+        for tag in tags:
+            data = found.get(TAG_PREFIX + tag)
+
+            if data is None:
+                # random, so a tag dropped by the backend and recreated
+                # can't match versions stored before it was dropped
+                missing[TAG_PREFIX + tag] = new_version()
+                versions[tag] = missing[TAG_PREFIX + tag]
+            else:
+                versions[tag] = int(data)
+
+        if missing:
+            self.backend.set_many(
+                {key: b"%d" % version for key, version in missing.items()},
+                None)
+
+        return versions
+
+    def invalidate(self, *tags):
+        """Drop every entry tagged with any of `tags`."""
+
+        try:
+            self.backend.set_many(
+                {TAG_PREFIX + tag: b"%d" % new_version() for tag in tags},
+                None)
+        except Exception:
+            self._failed("invalidate")
+
+    ########################
+    # entries
+
+    def get(self, key, default=None):
+        """Return the value cached under `key`, or `default`."""
+
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """Return {key: value} for those of `keys` that are cached."""
+
+        self._listen()
+        keys = list(keys)
+
+        try:
+            entries = {key: pickle.loads(data) for key, data
+                       in self.backend.get_many(keys).items()}
+
+            tags = {tag for value, versions in entries.values()
+                    for tag in versions}
+            current = self._tag_versions(
+                tags, self.backend.get_many(TAG_PREFIX + tag for tag in tags))
+
+        except Exception:
+            self._failed("get")
+            self._count("misses", len(keys))
+            return {}
+
+        found = {key: value for key, (value, versions) in entries.items()
+                 if all(current[tag] == version
+                        for tag, version in versions.items())}
+
+        self._count("hits", len(found))
+        self._count("misses", len(keys) - len(found))
+
+        return found
+
+    def set(self, key, value, ttl=None, tags=()):
+        """Cache `value` under `key` for `ttl` seconds (default
+        CACHE_DEFAULT_TTL), until any of `tags` is invalidated."""
+
+        try:
+            versions = self._tag_versions(
+                tags, self.backend.get_many(TAG_PREFIX + tag for tag in tags))
+            self._store(key, value, ttl, versions)
+        except Exception:
+            self._failed("set")
+
+    def _store(self, key, value, ttl, versions):
+        data = pickle.dumps((value, versions), pickle.HIGHEST_PROTOCOL)
+        self.backend.set_many({key: data}, ttl or self.default_ttl)
+        self._count("sets")
+
+    def delete(self, *keys):
+        """Remove `keys` from the cache."""
+
+        try:
+            self.backend.delete_many(keys)
+            self._count("deletes", len(keys))
+        except Exception:
+            self._failed("delete")
+
+    def clear(self):
+        """Remove everything, tag versions included."""
+
+        try:
+            self.backend.clear()
+        except Exception:
+            self._failed("clear")
+
+    ########################
+    # memoizing
+
+    def memoize(self, ttl=None, key=None, tags=None):
+        """Decorator caching a function's return values.
+
+        The key is the function's name and arguments, or `key(*args)`.
+        `tags(*args)` returns the version tags to store the value with.
+        Exceptions (like a 404) aren't cached. The decorated function's
+        `uncached` attribute is the original.
+        """
+
+        def decorator(func):
+            name = f"{func.__module__}.{func.__qualname__}"
+
+            @functools.wraps(func)
+            def wrapper(*args):
+                cache_key = (key(*args) if key
+                             else ":".join(map(str, (name, *args))))
+                entry_tags = tags(*args) if tags else ()
+
+                value = self._lookup(cache_key, entry_tags)
+
+                if value is MISSING:
+                    value = self._fill(cache_key, entry_tags, ttl, func, args)
+
+                return value
+
+            wrapper.uncached = func
+            return wrapper
+
+        return decorator
+
+    def _lookup(self, key, tags):
+        """Return the value under `key` if its tag versions are current,
+        else MISSING; fetches the value and tags in one round trip."""
+
+        self._listen()
+
+        try:
+            found = self.backend.get_many(
+                [key, *(TAG_PREFIX + tag for tag in tags)])
+
+            if key in found:
+                value, versions = pickle.loads(found[key])
+
+                if all(found.get(TAG_PREFIX + tag) == b"%d" % version
+                       for tag, version in versions.items()):
+                    self._count("hits")
+                    return value
+
+        except Exception:
+            self._failed("get")
+
+        self._count("misses")
+        return MISSING
+
+    def _fill(self, key, tags, ttl, func, args):
+        # read the versions before computing the value: if a change lands
+        # in between, the entry is stored with versions already outdated
+        # and never served
+        try:
+            versions = self._tag_versions(
+                tags, self.backend.get_many(TAG_PREFIX + tag for tag in tags))
+        except Exception:
+            self._failed("set")
+            return func(*args)
+
+        value = func(*args)
+
+        try:
+            self._store(key, value, ttl, versions)
+        except Exception:
+            self._failed("set")
+
+        return value
+
+    ########################
+    # invalidation
+
+    def on_change(self, entity, id):
+        """Invalidation bus callback: drop what's cached for the change."""
+
+        if entity == "*":
+            self.invalidate(*ENTITIES.values())
+        elif id is None:
+            self.invalidate(entity)
+        else:
+            self.invalidate(entity_key(entity, id))
+
+
+def new_version():
+    return random.getrandbits(62)
+
+
+def make_backend(config):
+    """Create the backend named by CACHE_BACKEND."""
+
+    name = config['CACHE_BACKEND']
+
+    if name == "memory":
+        return MemoryBackend(config['CACHE_MAX_BYTES'])
+
+    if name == "sqlite":
+        return SQLiteBackend(config['CACHE_SQLITE_PATH'],
+                             config['CACHE_SQLITE_MAX_ENTRIES'])
+
+    if name == "redis":
+        return RedisBackend(config['CACHE_REDIS_URL'],
+                            config['CACHE_REDIS_TIMEOUT'])
+
+    if name == "null":
+        return NullBackend()
+
+    raise ValueError(f"Unknown CACHE_BACKEND: {name}")
+
+
+cache = Cache()
+bus.subscribe(cache.on_change)
+
+
+#######################################
+# model lookups
+
+
+def entity_key(entity, id):
+    return f"{entity}:{id}"
+
+
+@cache.memoize(key=lambda model, id: entity_key(ENTITIES[model], id),
+               tags=lambda model, id: [ENTITIES[model],
+                                       entity_key(ENTITIES[model], id)])
+def _load(model, id):
+    return model.query.get_or_404(id)
+
+
+def get_or_404(model, id):
+    """Like model.query.get_or_404(id) for a cafe, restaurant or city, but
+    through the cache.
+
+    The instance comes back attached to the current session. It can lag a
+    change made by another worker until the notification arrives, so views
+    that edit should load from the database."""
+
+    # a cached copy is a new, detached instance; merging it without
+    # load=True adds it to the session without querying
+    return db.session.merge(_load(model, id), load=False)
@@ -0,0 +1,331 @@
+"""In-process snapshot of the venue catalog for Flask Cafe.
+
+Cafes, restaurants and cities change only when an admin edits them, but
+nearly every page reads them. Each worker keeps a read-only copy of the
+whole catalog in memory and serves list, detail and city pages from it.
+
+Any change to the catalog, from any worker, arrives through the
+invalidation bus (see invalidation.py). The worker stops using its
+snapshot at once, falling back to the database, and reloads it.
+
+A background thread also polls catalog_version (bumped by triggers on
+every write, see models.CatalogVersion), and loads a new snapshot when the
+version has moved. It polls every CATALOG_POLL_SECONDS while the bus isn't
+listening, and only as a safety net otherwise. Without the bus, until a
+snapshot has been confirmed current within CATALOG_MAX_STALE_SECONDS,
+pages fall back to querying the database, as they do for anything the
+snapshot can't answer, like liked-only lists.
+
+Config:
+    CATALOG_SNAPSHOT                serve from the snapshot (default True)
+    CATALOG_POLL_SECONDS            how often to check the version without
+                                    the bus (default 2)
+    CATALOG_LISTEN_POLL_SECONDS     how often with it, to catch writes made
+                                    outside the app (default 10)
+    CATALOG_MAX_STALE_SECONDS       without the bus, fall back to the
+                                    database if the version hasn't been
+                                    checked for this long (default 10)
+"""
+
+import os
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import select
+
+from invalidation import bus
+from cache import get_or_404
+from models import db, Cafe, Restaurant, City, CatalogVersion, VenueCard
+from models import venue_cards, city_facets, preview_text
+
+class CityRecord:
+    """A city, as kept in the snapshot."""
+
+    __slots__ = ("code", "name", "state")
+
+    def __init__(self, code, name, state):
+        self.code = code
+        self.name = name
+        self.state = state
+
+
+class VenueRecord:
+    """A cafe or restaurant, as kept in the snapshot; has what the detail
+    page shows."""
+
+    __slots__ = ("id", "name", "description", "url", "address", "image_url",
+                 "city")
+
+    def __init__(self, id, name, description, url, address, image_url, city):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.url = url
+        self.address = address
+        self.image_url = image_url
+        self.city = city
+
+    def get_city_state(self):
+        """Return 'city, state' for venue."""
+
+        return f'{self.city.name}, {self.city.state}'
+
+
+class Facet:
+    """A city and how many venues it has, like a city_facets row."""
+
+    __slots__ = ("code", "name", "state", "count")
+
+    def __init__(self, code, name, state, count):
+        self.code = code
+        self.name = name
+        self.state = state
+        self.count = count
+
+
+class Venues:
+    """The snapshot of one venue model.
+
+    `cards` are in name order, with each card's city in the matching slot
+    of `card_cities`, so filtering a list never touches the full records.
+    """
+
+    def __init__(self, records):
+        self.by_id = {record.id: record for record in records}
+        self.cards = [
+            VenueCard(record.id, record.name, record.image_url,
+                      preview_text(record.description), record.city.name,
+                      record.city.state)
+            for record in records
+        ]
+        self.card_cities = [record.city for record in records]
+
+
+class CatalogSnapshot:
+    """Every city, cafe and restaurant at one catalog version."""
+
+    def __init__(self, version, cities, venues):
+        self.version = version
+        self.cities = cities
+        self.cities_by_code = {city.code: city for city in cities}
+        self.venues = venues
+
+    def cards(self, model, city_code=None, state=None):
+        """VenueCards of `model` in name order, filtered like venue_cards."""
+
+        venues = self.venues[model]
+
+        return [card for card, city in zip(venues.cards, venues.card_cities)
+                if (not city_code or city.code == city_code)
+                and (not state or city.state == state)]
+
+    def facets(self, model):
+        """Like city_facets, without the liked_by filter."""
+
+        counts = {}
+        for city in self.venues[model].card_cities:
+            counts[city.code] = counts.get(city.code, 0) + 1
+
+        return [Facet(city.code, city.name, city.state, counts[city.code])
+                for city in self.cities if city.code in counts]
+
+
+def load_snapshot(conn, version):
+    """Read the whole catalog over `conn`."""
+
+    cities = [CityRecord(*row) for row in conn.execute(
+        select(City.code, City.name, City.state).order_by(City.name))]
+    by_code = {city.code: city for city in cities}
+
+    venues = {}
+
+    for model in (Cafe, Restaurant):
+        rows = conn.execute(
+            select(model.id, model.name, model.description, model.url,
+                   model.address, model.image_url, model.city_code)
+            .order_by(model.name))
+
+        venues[model] = Venues([VenueRecord(*row[:-1], by_code[row[-1]])
+                                for row in rows])
+
+    return CatalogSnapshot(version, cities, venues)
+
+
+class Catalog:
+    """Keeps this process's catalog snapshot up to date."""
+
+    def __init__(self):
+        self.snapshot = None
+        self.checked_at = None
+        self.engine = None
+
+        # bumped by invalidate(), so a poll that started before a local
+        # write can't mark its (older) snapshot as current
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('CATALOG_SNAPSHOT', True)
+        app.config.setdefault('CATALOG_POLL_SECONDS', 2)
+        app.config.setdefault('CATALOG_LISTEN_POLL_SECONDS', 10)
+        app.config.setdefault('CATALOG_MAX_STALE_SECONDS', 10)
+
+        self.app = app
+
+    def current(self):
+        """Return the snapshot if it's known to be up to date, else None."""
+
+        config = current_app.config
+
+        if not config['CATALOG_SNAPSHOT']:
+            return None
+
+        # threads don't survive gunicorn forking workers from the master,
+        # so each process starts its own
+        if self._pid != os.getpid():
+            self.start()
+
+        if self.checked_at is None:
+            return None
+
+        # while the bus is listening, we'd have heard of any change
+        if (not bus.listening and time.monotonic() - self.checked_at
+                > config['CATALOG_MAX_STALE_SECONDS']):
+            return None
+
+        return self.snapshot
+
+    def start(self):
+        """Load a snapshot, then keep polling in a background thread."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self.snapshot = self.checked_at = None
+
+            with self.app.app_context():
+                self.engine = db.engine
+
+        # before the first load, so no change can slip in between
+        bus.start()
+        self._poll_logging_errors()
+
+        threading.Thread(target=self._run, name="catalog-poller",
+                         daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.app.config[
+                'CATALOG_LISTEN_POLL_SECONDS' if bus.listening
+                else 'CATALOG_POLL_SECONDS'])
+            self._wake.clear()
+            self._poll_logging_errors()
+
+    def _poll_logging_errors(self):
+        try:
+            self.poll()
+        except Exception:
+            # pages fall back to the database until a poll succeeds
+            self.app.logger.exception("Catalog poll failed")
+
+    def poll(self):
+        """Check the catalog version, loading a new snapshot if it's
+        moved; returns the snapshot."""
+
+        generation = self._generation
+        engine = self.engine or db.engine
+
+        with engine.connect() as conn:
+            # read before the catalog itself: if a write lands in between,
+            # the snapshot is newer than its version, never older
+            version = conn.execute(
+                select(CatalogVersion.version)
+                .where(CatalogVersion.id == 1)).scalar_one()
+
+            snapshot = self.snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = load_snapshot(conn, version)
+
+        with self._lock:
+            self.snapshot = snapshot
+
+            if generation == self._generation:
+                self.checked_at = time.monotonic()
+
+        return snapshot
+
+    def invalidate(self):
+        """Stop serving the snapshot until the next poll, and poll now."""
+
+        with self._lock:
+            self._generation += 1
+            self.checked_at = None
+
+        self._wake.set()
+
+    def on_change(self, entity, id):
+        """Invalidation bus callback. Any change means a new snapshot."""
+
+        self.invalidate()
+
+
+catalog = Catalog()
+bus.subscribe(catalog.on_change)
+
+
+#######################################
+# lookups, from the snapshot if possible
+
+
+def list_cards(model, city_code=None, state=None, liked_by=None,
+               yield_per=None):
+    """VenueCards of `model`, as for venue_cards."""
+
+    snapshot = catalog.current()
+
+    if snapshot is None or liked_by:
+        return venue_cards(model, city_code, state, liked_by, yield_per)
+
+    return snapshot.cards(model, city_code, state)
+
+
+def list_facets(model, liked_by=None):
+    """Cities with venues of `model`, as for city_facets."""
+
+    snapshot = catalog.current()
+
+    if snapshot is None or liked_by:
+        return city_facets(model, liked_by=liked_by)
+
+    return snapshot.facets(model)
+
+
+def list_cities():
+    """Every city, in name order."""
+
+    snapshot = catalog.current()
+
+    if snapshot is None:
+        return City.query.order_by(City.name).all()
+
+    return snapshot.cities
+
+
+def get_city_or_404(code):
+    snapshot = catalog.current()
+    city = snapshot and snapshot.cities_by_code.get(code)
+
+    # not in the snapshot may just mean it's new
+    return city or get_or_404(City, code)
+
+
+def get_venue_or_404(model, id):
+    snapshot = catalog.current()
+    venue = snapshot and snapshot.venues[model].by_id.get(id)
+
+    return venue or get_or_404(model, id)
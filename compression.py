@@ -0,0 +1,258 @@
+"""Response compression for Flask Cafe.
+
+Rendered pages and API JSON are compressed with brotli or gzip, whichever
+the client prefers in Accept-Encoding. Streamed responses are compressed
+chunk by chunk, flushing after each one so the browser still gets the page
+progressively.
+
+Static files aren't compressed per request. `flask static compress` writes
+.br and .gz siblings next to them at build time (e.g. style.css.br), and
+the static view serves a sibling when the client accepts it.
+
+Config:
+    COMPRESS_ENABLED          turn compression on/off (default True)
+    COMPRESS_MIN_SIZE         skip bodies smaller than this many bytes,
+                              where headers outweigh the savings (default 500)
+    COMPRESS_MIMETYPES        content types to compress
+    COMPRESS_GZIP_LEVEL       zlib level for responses (default 6)
+    COMPRESS_BROTLI_QUALITY   brotli quality for responses (default 4)
+"""
+
+import gzip
+import mimetypes
+import os
+import zlib
+
+import brotli
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+from werkzeug.security import safe_join
+
+DEFAULT_MIMETYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/msgpack",
+    "application/x-msgpack",
+    "application/vnd.msgpack",
+    "image/svg+xml",
+    "image/vnd.microsoft.icon",
+    "image/x-icon",
+}
+
+# in order of preference when the client likes both equally
+ENCODINGS = ["br", "gzip"]
+
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+class GzipEncoder:
+    """Incremental gzip compression."""
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Return everything compressed so far, without ending the stream."""
+
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    """Incremental brotli compression."""
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        """Return everything compressed so far, without ending the stream."""
+
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def init_compression(app):
+    """Compress the app's responses and serve precompressed static files.
+
+    Call this before setting up anything else that changes response bodies
+    (like the debug toolbar), so compression runs after them.
+    """
+
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+
+    if not app.config['COMPRESS_ENABLED']:
+        return
+
+    app.after_request(compress_response)
+
+    if app.has_static_folder:
+        app.view_functions["static"] = send_static
+
+
+def negotiate_encoding():
+    """Return the encoding to use for this request, or None."""
+
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def make_encoder(encoding):
+    if encoding == "br":
+        return BrotliEncoder(current_app.config['COMPRESS_BROTLI_QUALITY'])
+
+    return GzipEncoder(current_app.config['COMPRESS_GZIP_LEVEL'])
+
+
+def compress_chunks(chunks, encoder):
+    """Compress a stream of byte chunks, flushing after each one."""
+
+    for chunk in chunks:
+        compressed = encoder.compress(chunk) + encoder.flush()
+        if compressed:
+            yield compressed
+
+    yield encoder.finish()
+
+
+def compress_response(response):
+    """after_request hook: compress the body if it's worth it."""
+
+    if response.mimetype not in current_app.config['COMPRESS_MIMETYPES']:
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if (response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or "Content-Range" in response.headers
+            or response.status_code < 200
+            or response.status_code in (204, 304)):
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    encoder = make_encoder(encoding)
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.iter_encoded(), encoder)
+        response.headers.pop("Content-Length", None)
+
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        response.set_data(encoder.compress(data) + encoder.finish())
+
+    response.headers["Content-Encoding"] = encoding
+
+    return response
+
+
+def send_static(filename):
+    """Static file view that prefers a precompressed sibling, if there's an
+    up-to-date one the client can accept."""
+
+    folder = current_app.static_folder
+    mimetype = mimetypes.guess_type(filename)[0]
+
+    if mimetype not in current_app.config['COMPRESS_MIMETYPES']:
+        return current_app.send_static_file(filename)
+
+    encoding = negotiate_encoding()
+    path = safe_join(folder, filename)
+
+    if encoding and path:
+        sibling = path + SUFFIXES[encoding]
+
+        if (os.path.isfile(sibling) and os.path.isfile(path)
+                and os.path.getmtime(sibling) >= os.path.getmtime(path)):
+            response = send_from_directory(
+                folder, filename + SUFFIXES[encoding], mimetype=mimetype,
+                max_age=current_app.get_send_file_max_age(filename))
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            return response
+
+    response = current_app.send_static_file(filename)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+#######################################
+# CLI
+
+
+static_cli = AppGroup('static', help="Manage static files.")
+
+
+def precompress(path):
+    """Write .br and .gz siblings of the file at path, at maximum
+    compression; returns the paths written."""
+
+    with open(path, "rb") as file:
+        data = file.read()
+
+    written = []
+
+    for encoding, compressed in [
+        ("br", brotli.compress(data, quality=11)),
+        ("gzip", gzip.compress(data, compresslevel=9, mtime=0)),
+    ]:
+        sibling = path + SUFFIXES[encoding]
+
+        # not worth serving if it barely shrinks
+        if len(compressed) >= len(data) * 0.9:
+            if os.path.exists(sibling):
+                os.remove(sibling)
+            continue
+
+        with open(sibling, "wb") as file:
+            file.write(compressed)
+
+        written.append(sibling)
+
+    return written
+
+
+@static_cli.command('compress')
+def compress_command():
+    """Write .br/.gz versions of compressible static files."""
+
+    config = current_app.config
+    files = written = 0
+
+    for root, dirs, names in os.walk(current_app.static_folder):
+        for name in names:
+            if name.endswith(tuple(SUFFIXES.values())):
+                continue
+
+            path = os.path.join(root, name)
+
+            if (mimetypes.guess_type(name)[0] in config['COMPRESS_MIMETYPES']
+                    and os.path.getsize(path) >= config['COMPRESS_MIN_SIZE']):
+                files += 1
+                written += len(precompress(path))
+
+    click.echo(f"Compressed {files} static files ({written} siblings written)")
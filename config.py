@@ -0,0 +1,110 @@
+"""Config profiles for Flask Cafe.
+
+Pick one by name when creating the app (see create_app in app.py), or with
+the FLASK_CONFIG environment variable:
+
+    production    the default; no debug toolbar, no SQL echo
+    development   the default when FLASK_DEBUG is on; adds the debug toolbar
+                  and logs every SQL statement
+    testing       for tests.py; no CSRF checks and cheap password hashes
+
+Most settings are read from the environment (or a .env file).
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+from database import engine_options_from_env, env_flag, REPLICA_BIND
+
+load_dotenv()
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY")
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL")
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options_from_env()
+
+    if os.environ.get("DATABASE_REPLICA_URL"):
+        SQLALCHEMY_BINDS = {REPLICA_BIND: os.environ["DATABASE_REPLICA_URL"]}
+
+    REPLICA_STICKY_SECONDS = float(
+        os.environ.get("REPLICA_STICKY_SECONDS", 10))
+
+    BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+    HASHING_WORKERS = int(os.environ.get("HASHING_WORKERS", 2))
+    HASHING_QUEUE_LIMIT = int(os.environ.get("HASHING_QUEUE_LIMIT", 8))
+
+    # load tests log in from one IP far faster than the limits allow
+    THROTTLE_ENABLED = env_flag(os.environ, "THROTTLE_ENABLED", True)
+
+    if os.environ.get("THROTTLE_DB_PATH"):
+        THROTTLE_DB_PATH = os.environ["THROTTLE_DB_PATH"]
+
+    # when behind a proxy (e.g. Render), trust this many X-Forwarded-For
+    # hops so throttling sees real client IPs
+    TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+
+    if os.environ.get("TEMPLATE_CACHE_DIR"):
+        TEMPLATE_CACHE_DIR = os.environ["TEMPLATE_CACHE_DIR"]
+
+    # A/B test preload hints, measuring paint times in browsers
+    PRELOAD_INSTRUMENT = env_flag(os.environ, "PRELOAD_INSTRUMENT", False)
+
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+
+    if os.environ.get("CACHE_REDIS_URL"):
+        CACHE_REDIS_URL = os.environ["CACHE_REDIS_URL"]
+
+    DEBUG_TOOLBAR = False
+
+
+class ProductionConfig(Config):
+    """Settings for gunicorn workers and release commands."""
+
+
+class DevelopmentConfig(Config):
+    """Settings for `flask run --debug`."""
+
+    DEBUG = True
+
+    SQLALCHEMY_ECHO = True
+
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class TestingConfig(Config):
+    """Settings for tests.py."""
+
+    # make Flask errors be real errors, rather than HTML pages with error info
+    TESTING = True
+
+    # don't require CSRF for testing
+    WTF_CSRF_ENABLED = False
+
+    BCRYPT_LOG_ROUNDS = 4
+
+    TEMPLATE_CACHE = False
+
+    # Flask 2.3's test client mixes up request contexts when it follows a
+    # redirect to a streamed page; tests that stream turn this back on
+    STREAM_TEMPLATES = False
+
+    # tests change the catalog between requests faster than it's polled;
+    # catalog tests turn this on and poll by hand
+    CATALOG_SNAPSHOT = False
+    INVALIDATION_LISTEN = False
+
+    # cache tests set up their own backends
+    CACHE_BACKEND = "null"
+
+
+CONFIGS = {
+    "production": ProductionConfig,
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+}
@@ -0,0 +1,199 @@
+"""Database engine and connection-pool configuration for Flask Cafe.
+
+Settings are read from the environment:
+
+    DB_POOL_SIZE              connections kept open per worker (default 5)
+    DB_MAX_OVERFLOW           extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT           seconds to wait for a connection (default 30)
+    DB_POOL_RECYCLE           reconnect connections older than this many
+                              seconds (default 1800)
+    DB_POOL_PRE_PING          test connections before use, so ones killed by
+                              a Postgres restart are replaced (default 1)
+    DB_STATEMENT_TIMEOUT_MS   cancel statements running longer than this;
+                              0 disables it (default 0)
+    DB_PGBOUNCER              set to 1 when connecting through PgBouncer in
+                              transaction pooling mode (default 0)
+
+Reads can be spread to a replica: with DATABASE_REPLICA_URL set, the app
+adds a "replica" bind, and RoutingSession sends queries made while handling
+GET/HEAD requests there. Everything else -- flushes, INSERT/UPDATE/DELETE and
+every query in other requests -- goes to the primary. After a request writes
+anything, the user's reads stay on the primary for REPLICA_STICKY_SECONDS
+(default 10) so they see their own changes despite replication lag.
+
+PgBouncer's transaction pooling hands each transaction to whichever server
+connection is free, so per-connection settings don't stick and it refuses
+the `options` startup parameter. In that mode the statement timeout is set
+with SET LOCAL at the start of every transaction instead.
+"""
+
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask import session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def env_flag(environ, name, default):
+    """Read a 0/1 (or true/false) flag from the environment."""
+
+    value = environ.get(name)
+    if value is None:
+        return default
+
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def engine_options_from_env(environ=os.environ):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from DB_* environment variables."""
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": env_flag(environ, "DB_POOL_PRE_PING", True),
+    }
+
+    statement_timeout = int(environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+
+    if statement_timeout and not env_flag(environ, "DB_PGBOUNCER", False):
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={statement_timeout}",
+        }
+
+    return options
+
+
+def init_engine(engine, environ=os.environ):
+    """Hook up per-transaction settings that can't be engine options."""
+
+    statement_timeout = int(environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+
+    if statement_timeout and env_flag(environ, "DB_PGBOUNCER", False):
+
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(
+                f"SET LOCAL statement_timeout = {statement_timeout}")
+
+
+REPLICA_BIND = "replica"
+READ_METHODS = ("GET", "HEAD")
+
+# session key holding the time until which this user's reads use the primary
+STICKY_KEY = "db_primary_until"
+
+
+class RoutingSession(Session):
+    """Session that sends GET requests' reads to the replica bind, if any."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, "is_dml", False):
+                g.db_wrote = True
+
+            elif self._use_replica():
+                return self._db.engines[REPLICA_BIND]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+    def _use_replica(self):
+        return (request.method in READ_METHODS
+                and REPLICA_BIND in self._db.engines
+                and flask_session.get(STICKY_KEY, 0) < time.time())
+
+
+def init_read_routing(app):
+    """Keep a user's reads on the primary for a while after they write."""
+
+    sticky_seconds = app.config.setdefault('REPLICA_STICKY_SECONDS', 10)
+
+    @app.after_request
+    def stick_to_primary_after_write(response):
+        if g.pop("db_wrote", False):
+            flask_session[STICKY_KEY] = time.time() + sticky_seconds
+
+        return response
+
+    @app.teardown_request
+    def forget_write(exc):
+        g.pop("db_wrote", None)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records checkout counts, wait times and timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def recreate(self):
+        # keep counting across pool recreation (e.g. engine.dispose())
+        pool = super().recreate()
+
+        pool.checkouts = self.checkouts
+        pool.timeouts = self.timeouts
+        pool.wait_total = self.wait_total
+        pool.wait_max = self.wait_max
+
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+
+        finally:
+            wait = time.perf_counter() - start
+
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def stats(self):
+        """Return a dict of pool counters and current gauges."""
+
+        return {
+            "pid": os.getpid(),
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "max_overflow": self._max_overflow,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": (self.wait_total / self.checkouts * 1000
+                            if self.checkouts else 0),
+            "wait_max_ms": self.wait_max * 1000,
+        }
+
+
+def pool_stats(engine):
+    """Return stats for an engine's pool, whatever kind of pool it is."""
+
+    pool = engine.pool
+
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+
+    return {"pid": os.getpid(), "status": pool.status()}
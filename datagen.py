@@ -0,0 +1,302 @@
+"""Synthetic dataset generator for load and scale testing Flask Cafe.
+
+Builds cities, cafes, restaurants, users and likes at whatever size you ask
+for. Output depends only on the options and --seed, so two runs with the
+same arguments produce the same data and benchmarks can be compared.
+
+Usage:
+    flask generate --reset --cities 200 --cafes 1000000 \\
+        --restaurants 1000000 --users 200000 --likes 5000000
+
+Venue popularity and user activity both follow a power law (Zipf), so a few
+venues collect most of the likes. Coordinates come from the offline
+LocalGeocoder and no maps are fetched, so MapQuest is never called.
+"""
+
+import time
+from array import array
+from itertools import accumulate
+from random import Random
+
+import bcrypt
+import click
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from forms import ALL_US_STATES
+from mapping import LocalGeocoder
+from models import db, City, Cafe, Restaurant, User, CafeLike, RestaurantLike
+
+DEFAULT_PASSWORD = "password"
+
+BCRYPT_SALT_CHARS = ("./ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                     "abcdefghijklmnopqrstuvwxyz0123456789")
+
+NAME_WORDS = [
+    "Blue", "Golden", "Little", "Corner", "Urban", "Sunny", "Rustic", "Happy",
+    "Secret", "Morning", "Velvet", "Copper", "Maple", "Harbor", "Garden",
+    "Lucky", "Silver", "Wild", "Quiet", "Twin", "Red", "Northern", "Old",
+]
+
+CAFE_WORDS = ["Cafe", "Coffee", "Espresso Bar", "Roasters", "Tea House",
+              "Bakery", "Beans", "Brew"]
+
+RESTAURANT_WORDS = ["Kitchen", "Bistro", "Grill", "Noodle House", "Diner",
+                    "Taqueria", "Trattoria", "Eatery", "Table", "Ramen"]
+
+STREETS = ["Main", "Oak", "Pine", "Market", "Mission", "Valencia", "Grand",
+           "Broadway", "Irving", "Folsom", "Sunset", "Lake", "Park", "Hill"]
+
+STREET_SUFFIXES = ["St", "Ave", "Blvd", "Way", "Pkwy"]
+
+DESCRIPTION_WORDS = [
+    "cozy", "bright", "friendly", "spacious", "busy", "local", "famous",
+    "spot", "place", "seating", "wifi", "pastries", "noodles", "coffee",
+    "brunch", "dinner", "lunch", "patio", "music", "service", "menu",
+]
+
+
+def bcrypt_salt(rng, rounds):
+    """Return a bcrypt salt drawn from rng, so hashes are reproducible."""
+
+    chars = "".join(rng.choice(BCRYPT_SALT_CHARS) for _ in range(21))
+
+    # the last character only carries 2 bits of the 128-bit salt
+    return f"$2b${rounds:02d}${chars}{rng.choice('.Oeu')}".encode('utf-8')
+
+
+def zipf_cum_weights(n, exponent):
+    """Cumulative Zipf weights for ranks 1..n, for use with Random.choices."""
+
+    return list(accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+def insert_batches(model, rows, batch_size, returning=True):
+    """Insert rows from an iterable with multi-row INSERTs, committing after
+    every batch.
+
+    Returns an array of the new primary keys if `returning` is set.
+    """
+
+    ids = array('q')
+    batch = []
+
+    def flush():
+        if returning:
+            # in row order, which an executemany doesn't otherwise promise
+            ids.extend(db.session.scalars(
+                insert(model).returning(
+                    model.id, sort_by_parameter_order=True), batch))
+        else:
+            db.session.execute(insert(model), batch)
+
+        db.session.commit()
+        batch.clear()
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    return ids
+
+
+class DataGenerator:
+    """Generates a reproducible synthetic dataset from a seed."""
+
+    def __init__(self, seed=0, bcrypt_rounds=4, zipf_exponent=1.1,
+                 batch_size=5000):
+        self.rng = Random(seed)
+        self.seed = seed
+        self.bcrypt_rounds = bcrypt_rounds
+        self.zipf_exponent = zipf_exponent
+        self.batch_size = batch_size
+        self.geocoder = LocalGeocoder()
+
+        self.cities = []
+
+    def generate_cities(self, count):
+        """Insert `count` cities."""
+
+        self.cities = [
+            (f"gen{self.seed}-{i}",
+             f"{self.rng.choice(NAME_WORDS)} City {i}",
+             self.rng.choice(ALL_US_STATES))
+            for i in range(count)
+        ]
+
+        insert_batches(City, (
+            dict(code=code, name=name, state=state)
+            for code, name, state in self.cities
+        ), self.batch_size, returning=False)
+
+    def venue_rows(self, count, kind_words):
+        """Yield `count` venue rows spread across the generated cities."""
+
+        rng = self.rng
+
+        for i in range(count):
+            code, city, state = rng.choice(self.cities)
+            address = (f"{rng.randint(1, 9999)} {rng.choice(STREETS)} "
+                       f"{rng.choice(STREET_SUFFIXES)}")
+            latitude, longitude = self.geocoder.geocode(address, city, state)
+
+            yield dict(
+                name=(f"{rng.choice(NAME_WORDS)} {rng.choice(kind_words)} "
+                      f"{i}")[:50],
+                description=" ".join(
+                    rng.choices(DESCRIPTION_WORDS, k=rng.randint(5, 30))),
+                url=f"https://example.com/{code}/{i}",
+                address=address,
+                city_code=code,
+                latitude=latitude,
+                longitude=longitude,
+            )
+
+    def generate_venues(self, model, count, kind_words):
+        """Insert `count` venues of `model`; returns their ids."""
+
+        return insert_batches(
+            model, self.venue_rows(count, kind_words), self.batch_size)
+
+    def generate_users(self, count):
+        """Insert `count` users, all with DEFAULT_PASSWORD; returns their ids.
+
+        The password is hashed once, at the cheap cost factor, and shared.
+        """
+
+        password = bcrypt.hashpw(
+            DEFAULT_PASSWORD.encode('utf-8'),
+            bcrypt_salt(self.rng, self.bcrypt_rounds)).decode('utf-8')
+
+        return insert_batches(User, (
+            dict(
+                username=f"user{self.seed}-{i}",
+                email=f"user{self.seed}-{i}@example.com",
+                first_name=self.rng.choice(NAME_WORDS),
+                last_name=f"User{i}",
+                description="",
+                password=password,
+                admin=False,
+            )
+            for i in range(count)
+        ), self.batch_size)
+
+    def like_rows(self, count, user_ids, venue_ids, venue_column):
+        """Yield up to `count` likes, choosing users and venues by Zipf rank.
+
+        Duplicate (user, venue) pairs are dropped on insert, so popular
+        venues saturate instead of the generator looping forever.
+        """
+
+        user_weights = zipf_cum_weights(len(user_ids), self.zipf_exponent)
+        venue_weights = zipf_cum_weights(len(venue_ids), self.zipf_exponent)
+
+        # rank order is shuffled so the most liked venue isn't always id 1
+        venue_ranks = list(venue_ids)
+        self.rng.shuffle(venue_ranks)
+
+        for start in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - start)
+
+            users = self.rng.choices(user_ids, cum_weights=user_weights, k=size)
+            venues = self.rng.choices(
+                venue_ranks, cum_weights=venue_weights, k=size)
+
+            for user_id, venue_id in zip(users, venues):
+                yield {"user_id": user_id, venue_column: venue_id}
+
+    def generate_likes(self, model, venue_column, count, user_ids, venue_ids):
+        """Insert up to `count` likes into `model`; returns how many stuck."""
+
+        if not count or not user_ids or not venue_ids:
+            return 0
+
+        before = model.query.count()
+        batch = []
+
+        for row in self.like_rows(count, user_ids, venue_ids, venue_column):
+            batch.append(row)
+
+            if len(batch) >= self.batch_size:
+                self.insert_likes(model, batch)
+
+        if batch:
+            self.insert_likes(model, batch)
+
+        return model.query.count() - before
+
+    def insert_likes(self, model, batch):
+        """Insert a batch of likes, skipping pairs that already exist."""
+
+        db.session.execute(pg_insert(model).on_conflict_do_nothing(), batch)
+        db.session.commit()
+        batch.clear()
+
+
+#######################################
+# CLI
+
+
+@click.command('generate')
+@click.option('--cities', default=20, show_default=True)
+@click.option('--cafes', default=1000, show_default=True)
+@click.option('--restaurants', default=1000, show_default=True)
+@click.option('--users', default=100, show_default=True)
+@click.option('--likes', default=5000, show_default=True,
+              help="Like attempts, split between cafes and restaurants; "
+                   "duplicates are dropped.")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--bcrypt-rounds', default=4, show_default=True,
+              type=click.IntRange(4, 31),
+              help=f"bcrypt cost for the shared '{DEFAULT_PASSWORD}' password.")
+@click.option('--zipf', 'zipf_exponent', default=1.1, show_default=True,
+              help="Power-law exponent for venue popularity/user activity.")
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--reset', is_flag=True,
+              help="Drop and recreate all tables first.")
+def generate_cli(cities, cafes, restaurants, users, likes, seed,
+                 bcrypt_rounds, zipf_exponent, batch_size, reset):
+    """Generate a synthetic dataset for load and scale testing."""
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    generator = DataGenerator(seed=seed,
+                              bcrypt_rounds=bcrypt_rounds,
+                              zipf_exponent=zipf_exponent,
+                              batch_size=batch_size)
+
+    def timed(label, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+
+        count = result if isinstance(result, int) else len(result)
+        click.echo(f"{label}: {count} in {elapsed:.2f}s "
+                   f"({count / elapsed if elapsed else 0:.0f}/sec)")
+
+        return result
+
+    generator.generate_cities(max(cities, 1))
+    click.echo(f"cities: {len(generator.cities)}")
+
+    cafe_ids = timed("cafes", generator.generate_venues,
+                     Cafe, cafes, CAFE_WORDS)
+    restaurant_ids = timed("restaurants", generator.generate_venues,
+                           Restaurant, restaurants, RESTAURANT_WORDS)
+    user_ids = timed("users", generator.generate_users, users)
+
+    venue_total = len(cafe_ids) + len(restaurant_ids)
+    cafe_likes = likes * len(cafe_ids) // venue_total if venue_total else 0
+
+    timed("cafe likes", generator.generate_likes,
+          CafeLike, "cafe_id", cafe_likes, user_ids, cafe_ids)
+    timed("restaurant likes", generator.generate_likes,
+          RestaurantLike, "restaurant_id", likes - cafe_likes,
+          user_ids, restaurant_ids)
@@ -0,0 +1,152 @@
+"""Streaming exports of the catalog and likes for Flask Cafe.
+
+Rows are read through a server-side cursor (`yield_per`) and written out a
+chunk at a time, so memory use stays flat no matter how big the tables get.
+
+Usage:
+    flask export                              # every table, CSV
+    flask export cafes cafe_likes --format jsonl --gzip -o exports/
+"""
+
+import csv
+import io
+import json
+import os
+import zlib
+
+import click
+from sqlalchemy import select
+
+from models import db, Cafe, Restaurant, City, CafeLike, RestaurantLike
+
+EXPORTS = {
+    "cities": (City.code, City.name, City.state),
+    "cafes": (Cafe.id, Cafe.name, Cafe.description, Cafe.url, Cafe.address,
+              Cafe.city_code, Cafe.image_url, Cafe.latitude, Cafe.longitude),
+    "restaurants": (Restaurant.id, Restaurant.name, Restaurant.description,
+                    Restaurant.url, Restaurant.address, Restaurant.city_code,
+                    Restaurant.image_url, Restaurant.latitude,
+                    Restaurant.longitude),
+    "cafe_likes": (CafeLike.user_id, CafeLike.cafe_id),
+    "restaurant_likes": (RestaurantLike.user_id, RestaurantLike.restaurant_id),
+}
+
+FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+# rows fetched per round trip to the server-side cursor
+YIELD_PER = 1000
+
+# bytes buffered before a chunk is handed to the writer
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_rows(entity):
+    """Yield rows of an export table in primary key order, streamed from a
+    server-side cursor."""
+
+    columns = EXPORTS[entity]
+    primary_key = [column for column in columns if column.primary_key]
+
+    result = db.session.execute(
+        select(*columns)
+        .order_by(*primary_key)
+        .execution_options(yield_per=YIELD_PER))
+
+    yield from result
+
+
+def iter_csv(entity):
+    """Yield an export table as chunks of CSV text."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(column.key for column in EXPORTS[entity])
+
+    for row in iter_rows(entity):
+        writer.writerow(row)
+
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def iter_jsonl(entity):
+    """Yield an export table as chunks of JSON lines."""
+
+    lines = []
+    size = 0
+
+    for row in iter_rows(entity):
+        line = json.dumps(row._asdict()) + "\n"
+        lines.append(line)
+        size += len(line)
+
+        if size >= CHUNK_SIZE:
+            yield "".join(lines)
+            lines = []
+            size = 0
+
+    yield "".join(lines)
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of byte chunks on the fly."""
+
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export_chunks(entity, format, gzip=False):
+    """Yield an export table as bytes in the given format, optionally gzipped."""
+
+    text = iter_csv(entity) if format == "csv" else iter_jsonl(entity)
+    chunks = (chunk.encode('utf-8') for chunk in text if chunk)
+
+    return gzip_chunks(chunks) if gzip else chunks
+
+
+def export_filename(entity, format, gzip=False):
+    """Return the file name for an export, e.g. cafes.csv.gz"""
+
+    return f"{entity}.{format}{'.gz' if gzip else ''}"
+
+
+#######################################
+# CLI
+
+
+@click.command('export')
+@click.argument('entities', nargs=-1, type=click.Choice(list(EXPORTS)))
+@click.option('--format', 'format', type=click.Choice(list(FORMATS)),
+              default="csv", show_default=True)
+@click.option('--gzip', is_flag=True, help="Gzip each file.")
+@click.option('-o', '--output-dir', default=".", show_default=True,
+              type=click.Path(file_okay=False))
+def export_cli(entities, format, gzip, output_dir):
+    """Export catalog and like tables (all of them by default)."""
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    for entity in entities or EXPORTS:
+        path = os.path.join(output_dir, export_filename(entity, format, gzip))
+
+        with open(path, "wb") as file:
+            for chunk in export_chunks(entity, format, gzip):
+                file.write(chunk)
+
+        db.session.commit()
+
+        click.echo(f"Wrote {path}")
@@ -0,0 +1,62 @@
+"""Gunicorn settings for Flask Cafe.
+
+The app is loaded once in the master process and workers are forked from
+it, so they share its imported modules and compiled templates through
+copy-on-write instead of each loading them again. Each worker then drops
+any database connections it inherited, and fills its own pool before it
+starts accepting requests.
+
+Workers and bind address come from WEB_CONCURRENCY and PORT, as usual for
+gunicorn; set GUNICORN_WARMUP=0 to skip the per-worker warm-up.
+"""
+
+import os
+
+wsgi_app = "app:create_app()"
+
+preload_app = True
+
+
+def when_ready(server):
+    """In the master, after loading the app: compile templates once so
+    every worker inherits them."""
+
+    from templating import compile_templates
+
+    count = compile_templates(server.app.wsgi())
+    server.log.info("Compiled %d templates", count)
+
+
+def post_fork(server, worker):
+    """Drop pooled connections copied from the master.
+
+    close=False leaves the sockets alone, since they still belong to the
+    master; the worker just forgets them and opens its own.
+    """
+
+    from models import db
+
+    with server.app.wsgi().app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    """Fill the worker's connection pools before it accepts requests."""
+
+    if os.environ.get("GUNICORN_WARMUP", "1") == "0":
+        return
+
+    from warmup import warm_up
+
+    try:
+        result = warm_up(worker.wsgi)
+    except Exception:
+        # a slow or unreachable database shouldn't stop the worker booting;
+        # its first requests will just be cold
+        worker.log.exception("Warm-up failed")
+        return
+
+    worker.log.info("Warmed up in %.2fs: %d templates, connections %s",
+                    result["seconds"], result["templates"],
+                    result["connections"])
@@ -0,0 +1,145 @@
+"""Password hashing for Flask Cafe.
+
+bcrypt is deliberately slow, so hashing runs in a small process pool instead
+of the request thread. The pool has a queue limit: once that many hashes are
+waiting, new requests get a 503 right away instead of tying up every worker
+during a login storm.
+
+Config:
+    BCRYPT_LOG_ROUNDS     bcrypt cost factor for new hashes (default 12)
+    HASHING_WORKERS       processes in the pool; 0 hashes inline (default 2)
+    HASHING_QUEUE_LIMIT   hashes allowed in flight at once (default 8)
+    HASHING_TIMEOUT       seconds to wait for a result (default 10)
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.exceptions import ServiceUnavailable
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+def _hash_password(password, rounds):
+    """Return a bcrypt hash of password. Runs in a pool process."""
+
+    # imported here so web workers that hash in the pool never load it
+    import bcrypt
+
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password(pw_hash, password):
+    """Return whether password matches pw_hash. Runs in a pool process."""
+
+    import bcrypt
+
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def get_log_rounds(pw_hash):
+    """Return the cost factor a bcrypt hash was made with."""
+
+    # hashes look like $2b$12$<salt><checksum>
+    return int(pw_hash.split('$')[2])
+
+
+class HashingOverloaded(ServiceUnavailable):
+    """Too many password hashes are already queued."""
+
+    description = "Too many login attempts right now. Please try again."
+
+
+class PasswordHasher:
+    """Hashes and checks passwords through a bounded process pool."""
+
+    def __init__(self, app=None):
+        self.log_rounds = DEFAULT_LOG_ROUNDS
+        self.workers = 0
+        self.timeout = None
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read hashing settings from the app config."""
+
+        self.log_rounds = app.config.setdefault(
+            'BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+        self.workers = app.config.setdefault('HASHING_WORKERS', 2)
+        self.timeout = app.config.setdefault('HASHING_TIMEOUT', 10)
+
+        self._slots = threading.BoundedSemaphore(
+            app.config.setdefault('HASHING_QUEUE_LIMIT', 8))
+
+        self.shutdown()
+
+    def generate_password_hash(self, password):
+        """Hash password at the configured cost factor."""
+
+        return self._run(_hash_password, password, self.log_rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        """Return whether password matches pw_hash."""
+
+        return self._run(_check_password, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Return whether pw_hash was made with a different cost factor."""
+
+        return get_log_rounds(pw_hash) != self.log_rounds
+
+    def shutdown(self):
+        """Stop the pool; a new one is started on next use."""
+
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _get_pool(self):
+        # started lazily, so each gunicorn worker gets its own after forking
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+            return self._pool
+
+    def _run(self, func, *args):
+        """Run func in the pool, or raise HashingOverloaded if it's full."""
+
+        if not self.workers:
+            return func(*args)
+
+        slots = self._slots
+
+        if not slots.acquire(blocking=False):
+            raise HashingOverloaded()
+
+        try:
+            future = self._get_pool().submit(func, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self.shutdown()
+            raise HashingOverloaded()
+
+        # the slot is held until the hash actually finishes, even if we stop
+        # waiting for it, so timed out jobs still count against the limit
+        future.add_done_callback(lambda future: slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+
+        except FutureTimeoutError:
+            raise HashingOverloaded()
+
+        except BrokenProcessPool:
+            self.shutdown()
+            raise HashingOverloaded()
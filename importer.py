@@ -0,0 +1,270 @@
+"""Bulk import of cafes and restaurants for Flask Cafe.
+
+Usage:
+    flask import venues venues.csv
+    flask import venues venues.jsonl --type cafe --rejects rejects.jsonl
+    flask maps generate
+
+Each row has the same fields as the add cafe/restaurant forms (name,
+description, url, address, city_code, image_url), plus an optional `type`
+("cafe" or "restaurant"). Rows for cities that don't exist yet must also
+include `city_name` and `state`; those cities are created on the fly.
+"""
+
+import csv
+import json
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import insert
+from werkzeug.datastructures import MultiDict
+
+from forms import CafeInfoForm, RestaurantInfoForm, AddCityForm
+from mapping import get_geocoder
+from models import db, Cafe, Restaurant, City, MapJob
+
+VENUE_TYPES = {
+    "cafe": (Cafe, CafeInfoForm),
+    "restaurant": (Restaurant, RestaurantInfoForm),
+}
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def read_rows(file, format):
+    """Yield (line number, row) pairs from an open CSV or JSONL file.
+
+    Rows that can't be parsed are yielded as None.
+    """
+
+    if format == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+
+    else:
+        for line_num, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+
+            yield line_num, row if isinstance(row, dict) else None
+
+
+class VenueImporter:
+    """Validates venue rows and inserts them in multi-row batches.
+
+    Rows are checked with the same forms the admin pages use. Valid rows are
+    held until a batch fills, then geocoded and inserted together, and map
+    downloads for the new venues are queued as MapJobs.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, default_type=None):
+        self.batch_size = batch_size
+        self.default_type = default_type
+
+        self.cities = {code: (name, state) for code, name, state
+                       in db.session.query(City.code, City.name, City.state)}
+
+        self.pending = {venue_type: [] for venue_type in VENUE_TYPES}
+        self.imported = {venue_type: 0 for venue_type in VENUE_TYPES}
+        self.created_cities = 0
+        self.rejected = []
+
+    def add(self, line_num, row):
+        """Validate a row and queue it for insert, or record why it failed."""
+
+        if row is None:
+            self.reject(line_num, row, {"row": ["Could not parse row."]})
+            return
+
+        row = {key: "" if value is None else str(value).strip()
+               for key, value in row.items() if key}
+
+        venue_type = row.get("type") or self.default_type
+
+        if venue_type not in VENUE_TYPES:
+            self.reject(line_num, row, {
+                "type": ["Must be 'cafe' or 'restaurant'."]})
+            return
+
+        city_errors = self.ensure_city(row)
+        if city_errors:
+            self.reject(line_num, row, city_errors)
+            return
+
+        model, form_class = VENUE_TYPES[venue_type]
+
+        form = form_class(formdata=MultiDict(row), meta={"csrf": False})
+        form.city_code.choices = [(row["city_code"], row["city_code"])]
+
+        if not form.validate():
+            self.reject(line_num, row, form.errors)
+            return
+
+        self.pending[venue_type].append(dict(
+            name=form.name.data,
+            description=form.description.data or "",
+            url=form.url.data or "",
+            address=form.address.data,
+            city_code=form.city_code.data,
+            image_url=form.image_url.data or model.image_url.default.arg,
+        ))
+
+        if len(self.pending[venue_type]) >= self.batch_size:
+            self.flush(venue_type)
+
+    def ensure_city(self, row):
+        """Create the row's city if it doesn't exist yet.
+
+        Returns a dict of errors if the city is missing and can't be created.
+        """
+
+        code = row.get("city_code", "")
+
+        if code in self.cities:
+            return None
+
+        form = AddCityForm(
+            formdata=MultiDict({
+                "code": code,
+                "name": row.get("city_name", ""),
+                "state": row.get("state", "").upper(),
+            }),
+            meta={"csrf": False},
+        )
+
+        if not form.validate():
+            return {f"city_{field}": errors
+                    for field, errors in form.errors.items()}
+
+        db.session.add(City(code=form.code.data,
+                            name=form.name.data,
+                            state=form.state.data))
+        db.session.flush()
+
+        self.cities[code] = (form.name.data, form.state.data)
+        self.created_cities += 1
+
+        return None
+
+    def reject(self, line_num, row, errors):
+        """Record a rejected row."""
+
+        self.rejected.append((line_num, row, errors))
+
+    def flush(self, venue_type):
+        """Geocode and insert all pending rows of venue_type, queue their
+        maps, and commit."""
+
+        rows = self.pending[venue_type]
+
+        if not rows:
+            return
+
+        model = VENUE_TYPES[venue_type][0]
+
+        locations = [(row["address"], *self.cities[row["city_code"]])
+                     for row in rows]
+
+        for row, coords in zip(rows, get_geocoder().geocode_many(locations)):
+            row["latitude"], row["longitude"] = coords or (None, None)
+
+        ids = db.session.scalars(insert(model).returning(model.id), rows).all()
+
+        db.session.execute(insert(MapJob), [
+            {"venue_type": venue_type, "venue_id": id} for id in ids])
+
+        db.session.commit()
+
+        self.imported[venue_type] += len(rows)
+        self.pending[venue_type] = []
+
+    def finish(self):
+        """Insert any remaining rows."""
+
+        for venue_type in VENUE_TYPES:
+            self.flush(venue_type)
+
+        # commit cities that only appeared on rejected rows, too
+        db.session.commit()
+
+
+#######################################
+# CLI
+
+
+import_cli = AppGroup('import', help="Bulk import data.")
+
+
+@import_cli.command('venues')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(['csv', 'jsonl']),
+              help="File format (default: from the file extension).")
+@click.option('--type', 'default_type', type=click.Choice(list(VENUE_TYPES)),
+              help="Venue type for rows without a `type` column.")
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help="Rows per multi-row INSERT.")
+@click.option('--rejects', type=click.Path(dir_okay=False, writable=True),
+              help="Write rejected rows and their errors to this JSONL file.")
+def import_venues(path, format, default_type, batch_size, rejects):
+    """Import cafes and restaurants from a CSV or JSONL file."""
+
+    format = format or ("csv" if path.lower().endswith(".csv") else "jsonl")
+
+    importer = VenueImporter(batch_size=batch_size, default_type=default_type)
+
+    start = time.perf_counter()
+
+    with open(path, encoding="utf-8", newline="") as file:
+        for line_num, row in read_rows(file, format):
+            importer.add(line_num, row)
+
+    importer.finish()
+
+    elapsed = time.perf_counter() - start
+    total = sum(importer.imported.values())
+    rows_seen = total + len(importer.rejected)
+
+    click.echo(
+        f"Imported {total} venues ({importer.imported['cafe']} cafes, "
+        f"{importer.imported['restaurant']} restaurants) in {elapsed:.2f}s "
+        f"({rows_seen / elapsed if elapsed else 0:.0f} rows/sec).")
+    click.echo(f"Created {importer.created_cities} cities; "
+               f"queued {total} maps (run `flask maps generate`).")
+    click.echo(f"Rejected {len(importer.rejected)} rows.")
+
+    for line_num, row, errors in importer.rejected:
+        messages = "; ".join(f"{field}: {' '.join(field_errors)}"
+                             for field, field_errors in errors.items())
+        click.echo(f"  line {line_num}: {messages}", err=True)
+
+    if rejects:
+        with open(rejects, "w", encoding="utf-8") as file:
+            for line_num, row, errors in importer.rejected:
+                file.write(json.dumps(
+                    {"line": line_num, "row": row, "errors": errors}) + "\n")
+
+
+maps_cli = AppGroup('maps', help="Manage venue map images.")
+
+
+@maps_cli.command('generate')
+@click.option('--limit', type=int, help="Only run this many queued jobs.")
+def generate_maps(limit):
+    """Download maps queued by bulk imports."""
+
+    jobs = MapJob.query.order_by(MapJob.id).limit(limit).all()
+
+    for job in jobs:
+        job.run()
+
+        db.session.delete(job)
+        db.session.commit()
+
+    click.echo(f"Generated {len(jobs)} maps.")
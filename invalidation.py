@@ -0,0 +1,227 @@
+"""Cross-worker cache invalidation for Flask Cafe.
+
+When a cafe, restaurant or city is written, the transaction also sends
+`NOTIFY catalog_changed` with a payload like "cafe:12" (or "cafe:*" for
+bulk writes). Postgres delivers it only if the transaction commits. Every
+worker runs a thread LISTENing on that channel, and passes each change to
+the callbacks registered with `bus.subscribe`, which evict whatever they
+cached for it.
+
+Changes committed by a worker are also passed to its own callbacks as soon
+as it commits, without waiting for the round trip.
+
+If the listening connection drops, `bus.listening` goes false until it's
+back; caches should then fall back to polling (as the catalog snapshot
+does). On reconnecting, anything could have changed in the meantime, so
+callbacks get a change to every entity ("*", None).
+
+LISTEN doesn't work through PgBouncer in transaction pooling mode: point
+INVALIDATION_LISTEN_URL straight at Postgres when using it.
+
+Config:
+    INVALIDATION_LISTEN       run the listener (default True)
+    INVALIDATION_LISTEN_URL   database to listen on (default DATABASE_URL)
+"""
+
+import os
+import select
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+
+from database import RoutingSession
+from models import db, Cafe, Restaurant, City
+
+CHANNEL = "catalog_changed"
+
+# shows in pg_stat_activity, to tell listener connections apart
+APPLICATION_NAME = "flaskcafe-invalidation"
+
+ENTITIES = {Cafe: "cafe", Restaurant: "restaurant", City: "city"}
+
+# more changes to one entity than this in a flush are sent as one "*"
+MAX_NOTIFICATIONS = 100
+
+# how long the listener waits before checking its connection is alive,
+# and before trying to reconnect
+HEARTBEAT_SECONDS = 5
+RECONNECT_SECONDS = 5
+
+
+def format_payload(entity, id):
+    return f"{entity}:{'*' if id is None else id}"
+
+
+def parse_payload(payload):
+    entity, _, id = payload.partition(":")
+    return entity, None if id == "*" else id
+
+
+class InvalidationBus:
+    """Listens for catalog changes and passes them to subscribers."""
+
+    def __init__(self):
+        self.subscribers = []
+        self.listening = False
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('INVALIDATION_LISTEN', True)
+        app.config.setdefault('INVALIDATION_LISTEN_URL',
+                              app.config['SQLALCHEMY_DATABASE_URI'])
+
+        self.app = app
+
+    def subscribe(self, callback):
+        """Call `callback(entity, id)` for every change. `id` is the
+        primary key as a string, or None when any row of the entity may
+        have changed; entity is "*" when anything may have."""
+
+        self.subscribers.append(callback)
+
+    def dispatch(self, entity, id):
+        for callback in self.subscribers:
+            try:
+                callback(entity, id)
+            except Exception:
+                self.app.logger.exception("Invalidation callback failed")
+
+    def start(self):
+        """Start listening in a background thread, once per process."""
+
+        if not self.app.config['INVALIDATION_LISTEN']:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self.listening = False
+
+        engine = create_engine(
+            self.app.config['INVALIDATION_LISTEN_URL'], poolclass=NullPool,
+            connect_args={"application_name": APPLICATION_NAME})
+
+        threading.Thread(target=self._run, args=(engine,),
+                         name="invalidation-listener", daemon=True).start()
+
+    def _run(self, engine):
+        while True:
+            try:
+                self._listen(engine)
+            except Exception:
+                self.app.logger.exception(
+                    "Lost invalidation listener connection")
+            finally:
+                self.listening = False
+
+            time.sleep(RECONNECT_SECONDS)
+
+    def _listen(self, engine):
+        conn = engine.raw_connection()
+
+        try:
+            dbapi_conn = conn.driver_connection
+            dbapi_conn.autocommit = True
+
+            with dbapi_conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+
+            self.listening = True
+
+            # changes made while we weren't listening were missed
+            self.dispatch("*", None)
+
+            while True:
+                ready, _, _ = select.select([dbapi_conn], [], [],
+                                            HEARTBEAT_SECONDS)
+
+                if not ready:
+                    # raises if the connection has gone away
+                    with dbapi_conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+
+                dbapi_conn.poll()
+
+                while dbapi_conn.notifies:
+                    notify = dbapi_conn.notifies.pop(0)
+                    self.dispatch(*parse_payload(notify.payload))
+
+        finally:
+            conn.close()
+
+
+bus = InvalidationBus()
+
+
+#######################################
+# publishing changes
+
+
+def publish(session, changes):
+    """NOTIFY each (entity, id) in `changes` in the session's transaction,
+    on the primary, and remember them for after_commit."""
+
+    connection = session.connection(bind_arguments={"bind": db.engine})
+
+    for entity, id in changes:
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                           {"channel": CHANNEL,
+                            "payload": format_payload(entity, id)})
+
+    session.info.setdefault("catalog_changes", set()).update(changes)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def publish_flushed_changes(session, flush_context):
+    ids = {}
+
+    # a like puts the venue in session.dirty through its liking_users
+    # backref, but leaves its row alone
+    dirty = (obj for obj in session.dirty
+             if session.is_modified(obj, include_collections=False))
+
+    for obj in (*session.new, *dirty, *session.deleted):
+        entity = ENTITIES.get(type(obj))
+
+        if entity:
+            # new objects don't have an identity key until after the flush
+            [id] = db.inspect(obj).mapper.primary_key_from_instance(obj)
+            ids.setdefault(entity, set()).add(str(id))
+
+    changes = set()
+
+    for entity, entity_ids in ids.items():
+        if len(entity_ids) > MAX_NOTIFICATIONS:
+            changes.add((entity, None))
+        else:
+            changes.update((entity, id) for id in entity_ids)
+
+    if changes:
+        publish(session, changes)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def publish_bulk_changes(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        changes = {(ENTITIES[mapper.class_], None)
+                   for mapper in state.all_mappers
+                   if mapper.class_ in ENTITIES}
+
+        if changes:
+            publish(state.session, changes)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def dispatch_committed_changes(session):
+    for entity, id in session.info.pop("catalog_changes", ()):
+        bus.dispatch(entity, id)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_rolled_back_changes(session):
+    session.info.pop("catalog_changes", None)
@@ -0,0 +1,365 @@
+"""Multi-process load generator for Flask Cafe.
+
+Replays realistic user sessions against a running server: log in, browse
+/cafes, open details, check and toggle likes, edit the profile. Each of
+--processes worker processes runs sessions back to back until --duration
+runs out, picking actions according to --mix.
+
+Usage:
+    flask generate --reset --users 1000 --cafes 5000 --seed 0
+    python loadtest.py --start-server --workers 4 --processes 16 \\
+        --duration 60 --output run-4-workers.json
+    python loadtest.py --url http://localhost:5000 --compare run-4-workers.json
+
+Logs in as the generated users (user<seed>-<n>, password "password").
+Reports throughput, p50/p95/p99 latency per endpoint and the error rate, and
+writes results as JSON so runs can be compared.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+from random import Random
+
+import requests
+
+from datagen import DEFAULT_PASSWORD
+
+DEFAULT_MIX = "browse=40,detail=25,check_like=20,toggle_like=10,edit_profile=5"
+
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+CAFE_LINK_PATTERN = re.compile(r'href="/cafes/(\d+)"')
+
+
+def parse_mix(mix):
+    """Parse "action=weight,..." into a dict of action -> weight."""
+
+    weights = {}
+
+    for part in mix.split(","):
+        action, weight = part.split("=")
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action: {action}")
+        weights[action] = float(weight)
+
+    return weights
+
+
+def csrf_token(html):
+    """Pull the CSRF token out of a rendered form."""
+
+    match = CSRF_PATTERN.search(html)
+    return match.group(1) if match else ""
+
+
+class UserSession:
+    """One simulated user, recording (endpoint, seconds, ok) samples."""
+
+    def __init__(self, base_url, username, rng, samples):
+        self.base_url = base_url
+        self.username = username
+        self.rng = rng
+        self.samples = samples
+        self.http = requests.Session()
+        self.cafe_ids = []
+
+    def request(self, endpoint, method, path, expect=200, **kwargs):
+        """Make a request, recording its latency under `endpoint`.
+
+        Any status other than `expect` counts as an error; a redirect to
+        /login on a page, for instance, means the session was lost.
+        """
+
+        start = time.perf_counter()
+
+        try:
+            resp = self.http.request(method, self.base_url + path,
+                                     allow_redirects=False, timeout=30,
+                                     **kwargs)
+            ok = resp.status_code == expect
+        except requests.RequestException:
+            resp = None
+            ok = False
+
+        self.samples.setdefault(endpoint, []).append(
+            (time.perf_counter() - start, ok))
+
+        return resp
+
+    def login(self):
+        resp = self.request("GET /login", "GET", "/login")
+        token = csrf_token(resp.text) if resp is not None else ""
+
+        self.request("POST /login", "POST", "/login", expect=302, data={
+            "username": self.username,
+            "password": DEFAULT_PASSWORD,
+            "csrf_token": token,
+        })
+
+    def browse(self):
+        resp = self.request("GET /cafes", "GET", "/cafes")
+
+        if resp is not None and resp.status_code == 200:
+            self.cafe_ids = CAFE_LINK_PATTERN.findall(resp.text)
+
+    def pick_cafe(self):
+        if not self.cafe_ids:
+            self.browse()
+
+        return self.rng.choice(self.cafe_ids) if self.cafe_ids else None
+
+    def detail(self):
+        cafe_id = self.pick_cafe()
+        if cafe_id:
+            self.request("GET /cafes/<id>", "GET", f"/cafes/{cafe_id}")
+
+    def check_like(self):
+        cafe_id = self.pick_cafe()
+        if cafe_id:
+            self.request("GET /api/likes-cafe", "GET",
+                         f"/api/likes-cafe?q={cafe_id}")
+
+    def toggle_like(self):
+        cafe_id = self.pick_cafe()
+        if cafe_id:
+            self.request("POST /api/likes-cafe-toggle", "POST",
+                         "/api/likes-cafe-toggle",
+                         json={"cafe_id": int(cafe_id)})
+
+    def edit_profile(self):
+        resp = self.request("GET /profile/edit", "GET", "/profile/edit")
+        if resp is None or resp.status_code != 200:
+            return
+
+        form = {
+            "csrf_token": csrf_token(resp.text),
+            "first_name": "Load",
+            "last_name": f"Tester{self.rng.randint(1, 999)}",
+            "description": "Generated by loadtest.py",
+            "email": f"{self.username}@example.com",
+            "image_url": "",
+        }
+
+        self.request("POST /profile/edit", "POST", "/profile/edit",
+                     expect=302, data=form)
+
+
+ACTIONS = {
+    "browse": UserSession.browse,
+    "detail": UserSession.detail,
+    "check_like": UserSession.check_like,
+    "toggle_like": UserSession.toggle_like,
+    "edit_profile": UserSession.edit_profile,
+}
+
+
+def run_worker(options):
+    """Run sessions in one process until the deadline; returns samples."""
+
+    rng = Random(options["seed"] * 1000 + options["worker"])
+    actions = list(options["mix"])
+    weights = list(options["mix"].values())
+    samples = {}
+
+    while time.time() < options["deadline"]:
+        username = (f"user{options['user_seed']}-"
+                    f"{rng.randrange(options['user_count'])}")
+        session = UserSession(options["url"], username, rng, samples)
+        session.login()
+
+        for _ in range(options["actions_per_session"]):
+            if time.time() >= options["deadline"]:
+                break
+
+            action = rng.choices(actions, weights=weights)[0]
+            ACTIONS[action](session)
+
+            if options["think_time"]:
+                time.sleep(rng.expovariate(1 / options["think_time"]))
+
+    return samples
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at `fraction` (0-1) of an already sorted list."""
+
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(all_samples, elapsed):
+    """Combine per-process samples into per-endpoint statistics."""
+
+    merged = {}
+    for samples in all_samples:
+        for endpoint, values in samples.items():
+            merged.setdefault(endpoint, []).extend(values)
+
+    endpoints = {}
+    total = errors = 0
+
+    for endpoint, values in sorted(merged.items()):
+        latencies = sorted(seconds for seconds, ok in values)
+        endpoint_errors = sum(1 for seconds, ok in values if not ok)
+
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": endpoint_errors,
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+        total += len(values)
+        errors += endpoint_errors
+
+    return {
+        "elapsed_sec": elapsed,
+        "requests": total,
+        "throughput_rps": total / elapsed if elapsed else 0,
+        "error_rate": errors / total if total else 0,
+        "endpoints": endpoints,
+    }
+
+
+def print_summary(summary, previous=None):
+    """Print a results table, with changes vs. a previous run if given."""
+
+    def delta(key, endpoint=None):
+        if not previous:
+            return ""
+
+        before = (previous["endpoints"].get(endpoint, {}) if endpoint
+                  else previous)
+        if not before.get(key):
+            return ""
+
+        after = (summary["endpoints"][endpoint] if endpoint else summary)[key]
+        return f" ({(after - before[key]) / before[key]:+.0%})"
+
+    print(f"{'endpoint':<30} {'reqs':>7} {'errors':>6} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8}")
+
+    for endpoint, stats in summary["endpoints"].items():
+        print(f"{endpoint:<30} {stats['requests']:>7} {stats['errors']:>6} "
+              f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+              f"{stats['p99_ms']:>8.1f}{delta('p95_ms', endpoint)}")
+
+    print(f"\nthroughput: {summary['throughput_rps']:.1f} req/s"
+          f"{delta('throughput_rps')}")
+    print(f"error rate: {summary['error_rate']:.2%}")
+
+
+def start_server(port, workers):
+    """Start gunicorn on localhost and wait until it answers."""
+
+    server = subprocess.Popen(
+        ["gunicorn", "--workers", str(workers), "--bind",
+         f"127.0.0.1:{port}", "app:create_app()"],
+        env=os.environ.copy(),
+    )
+
+    url = f"http://127.0.0.1:{port}"
+
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--start-server", action="store_true",
+                        help="start gunicorn locally instead of using --url")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2,
+                        help="gunicorn workers for --start-server")
+    parser.add_argument("--processes", type=int, default=8,
+                        help="concurrent load-generating processes")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds to run")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help=f"action weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--actions-per-session", type=int, default=20)
+    parser.add_argument("--think-time", type=float, default=0,
+                        help="mean seconds between actions")
+    parser.add_argument("--user-count", type=int, default=100,
+                        help="how many generated users to log in as")
+    parser.add_argument("--user-seed", type=int, default=0,
+                        help="--seed the users were generated with")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="results JSON of an earlier run")
+    args = parser.parse_args(argv)
+
+    mix = args.mix
+
+    server = None
+    url = args.url
+
+    if args.start_server:
+        server, url = start_server(args.port, args.workers)
+
+    try:
+        start = time.time()
+        deadline = start + args.duration
+
+        worker_options = [{
+            "worker": worker,
+            "url": url,
+            "mix": mix,
+            "deadline": deadline,
+            "actions_per_session": args.actions_per_session,
+            "think_time": args.think_time,
+            "user_count": args.user_count,
+            "user_seed": args.user_seed,
+            "seed": args.seed,
+        } for worker in range(args.processes)]
+
+        with Pool(args.processes) as pool:
+            all_samples = pool.map(run_worker, worker_options)
+
+        elapsed = time.time() - start
+
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(all_samples, elapsed)
+    summary["config"] = {
+        "processes": args.processes,
+        "workers": args.workers if args.start_server else None,
+        "mix": mix,
+        "duration": args.duration,
+        "think_time": args.think_time,
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+    print_summary(summary, previous)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,14 @@
 import os
-import requests
+import hashlib
+from math import radians, degrees, sin, cos, asin, sqrt
 from dotenv import load_dotenv
 
 load_dotenv()
 
 MAPQUEST_API_KEY = os.environ.get('MAPQUEST_API_KEY')
 
+EARTH_RADIUS_KM = 6371.0
+
 
 def get_map_url(address, city, state):
     """Get MapQuest URL for a static map for this location."""
@@ -21,6 +24,10 @@ def save_map(id, type, address, city, state):
     path = os.path.join(os.path.abspath(
         os.path.dirname(__file__)), f'static/maps/{type}{id}.jpg')
 
+    # requests is only needed when talking to MapQuest, so it's imported
+    # here rather than by every worker at startup
+    import requests
+
     url = get_map_url(address, city, state)
 
     response = requests.get(url)
@@ -41,4 +48,166 @@ def delete_map_secure(id, type):
             os.remove(path)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
+
+
+#######################################
+# geocoding
+
+
+class MapQuestGeocoder:
+    """Looks up coordinates with the MapQuest geocoding API."""
+
+    url = "https://www.mapquestapi.com/geocoding/v1/address"
+    batch_url = "https://www.mapquestapi.com/geocoding/v1/batch"
+    batch_size = 100
+
+    # seconds; venues are geocoded while their form is being submitted
+    timeout = 5
+    batch_timeout = 30
+
+    def geocode(self, address, city, state):
+        """Return (lat, lng) for this location, or None if not found (or
+        MapQuest can't be reached)."""
+
+        import requests
+
+        try:
+            response = requests.get(self.url, params={
+                "key": MAPQUEST_API_KEY,
+                "location": f"{address},{city},{state}",
+            }, timeout=self.timeout)
+        except requests.RequestException:
+            return None
+
+        if response.status_code != 200:
+            return None
+
+        try:
+            lat_lng = response.json()["results"][0]["locations"][0]["latLng"]
+        except (KeyError, IndexError, ValueError):
+            return None
+
+        return (lat_lng["lat"], lat_lng["lng"])
+
+    def geocode_many(self, locations):
+        """Return a list of (lat, lng) or None for each (address, city, state)
+        location, looking up to 100 of them per request. A request that
+        fails gives None for its whole batch."""
+
+        import requests
+
+        coords = []
+
+        for start in range(0, len(locations), self.batch_size):
+            batch = locations[start:start + self.batch_size]
+
+            try:
+                response = requests.get(self.batch_url, params=[
+                    ("key", MAPQUEST_API_KEY),
+                    *[("location", f"{address},{city},{state}")
+                      for address, city, state in batch],
+                ], timeout=self.batch_timeout)
+            except requests.RequestException:
+                coords.extend([None] * len(batch))
+                continue
+
+            try:
+                results = response.json()["results"]
+            except (KeyError, ValueError):
+                results = []
+
+            for i in range(len(batch)):
+                try:
+                    lat_lng = results[i]["locations"][0]["latLng"]
+                    coords.append((lat_lng["lat"], lat_lng["lng"]))
+                except (KeyError, IndexError):
+                    coords.append(None)
+
+        return coords
+
+
+class LocalGeocoder:
+    """Offline stand-in for a real geocoder.
+
+    Places each address at a stable point near its city's center (or
+    somewhere in the continental U.S. for unknown cities), so the same
+    address always gets the same coordinates without any network calls.
+    """
+
+    CITY_CENTERS = {
+        ("San Francisco", "CA"): (37.7749, -122.4194),
+        ("Berkeley", "CA"): (37.8715, -122.2730),
+        ("Oakland", "CA"): (37.8044, -122.2712),
+        ("Los Angeles", "CA"): (34.0522, -118.2437),
+        ("Chino Hills", "CA"): (33.9898, -117.7326),
+    }
+
+    # max distance (in degrees) an address is placed from its city center
+    SPREAD = 0.03
+
+    def geocode(self, address, city, state):
+        """Return (lat, lng) for this location."""
+
+        digest = hashlib.sha1(
+            f"{address},{city},{state}".lower().encode('utf-8')).digest()
+
+        center = self.CITY_CENTERS.get((city, state))
+
+        if center is None:
+            city_digest = hashlib.sha1(
+                f"{city},{state}".lower().encode('utf-8')).digest()
+            center = (25 + 24 * city_digest[0] / 255,
+                      -124 + 57 * city_digest[1] / 255)
+
+        lat = center[0] + self.SPREAD * (digest[0] / 127.5 - 1)
+        lng = center[1] + self.SPREAD * (digest[1] / 127.5 - 1)
+
+        return (round(lat, 6), round(lng, 6))
+
+    def geocode_many(self, locations):
+        """Return a list of (lat, lng) for each (address, city, state)."""
+
+        return [self.geocode(*location) for location in locations]
+
+
+GEOCODERS = {
+    "mapquest": MapQuestGeocoder,
+    "local": LocalGeocoder,
+}
+
+
+def get_geocoder():
+    """Return the geocoder named by the GEOCODER env variable.
+
+    Defaults to MapQuest; set GEOCODER=local to work offline.
+    """
+
+    return GEOCODERS[os.environ.get('GEOCODER', 'mapquest')]()
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points, in kilometers."""
+
+    lat1, lng1, lat2, lng2 = map(radians, (lat1, lng1, lat2, lng2))
+
+    a = (sin((lat2 - lat1) / 2) ** 2
+         + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+
+def bounding_box(lat, lng, radius_km):
+    """Return (min_lat, max_lat, min_lng, max_lng) enclosing a circle.
+
+    Used to narrow a search to an indexed lat/lng range before computing
+    exact distances.
+    """
+
+    lat_delta = degrees(radius_km / EARTH_RADIUS_KM)
+
+    # longitude degrees shrink towards the poles; clamp to avoid dividing by 0
+    lng_delta = degrees(radius_km / (EARTH_RADIUS_KM
+                                     * max(cos(radians(lat)), 0.01)))
+
+    return (lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta)
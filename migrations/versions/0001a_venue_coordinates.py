@@ -0,0 +1,52 @@
+"""venue coordinates and map jobs
+
+Latitude/longitude on cafes and restaurants, indexed for nearby search, and
+the map_jobs queue that bulk imports fill for `flask maps generate`.
+
+IF NOT EXISTS lets this run against databases that were created by
+db.create_all() after these were added and stamped at 0001.
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-19 07:17:02.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001a'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+VENUE_TABLES = ['cafes', 'restaurants']
+
+
+def upgrade():
+    op.create_table('map_jobs',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('venue_type', sa.String(length=20), nullable=False),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    if_not_exists=True
+    )
+
+    for table in VENUE_TABLES:
+        op.add_column(table, sa.Column('latitude', sa.Float(), nullable=True),
+                      if_not_exists=True)
+        op.add_column(table, sa.Column('longitude', sa.Float(), nullable=True),
+                      if_not_exists=True)
+        op.create_index(f'ix_{table}_latitude_longitude', table,
+                        ['latitude', 'longitude'], if_not_exists=True)
+
+
+def downgrade():
+    for table in reversed(VENUE_TABLES):
+        op.drop_index(f'ix_{table}_latitude_longitude', table_name=table)
+        op.drop_column(table, 'longitude')
+        op.drop_column(table, 'latitude')
+
+    op.drop_table('map_jobs')
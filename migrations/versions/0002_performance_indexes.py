@@ -0,0 +1,53 @@
+"""performance indexes
+
+Indexes for city filters and name ordering on venue lists, and likes looked
+up by venue (including the cascades when a venue is deleted).
+
+They're built with CREATE INDEX CONCURRENTLY, so production can be upgraded
+while serving traffic without locking writes to the like tables. That can't
+run inside a transaction, so each index is built in an autocommit block. If
+a concurrent build fails it leaves an INVALID index behind: drop it by hand
+and run the upgrade again.
+
+IF NOT EXISTS lets this run against databases that were created by
+db.create_all() and stamped at 0001, which may have some of these already.
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-19 07:20:41.512305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001a'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_cafes_city_code_name', 'cafes', ['city_code', 'name']),
+    ('ix_cafes_name', 'cafes', ['name']),
+    ('ix_restaurants_city_code_name', 'restaurants', ['city_code', 'name']),
+    ('ix_restaurants_name', 'restaurants', ['name']),
+    ('ix_cafe_likes_cafe_id', 'cafe_likes', ['cafe_id']),
+    ('ix_restaurant_likes_restaurant_id', 'restaurant_likes',
+     ['restaurant_id']),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True,
+                          postgresql_concurrently=True)
@@ -0,0 +1,57 @@
+"""catalog version
+
+A single-row counter, bumped by statement-level triggers whenever cafes,
+restaurants or cities are written. Workers poll it to know when to reload
+their in-process catalog snapshot.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:02:13.840127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['cafes', 'restaurants', 'cities']
+
+
+def upgrade():
+    op.create_table(
+        'catalog_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.execute("INSERT INTO catalog_version (id, version) VALUES (1, 0)")
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE catalog_version SET version = version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+    for table in TABLES:
+        op.execute(f"""
+            CREATE TRIGGER {table}_catalog_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()
+        """)
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute(f"DROP TRIGGER {table}_catalog_version ON {table}")
+
+    op.execute("DROP FUNCTION bump_catalog_version()")
+    op.drop_table('catalog_version')
@@ -1,13 +1,15 @@
 """Data models for Flask Cafe"""
 
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from mapping import save_map, delete_map_secure
+from database import RoutingSession
+from hashing import PasswordHasher
+from mapping import save_map, delete_map_secure, get_geocoder
+from mapping import distance_km, bounding_box
 
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+hasher = PasswordHasher()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 DEFAULT_CAFE_PIC = "/static/images/default-cafe.png"
 DEFAULT_PROF_PIC = "/static/images/default-prof-pic.png"
@@ -80,8 +82,24 @@ class Cafe(db.Model):
         default=DEFAULT_CAFE_PIC,
     )
 
+    latitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
     city = db.relationship("City", backref='cafes')
 
+    __table_args__ = (
+        db.Index('ix_cafes_latitude_longitude', 'latitude', 'longitude'),
+        db.Index('ix_cafes_city_code_name', 'city_code', 'name'),
+        db.Index('ix_cafes_name', 'name'),
+    )
+
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
@@ -102,6 +120,13 @@ class Cafe(db.Model):
 
         delete_map_secure(self.id, "cafe")
 
+    def geocode(self):
+        """Looks up and stores coordinates of cafe's address"""
+
+        city = self.city
+        coords = get_geocoder().geocode(self.address, city.name, city.state)
+        self.latitude, self.longitude = coords or (None, None)
+
 class Restaurant(db.Model):
     """Restaurant information."""
 
@@ -147,8 +172,24 @@ class Restaurant(db.Model):
         default=DEFAULT_RESTAURANT_PIC,
     )
 
+    latitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
     city = db.relationship("City", backref='restaurants')
 
+    __table_args__ = (
+        db.Index('ix_restaurants_latitude_longitude', 'latitude', 'longitude'),
+        db.Index('ix_restaurants_city_code_name', 'city_code', 'name'),
+        db.Index('ix_restaurants_name', 'name'),
+    )
+
     def __repr__(self):
         return f'<Restaurant id={self.id} name="{self.name}">'
 
@@ -169,6 +210,13 @@ class Restaurant(db.Model):
 
         delete_map_secure(self.id, "restaurant")
 
+    def geocode(self):
+        """Looks up and stores coordinates of restaurant's address"""
+
+        city = self.city
+        coords = get_geocoder().geocode(self.address, city.name, city.state)
+        self.latitude, self.longitude = coords or (None, None)
+
 class User(db.Model):
     """User in the system."""
 
@@ -246,7 +294,7 @@ class User(db.Model):
         Hashes password and returns the user instance.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -270,13 +318,19 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with a different cost factor than the
+        one configured, the password is rehashed; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check_password_hash(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.generate_password_hash(password)
+
                 return user
 
         return False
@@ -309,6 +363,12 @@ class CafeLike(db.Model):
         primary_key=True
     )
 
+    # the primary key covers lookups by user; this covers them by cafe
+    __table_args__ = (
+        db.Index('ix_cafe_likes_cafe_id', 'cafe_id'),
+    )
+
+
 class RestaurantLike(db.Model):
     """Through table that links users to restaurants"""
 
@@ -326,6 +386,260 @@ class RestaurantLike(db.Model):
         primary_key=True
     )
 
+    __table_args__ = (
+        db.Index('ix_restaurant_likes_restaurant_id', 'restaurant_id'),
+    )
+
+
+class MapJob(db.Model):
+    """Queued static map download for a cafe or restaurant.
+
+    Bulk imports enqueue these instead of calling MapQuest inline; run them
+    with `flask maps generate`.
+    """
+
+    __tablename__ = 'map_jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    venue_type = db.Column(
+        db.String(20),
+        nullable=False,
+    )
+
+    venue_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<MapJob #{self.id}: {self.venue_type}{self.venue_id}>"
+
+    def run(self):
+        """Saves the map for this job's venue, if the venue still exists"""
+
+        model = Cafe if self.venue_type == "cafe" else Restaurant
+        venue = db.session.get(model, self.venue_id)
+
+        if venue:
+            city = venue.city
+            save_map(venue.id, self.venue_type, venue.address,
+                     city.name, city.state)
+
+
+class CatalogVersion(db.Model):
+    """A counter that goes up whenever cafes, restaurants or cities change.
+
+    Its one row is bumped by triggers on those tables (see CATALOG_TRIGGERS),
+    so it also catches bulk imports and edits made outside the app. Workers
+    poll it to know when their catalog snapshot is out of date.
+    """
+
+    __tablename__ = 'catalog_version'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    version = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+
+CATALOG_TABLES = ['cafes', 'restaurants', 'cities']
+
+# kept in step with migration 0003, which sets these up on existing
+# databases; this is for ones made by db.create_all()
+CATALOG_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE catalog_version SET version = version + 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    *(f"""
+    CREATE TRIGGER {table}_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()
+    """ for table in CATALOG_TABLES),
+    "INSERT INTO catalog_version (id, version) VALUES (1, 0)",
+]
+
+
+@db.event.listens_for(db.metadata, "after_create")
+def create_catalog_triggers(target, connection, tables=(), **kw):
+    """After db.create_all(), set up the catalog version triggers."""
+
+    if CatalogVersion.__table__ in tables:
+        for statement in CATALOG_TRIGGERS:
+            connection.execute(db.text(statement))
+
+
+def venue_conditions(model, city_code=None, state=None, liked_by=None):
+    """Return WHERE clauses limiting venues of `model` to a city, a state,
+    or a user's likes. The state clause needs `City` joined in."""
+
+    conditions = []
+
+    if city_code:
+        conditions.append(model.city_code == city_code)
+
+    if state:
+        conditions.append(City.state == state)
+
+    if liked_by:
+        conditions.append(model.liking_users.any(User.id == liked_by.id))
+
+    return conditions
+
+
+def filter_venues(model, city_code=None, state=None, liked_by=None):
+    """Return a query for venues of `model` (Cafe or Restaurant), ordered by
+    name and optionally limited to a city, a state, or a user's likes."""
+
+    query = model.query
+
+    if state:
+        query = query.join(model.city)
+
+    return (query
+            .filter(*venue_conditions(model, city_code, state, liked_by))
+            .order_by(model.name))
+
+
+# characters of description shown on a list card
+CARD_DESCRIPTION_LENGTH = 150
+
+
+class VenueCard:
+    """What a list card shows of a cafe or restaurant.
+
+    Far lighter than the model itself: only these columns are read, the
+    description is cut short by the database, and there's no ORM state or
+    identity map entry to keep per row.
+    """
+
+    __slots__ = ("id", "name", "image_url", "description", "city_name",
+                 "city_state")
+
+    def __init__(self, id, name, image_url, description, city_name,
+                 city_state):
+        self.id = id
+        self.name = name
+        self.image_url = image_url
+        self.description = description
+        self.city_name = city_name
+        self.city_state = city_state
+
+    def __repr__(self):
+        return f'<VenueCard id={self.id} name="{self.name}">'
+
+    def get_city_state(self):
+        """Return 'city, state' for venue."""
+
+        return f'{self.city_name}, {self.city_state}'
+
+
+def description_preview(column, length=CARD_DESCRIPTION_LENGTH):
+    """SQL for the first `length` characters of `column`, ending in an
+    ellipsis if it was cut short."""
+
+    return db.case(
+        (db.func.length(column) > length,
+         db.func.left(column, length - 3) + "..."),
+        else_=column,
+    )
+
+
+def preview_text(text, length=CARD_DESCRIPTION_LENGTH):
+    """The same preview as description_preview, made in Python."""
+
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
+def card_query(model, city_code=None, state=None, liked_by=None):
+    """Return a SELECT of the VenueCard columns for venues of `model`,
+    filtered like filter_venues and ordered by name."""
+
+    return (db.select(model.id, model.name, model.image_url,
+                      description_preview(model.description),
+                      City.name, City.state)
+            .join(model.city)
+            .where(*venue_conditions(model, city_code, state, liked_by))
+            .order_by(model.name))
+
+
+def venue_cards(model, city_code=None, state=None, liked_by=None,
+                yield_per=None):
+    """Yield a VenueCard for each venue of `model`, filtered like
+    filter_venues. With `yield_per`, rows come from a server-side cursor
+    that many at a time.
+
+    Nothing is queried until the first card is asked for."""
+
+    query = card_query(model, city_code, state, liked_by)
+
+    if yield_per:
+        query = query.execution_options(yield_per=yield_per)
+
+    for row in db.session.execute(query):
+        yield VenueCard(*row)
+
+
+def city_facets(model, liked_by=None):
+    """Count venues of `model` per city in a single grouped query.
+
+    Returns rows of (code, name, state, count) ordered by city name; cities
+    without any matching venues are left out.
+    """
+
+    query = (db.session
+             .query(City.code, City.name, City.state,
+                    db.func.count(model.id).label('count'))
+             .join(model, model.city_code == City.code))
+
+    if liked_by:
+        query = query.filter(model.liking_users.any(User.id == liked_by.id))
+
+    return query.group_by(City.code).order_by(City.name).all()
+
+
+def find_nearby(model, lat, lng, radius_km, limit=50):
+    """Find venues of `model` (Cafe or Restaurant) within radius_km of a point.
+
+    Narrows the search with the (latitude, longitude) index using a bounding
+    box, then computes exact distances for just those rows. Returns a list of
+    (venue, distance_km) tuples ordered by distance.
+    """
+
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_km)
+
+    candidates = (model.query
+                  .options(db.joinedload(model.city))
+                  .filter(model.latitude.between(min_lat, max_lat),
+                          model.longitude.between(min_lng, max_lng))
+                  .all())
+
+    nearby = []
+
+    for venue in candidates:
+        distance = distance_km(lat, lng, venue.latitude, venue.longitude)
+        if distance <= radius_km:
+            nearby.append((venue, distance))
+
+    nearby.sort(key=lambda pair: pair[1])
+
+    return nearby[:limit]
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -333,6 +647,5 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
+    hasher.init_app(app)
@@ -0,0 +1,180 @@
+"""Preload hints for Flask Cafe pages.
+
+Browsers only find a page's stylesheet, scripts and images once they've
+parsed the HTML that links to them. Pages here send a `Link: rel=preload`
+header for those files, so the browser can start fetching them as soon as
+the headers arrive. When the server supports it (it puts a
+`wsgi.early_hints` callable in the WSGI environ), the same links are also
+sent in a 103 Early Hints response, before the view has even run.
+
+Every HTML page preloads the stylesheet and the vendor scripts. Views add
+their own hints with the @preload decorator, e.g. a venue's map image:
+
+    @bp.get('/cafes/<int:cafe_id>')
+    @preload(lambda cafe_id: [script("cafeLikes.js"),
+                              map_image("cafe", cafe_id)])
+    def cafe_detail(cafe_id):
+
+In instrumentation mode, half of the pages are sent without hints, and
+each page reports its first contentful paint back to /api/metrics/paint;
+/api/metrics then shows paint times with and without preloading.
+
+Config:
+    PRELOAD_ENABLED       send preload hints (default True)
+    PRELOAD_INSTRUMENT    measure paint times with and without them
+                          (default False)
+"""
+
+import os
+import random
+from collections import deque
+from statistics import quantiles
+
+from flask import current_app, request, g, url_for
+
+from assets import asset_urls
+
+VARIANTS = ("preload", "none")
+
+
+def init_preload(app):
+    """Send preload hints for the app's pages."""
+
+    app.config.setdefault('PRELOAD_ENABLED', True)
+    app.config.setdefault('PRELOAD_INSTRUMENT', False)
+
+    if not app.config['PRELOAD_ENABLED']:
+        return
+
+    app.before_request(send_early_hints)
+    app.after_request(add_link_header)
+
+
+def preload(hints):
+    """View decorator: `hints(**view_args)` returns the extra (url, as)
+    pairs to preload for the view's page."""
+
+    def decorator(view):
+        view.preload_hints = hints
+        return view
+
+    return decorator
+
+
+def stylesheet(name):
+    return [(url, "style") for url in asset_urls(name)]
+
+
+def script(name):
+    return [(url, "script") for url in asset_urls(name)]
+
+
+def map_image(type, id):
+    """The venue's map, if it has one."""
+
+    filename = f"maps/{type}{id}.jpg"
+
+    if not os.path.isfile(os.path.join(current_app.static_folder, filename)):
+        return []
+
+    return [(url_for("static", filename=filename), "image")]
+
+
+def page_hints():
+    """Return the (url, as) pairs to preload for this request."""
+
+    hints = stylesheet("app.css") + script("vendor.js")
+
+    view = current_app.view_functions.get(request.endpoint)
+    view_hints = getattr(view, "preload_hints", None)
+
+    if view_hints:
+        for hint in view_hints(**request.view_args):
+            hints += hint
+
+    return hints
+
+
+def link_header(hints):
+    return ", ".join(f"<{url}>; rel=preload; as={as_}" for url, as_ in hints)
+
+
+def send_early_hints():
+    """before_request hook: work out the page's hints, and send them in a
+    103 response if the server can."""
+
+    g.preload_links = None
+
+    # only browsers navigating to a page, not scripts calling the API
+    if (request.method != "GET"
+            or request.endpoint in (None, "static")
+            or request.accept_mimetypes.best != "text/html"):
+        return
+
+    if current_app.config['PRELOAD_INSTRUMENT']:
+        g.preload_variant = random.choice(VARIANTS)
+
+        if g.preload_variant == "none":
+            return
+
+    g.preload_links = link_header(page_hints())
+
+    early_hints = request.environ.get("wsgi.early_hints")
+    if early_hints:
+        early_hints([("Link", g.preload_links)])
+
+
+def add_link_header(response):
+    """after_request hook: repeat the hints on the page itself, for servers
+    and proxies without Early Hints (some CDNs turn these into 103s for
+    later requests)."""
+
+    links = g.get("preload_links")
+
+    if (links and response.status_code == 200
+            and response.mimetype == "text/html"):
+        response.headers.add("Link", links)
+
+    return response
+
+
+class PaintTimings:
+    """Recent first-contentful-paint times reported by browsers, by
+    variant. Kept per worker process, like the other metrics."""
+
+    def __init__(self, size=1000):
+        self.samples = {variant: deque(maxlen=size) for variant in VARIANTS}
+
+    def clear(self):
+        for samples in self.samples.values():
+            samples.clear()
+
+    def record(self, variant, ms):
+        self.samples[variant].append(ms)
+
+    def summary(self):
+        """{variant: {"count", "p50_ms", "p90_ms"}} for variants with
+        samples."""
+
+        summary = {}
+
+        for variant, samples in self.samples.items():
+            if not samples:
+                continue
+
+            if len(samples) > 1:
+                deciles = quantiles(samples, n=10)
+                p50, p90 = deciles[4], deciles[8]
+            else:
+                p50 = p90 = samples[0]
+
+            summary[variant] = {
+                "count": len(samples),
+                "p50_ms": round(p50, 1),
+                "p90_ms": round(p90, 1),
+            }
+
+        return summary
+
+
+paint_timings = PaintTimings()
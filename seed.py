@@ -1,11 +1,22 @@
 """Initial data."""
 
+from flask_migrate import Migrate, upgrade
+from sqlalchemy import text
+
 from models import City, Cafe, Restaurant, db, User
 
-from app import app
+from app import create_app
+
+app = create_app()
+app.app_context().push()
+
+Migrate(app, db)
 
 db.drop_all()
-db.create_all()
+db.session.execute(text("DROP TABLE IF EXISTS alembic_version"))
+db.session.commit()
+
+upgrade()
 
 
 #######################################
@@ -132,6 +143,15 @@ ua.liked_restaurants.append(r1)
 db.session.commit()
 
 
+#######################################
+# coordinates
+
+for venue in [c1, c2, c3, r1, r2, r3]:
+    venue.geocode()
+
+db.session.commit()
+
+
 #######################################
 # maps
 
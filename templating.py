@@ -0,0 +1,144 @@
+"""Template bytecode caching for Flask Cafe.
+
+Jinja parses and compiles each template to Python bytecode the first time
+a process renders it. With a bytecode cache, the compiled code is written
+to TEMPLATE_CACHE_DIR (default: instance/jinja_cache), and every worker
+after that loads it from there instead of parsing the template again.
+
+`flask templates compile` fills the cache at build time, so even the first
+worker after a deploy starts with compiled templates. Cache entries are
+checked against the template source and the Python version, so an edited
+template is recompiled rather than served stale.
+
+Long pages can be streamed with `stream_page`, which sends the HTML in
+chunks as it's rendered rather than building it all in memory first. Pass
+rows from a server-side cursor (`yield_per`) and cards are rendered as the
+rows arrive. base.html marks the end of the head and navbar with `{{ flush
+}}`, so those are sent straight away.
+
+Config:
+    TEMPLATE_CACHE        turn the bytecode cache on/off (default True)
+    TEMPLATE_CACHE_DIR    where compiled templates are kept
+    STREAM_TEMPLATES      stream pages rendered with stream_page (default
+                          True); if off, they're rendered all at once
+    STREAM_CHUNK_SIZE     bytes of HTML buffered per chunk (default 8 KB)
+"""
+
+import os
+import time
+
+import click
+from flask import current_app, render_template, stream_template, Response
+from flask import get_flashed_messages
+from flask.cli import AppGroup
+from flask_wtf.csrf import generate_csrf
+from jinja2 import FileSystemBytecodeCache
+
+# rendered by {{ flush }} in a streamed page, and never sent
+FLUSH = "\x00flush\x00"
+
+
+def init_template_cache(app):
+    """Give the app's Jinja environment a shared bytecode cache."""
+
+    if not app.config.setdefault('TEMPLATE_CACHE', True):
+        return
+
+    directory = app.config.setdefault(
+        'TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, "jinja_cache"))
+    os.makedirs(directory, exist_ok=True)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def init_streaming(app):
+    app.config.setdefault('STREAM_TEMPLATES', True)
+    app.config.setdefault('STREAM_CHUNK_SIZE', 8 * 1024)
+
+
+def stream_page(template_name, **context):
+    """Render a template as a streamed response, or all at once when
+    STREAM_TEMPLATES is off."""
+
+    if not current_app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+
+    # The session cookie is sent before the page is rendered, so anything
+    # the page would change in the session has to happen now: popping
+    # flashed messages, and storing a new CSRF token.
+    get_flashed_messages()
+    generate_csrf()
+
+    chunks = stream_template(template_name, flush=FLUSH, **context)
+
+    return Response(
+        buffer_chunks(chunks, current_app.config['STREAM_CHUNK_SIZE']),
+        mimetype="text/html")
+
+
+def buffer_chunks(chunks, size):
+    """Join rendered template output into chunks of about `size` bytes,
+    sending what there is early wherever the template asks to flush."""
+
+    buffer = []
+    buffered = 0
+
+    for chunk in chunks:
+        if chunk == FLUSH:
+            if buffer:
+                yield "".join(buffer)
+                buffer = []
+                buffered = 0
+            continue
+
+        buffer.append(chunk)
+        buffered += len(chunk)
+
+        if buffered >= size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield "".join(buffer)
+
+
+def compile_templates(app):
+    """Load every template into the Jinja cache, compiling it (and storing
+    the bytecode) if needed; returns how many."""
+
+    names = [name for name in app.jinja_env.list_templates()
+             if name.endswith(".html")]
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+#######################################
+# CLI
+
+
+templates_cli = AppGroup('templates', help="Manage compiled templates.")
+
+
+@templates_cli.command('compile')
+@click.option('--clear', is_flag=True,
+              help="Delete previously compiled templates first.")
+def compile_command(clear):
+    """Precompile every template into the bytecode cache."""
+
+    cache = current_app.jinja_env.bytecode_cache
+
+    if cache is None:
+        raise click.UsageError("TEMPLATE_CACHE is turned off.")
+
+    if clear:
+        cache.clear()
+
+    start = time.perf_counter()
+    count = compile_templates(current_app)
+
+    click.echo(f"Compiled {count} templates into {cache.directory} "
+               f"in {time.perf_counter() - start:.2f}s")
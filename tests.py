@@ -2,25 +2,60 @@
 
 
 import os
+import gzip
+import json
+import shutil
+import zlib
+import tempfile
+import time
+from decimal import Decimal
 
 os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
+REPLICA_DATABASE_URL = "postgresql:///flaskcafe_test_replica"
 os.environ["FLASK_DEBUG"] = "0"
+os.environ["GEOCODER"] = "local"
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
+os.environ["THROTTLE_DB_PATH"] = os.path.join(
+    tempfile.mkdtemp(), "throttle.sqlite3")
 
 import re
+import socketserver
+import threading
 from unittest import TestCase
 
-from models import db, Cafe, City, User, CafeLike
+from models import db, Cafe, City, User, CafeLike, Restaurant, MapJob, hasher
+from models import find_nearby, RestaurantLike, venue_cards
+from models import CARD_DESCRIPTION_LENGTH
+from datagen import DataGenerator, DEFAULT_PASSWORD
+from hashing import get_log_rounds
+from database import engine_options_from_env, REPLICA_BIND, STICKY_KEY
+from mapping import LocalGeocoder, MapQuestGeocoder, distance_km
+from warmup import warm_up
+from compression import compress_response, compress_chunks, precompress
+from compression import GzipEncoder
+from preload import paint_timings
+from templating import buffer_chunks, FLUSH
+from catalog import catalog, list_cards, get_venue_or_404
+from invalidation import bus, parse_payload
+from cache import cache, get_or_404, MemoryBackend, SQLiteBackend
+from cache import RedisBackend, NullBackend, ENTRY_OVERHEAD
+from api import VENUE_FIELDS
+import invalidation
+from assets import build_assets, load_manifest, fingerprint, DIST_DIR
 from flask_bcrypt import Bcrypt
+from flask import jsonify
+from werkzeug.exceptions import NotFound
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import create_engine, event
+import brotli
+import msgpack
 
-from app import app , CURR_USER_KEY, NOT_LOGGED_IN_MSG
+from app import create_app, CURR_USER_KEY, NOT_LOGGED_IN_MSG, throttle
 
 bcrypt = Bcrypt()
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+app = create_app("testing")
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -47,6 +82,66 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Answers the few Redis commands RedisBackend sends."""
+
+    def handle(self):
+        while line := self.rfile.readline():
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+
+            self.wfile.write(self.server.run(args[0].upper(), *args[1:]))
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """Stand-in Redis server on a free local port, keeping data in a dict."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.data = {}
+        self.url = f"redis://127.0.0.1:{self.server_address[1]}/1"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def get(self, key):
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            return None
+        return value
+
+    def run(self, command, *args):
+        if command == b"MGET":
+            values = [self.get(key) for key in args]
+            return b"*%d\r\n" % len(values) + b"".join(
+                b"$-1\r\n" if value is None
+                else b"$%d\r\n%s\r\n" % (len(value), value)
+                for value in values)
+
+        if command == b"SET":
+            expires_at = None
+            if len(args) == 4:
+                expires_at = time.monotonic() + int(args[3]) / 1000
+            self.data[args[0]] = (args[1], expires_at)
+            return b"+OK\r\n"
+
+        if command == b"DEL":
+            return b":%d\r\n" % sum(self.data.pop(key, None) is not None
+                                     for key in args)
+
+        if command == b"DBSIZE":
+            return b":%d\r\n" % len(self.data)
+
+        if command in (b"FLUSHDB", b"SELECT"):
+            if command == b"FLUSHDB":
+                self.data.clear()
+            return b"+OK\r\n"
+
+        return b"-ERR unknown command\r\n"
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -113,6 +208,94 @@ ADMIN_USER_DATA = dict(
 )
 
 
+#######################################
+# app factory
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for creating the app with each config profile."""
+
+    def tearDown(self):
+        """Creating an app reconfigures shared extensions; restore them."""
+
+        hasher.init_app(app)
+        throttle.init_app(app)
+        bus.init_app(app)
+        cache.init_app(app)
+        catalog.init_app(app)
+
+    def test_production(self):
+        prod_app = create_app("production")
+
+        self.assertFalse(prod_app.testing)
+        self.assertFalse(prod_app.debug)
+        self.assertNotIn("_debug_toolbar.static", prod_app.view_functions)
+
+    def test_development(self):
+        dev_app = create_app("development")
+
+        self.assertTrue(dev_app.debug)
+        self.assertIn("_debug_toolbar.static", dev_app.view_functions)
+        self.assertTrue(dev_app.config['SQLALCHEMY_ECHO'])
+
+    def test_lazy_cli_commands(self):
+        self.assertIn("db", app.cli.list_commands(None))
+
+        result = app.test_cli_runner().invoke(args=["db", "--help"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("upgrade", result.output)
+
+
+class WarmUpTestCase(TestCase):
+    """Tests for the worker warm-up routine."""
+
+    def test_warm_up(self):
+        result = warm_up(app)
+
+        self.assertGreater(result["templates"], 0)
+        self.assertEqual(result["connections"],
+                         {"primary": db.engine.pool.size()})
+        self.assertGreaterEqual(db.engine.pool.checkedin(),
+                                db.engine.pool.size())
+
+        cached = [name for loader, name in app.jinja_env.cache.keys()]
+        self.assertIn("cafe/list.html", cached)
+
+
+class TemplateCacheTestCase(TestCase):
+    """Tests for precompiling templates into the bytecode cache."""
+
+    def setUp(self):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            tempfile.mkdtemp())
+        app.jinja_env.cache.clear()
+
+    def tearDown(self):
+        app.jinja_env.bytecode_cache = None
+        app.jinja_env.cache.clear()
+
+    def test_compile(self):
+        result = app.test_cli_runner().invoke(args=["templates", "compile"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        directory = app.jinja_env.bytecode_cache.directory
+        count = len(os.listdir(directory))
+        self.assertIn(f"Compiled {count} templates", result.output)
+
+        # a fresh process would load these instead of parsing the templates
+        app.jinja_env.cache.clear()
+        with app.test_request_context():
+            app.jinja_env.get_template("homepage.html").render()
+
+        self.assertEqual(len(os.listdir(directory)), count)
+
+    def test_compile_disabled(self):
+        app.jinja_env.bytecode_cache = None
+
+        result = app.test_cli_runner().invoke(args=["templates", "compile"])
+        self.assertNotEqual(result.exit_code, 0)
+
+
 #######################################
 # homepage
 
@@ -126,6 +309,142 @@ class HomepageViewsTestCase(TestCase):
             self.assertIn(b'A Way to Keep Track of Your Favorite Restaurants and Cafes', resp.data)
 
 
+#######################################
+# compression
+
+
+class CompressionTestCase(TestCase):
+    """Tests for compressed responses and precompressed static files."""
+
+    def tearDown(self):
+        """Remove any precompressed siblings made by a test."""
+
+        for suffix in (".br", ".gz"):
+            path = os.path.join(app.static_folder, "cafeLikes.js" + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_gzip(self):
+        with app.test_client() as client:
+            plain = client.get("/")
+            resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+    def test_prefers_brotli(self):
+        with app.test_client() as client:
+            plain = client.get("/")
+            resp = client.get("/", headers={"Accept-Encoding": "gzip, br"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "br")
+            self.assertEqual(brotli.decompress(resp.data), plain.data)
+
+    def test_not_accepted(self):
+        with app.test_client() as client:
+            resp = client.get("/", headers={"Accept-Encoding": "identity"})
+
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+
+    def test_small_responses_skipped(self):
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            resp = compress_response(jsonify(likes="true"))
+
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+
+    def test_stream(self):
+        chunks = [b"<p>first</p>", b"", b"<p>second</p>"]
+        compressed = list(compress_chunks(chunks, GzipEncoder(6)))
+
+        self.assertEqual(gzip.decompress(b"".join(compressed)),
+                         b"".join(chunks))
+
+        # the first chunk can be decompressed before the stream ends
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(compressed[0]),
+                         b"<p>first</p>")
+
+    def test_precompressed_static(self):
+        path = os.path.join(app.static_folder, "cafeLikes.js")
+        precompress(path)
+
+        with open(path, "rb") as file:
+            original = file.read()
+
+        with app.test_client() as client:
+            resp = client.get("/static/cafeLikes.js",
+                              headers={"Accept-Encoding": "br"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "br")
+            self.assertEqual(resp.mimetype, "text/javascript")
+            self.assertEqual(brotli.decompress(resp.data), original)
+
+            resp = client.get("/static/cafeLikes.js")
+
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertEqual(resp.data, original)
+
+
+class AssetsTestCase(TestCase):
+    """Tests for bundled, fingerprinted static assets."""
+
+    def tearDown(self):
+        """Remove any bundles built by a test."""
+
+        shutil.rmtree(os.path.join(app.static_folder, DIST_DIR),
+                      ignore_errors=True)
+        app.extensions["assets"] = {}
+
+    def test_unbuilt_links_sources(self):
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+
+            self.assertIn("/static/vendor/jquery-3.5.1.min.js", html)
+            self.assertIn("/static/vendor/bootstrap-4.6.1.min.js", html)
+            self.assertIn("/static/style.css", html)
+            self.assertNotIn("unpkg.com", html)
+            self.assertNotIn("bootswatch.com", html)
+
+    def test_build(self):
+        manifest = build_assets(app.static_folder)
+        self.assertEqual(load_manifest(app), manifest)
+
+        app.extensions["assets"] = manifest
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+
+            self.assertIn(f'href="/static/{manifest["app.css"]}"', html)
+            self.assertIn(f'src="/static/{manifest["vendor.js"]}"', html)
+            self.assertNotIn("/static/style.css", html)
+
+            resp = client.get(f"/static/{manifest['vendor.js']}")
+            data = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Cache-Control"],
+                             "public, max-age=31536000, immutable")
+            self.assertLess(data.index("jQuery v3.5.1"),
+                            data.index("Bootstrap v4.6.1"))
+            self.assertNotIn("sourceMappingURL", data)
+
+            css = client.get(f"/static/{manifest['app.css']}").data
+            self.assertIn(b".prof-pic{height:20vh;", css)
+
+            # unfingerprinted files still get checked for changes
+            resp = client.get("/static/style.css")
+            self.assertNotIn("immutable", resp.headers["Cache-Control"])
+
+    def test_fingerprint(self):
+        self.assertRegex(fingerprint("app.css", b"a{}"),
+                         r"^app\.[0-9a-f]{10}\.css$")
+        self.assertNotEqual(fingerprint("app.css", b"a{}"),
+                            fingerprint("app.css", b"b{}"))
+
+
 #######################################
 # cities
 
@@ -166,6 +485,55 @@ class CityModelTestCase(TestCase):
     # the City model, so here's a good place to put that stuff.
 
 
+class CityViewsTestCase(TestCase):
+    """Tests for views on cities."""
+
+    def setUp(self):
+        """Before each test, add sample city, cafe & user"""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all cafes, cities & users."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_list_links_to_detail(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cities")
+            self.assertIn(b'href="/cities/sf"', resp.data)
+
+    def test_detail(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cities/sf")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"San Francisco, CA", resp.data)
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b"No restaurants in San Francisco yet", resp.data)
+
+            resp = client.get("/cities/nowhere")
+            self.assertEqual(resp.status_code, 404)
+
+
 #######################################
 # cafes
 
@@ -194,87 +562,1157 @@ class CafeModelTestCase(TestCase):
         self.cafe = cafe
         self.user_id = user.id
 
-    def tearDown(self):
-        """After each test, remove all cafes."""
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.commit()
+
+    def test_get_city_state(self):
+        self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
+
+    def test_venue_cards(self):
+        long = Cafe(**{**CAFE_DATA, "name": "Long Cafe",
+                       "description": "word " * 100})
+        db.session.add(long)
+        db.session.commit()
+
+        cards = list(venue_cards(Cafe, state="CA"))
+        self.assertEqual([card.name for card in cards],
+                         ["Long Cafe", "Test Cafe"])
+
+        self.assertEqual(len(cards[0].description), CARD_DESCRIPTION_LENGTH)
+        self.assertTrue(cards[0].description.endswith("..."))
+        self.assertEqual(cards[1].description, "Test description")
+        self.assertEqual(cards[1].get_city_state(), "San Francisco, CA")
+
+        self.assertEqual(list(venue_cards(Cafe, state="NY")), [])
+
+
+class CatalogTestCase(TestCase):
+    """Tests for the in-process catalog snapshot."""
+
+    def setUp(self):
+        """Before each test, add a city and cafe, and use the snapshot."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+        app.config['CATALOG_SNAPSHOT'] = True
+        catalog.start()
+
+    def tearDown(self):
+        app.config['CATALOG_SNAPSHOT'] = False
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_snapshot(self):
+        snapshot = catalog.poll()
+        self.assertIs(catalog.current(), snapshot)
+
+        [card] = snapshot.cards(Cafe, state="CA")
+        self.assertEqual(card.name, "Test Cafe")
+        self.assertEqual(card.get_city_state(), "San Francisco, CA")
+        self.assertEqual(snapshot.cards(Cafe, city_code="nyc"), [])
+        self.assertEqual(snapshot.cards(Restaurant), [])
+
+        [facet] = snapshot.facets(Cafe)
+        self.assertEqual((facet.code, facet.count), ("sf", 1))
+
+        venue = get_venue_or_404(Cafe, self.cafe_id)
+        self.assertIs(venue, snapshot.venues[Cafe].by_id[self.cafe_id])
+        self.assertEqual(venue.url, "http://testcafe.com/")
+
+    def test_version_bumped_on_write(self):
+        version = catalog.poll().version
+
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Another Cafe"}))
+        db.session.commit()
+
+        snapshot = catalog.poll()
+        self.assertGreater(snapshot.version, version)
+        self.assertEqual([card.name for card in snapshot.cards(Cafe)],
+                         ["Another Cafe", "Test Cafe"])
+
+    def test_local_write_seen_immediately(self):
+        catalog.poll()
+
+        cafe = db.session.get(Cafe, self.cafe_id)
+        cafe.name = "Renamed Cafe"
+        db.session.commit()
+
+        # whether or not the poller has reloaded yet
+        self.assertEqual([card.name for card in list_cards(Cafe)],
+                         ["Renamed Cafe"])
+
+        with app.test_client() as client:
+            user = User(**TEST_USER_DATA)
+            db.session.add(user)
+            db.session.commit()
+            login_for_test(client, user.id)
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Renamed Cafe", resp.data)
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_stale_snapshot_not_used(self):
+        catalog.poll()
+        self.assertIsNotNone(catalog.current())
+
+        app.config['CATALOG_MAX_STALE_SECONDS'] = -1
+
+        try:
+            self.assertIsNone(catalog.current())
+        finally:
+            app.config['CATALOG_MAX_STALE_SECONDS'] = 10
+
+
+def wait_for(condition, timeout=5):
+    """Wait until condition() is true, for up to `timeout` seconds."""
+
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.02)
+
+
+class InvalidationTestCase(TestCase):
+    """Tests for the cross-worker invalidation bus."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+        self.changes = []
+        bus.subscribe(self.record)
+        self.drain()
+
+    def tearDown(self):
+        bus.subscribers.remove(self.record)
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def record(self, entity, id):
+        self.changes.append((entity, id))
+
+    def drain(self):
+        """Wait for a running listener to hear of everything committed so
+        far (notifications arrive in commit order), then forget it all."""
+
+        if bus.listening:
+            db.session.execute(db.text("SELECT pg_notify(:channel, 'drain:*')"),
+                               {"channel": invalidation.CHANNEL})
+            db.session.commit()
+            wait_for(lambda: ("drain", None) in self.changes)
+
+        self.changes.clear()
+
+    def test_publish_on_commit(self):
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.flush()
+        self.assertEqual(self.changes, [])
+
+        db.session.commit()
+
+        # (the listener, if it's running, may hear of it a second time)
+        self.assertEqual(set(self.changes), {("cafe", str(cafe.id))})
+
+    def test_nothing_published_on_rollback(self):
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.flush()
+        db.session.rollback()
+
+        db.session.commit()
+        self.assertEqual(self.changes, [])
+
+    def test_nothing_published_for_likes(self):
+        cafe = Cafe(**CAFE_DATA)
+        user = User(**TEST_USER_DATA)
+        db.session.add_all([cafe, user])
+        db.session.commit()
+        self.drain()
+
+        user.liked_cafes.append(cafe)
+        db.session.commit()
+        user.liked_cafes.remove(cafe)
+        db.session.commit()
+
+        self.assertEqual(self.changes, [])
+
+    def test_bulk_write(self):
+        City.query.filter_by(code="sf").update({"name": "SF"})
+        db.session.commit()
+
+        self.assertEqual(set(self.changes), {("city", None)})
+
+    def test_listener(self):
+        app.config['INVALIDATION_LISTEN'] = True
+
+        try:
+            bus.start()
+            wait_for(lambda: bus.listening)
+
+            # as if from another worker
+            other = create_engine(os.environ["DATABASE_URL"])
+            with other.begin() as conn:
+                conn.execute(db.text("NOTIFY catalog_changed, 'city:sf'"))
+
+            wait_for(lambda: ("city", "sf") in self.changes)
+
+            # drop the listener's connection; it should reconnect, and tell
+            # subscribers that anything might have changed meanwhile
+            self.changes.clear()
+            invalidation.RECONNECT_SECONDS = 0.1
+
+            with other.begin() as conn:
+                conn.execute(db.text(
+                    "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                    "WHERE application_name = :name"),
+                    {"name": invalidation.APPLICATION_NAME})
+
+            wait_for(lambda: ("*", None) in self.changes)
+            self.assertTrue(bus.listening)
+
+            other.dispose()
+
+        finally:
+            app.config['INVALIDATION_LISTEN'] = False
+            invalidation.RECONNECT_SECONDS = 5
+
+    def test_parse_payload(self):
+        self.assertEqual(parse_payload("cafe:12"), ("cafe", "12"))
+        self.assertEqual(parse_payload("cafe:*"), ("cafe", None))
+
+
+class CacheTestCase(TestCase):
+    """Tests for the cache and its backends."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis = FakeRedis()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redis.shutdown()
+        cls.redis.server_close()
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+        cache.backend = MemoryBackend(1024 * 1024)
+        cache.reset_counters()
+
+    def tearDown(self):
+        cache.backend = NullBackend()
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def backends(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+
+        return {
+            "memory": MemoryBackend(1024 * 1024),
+            "sqlite": SQLiteBackend(path, 1000),
+            "redis": RedisBackend(self.redis.url, 1),
+        }
+
+    def test_backends(self):
+        for name, backend in self.backends().items():
+            with self.subTest(name):
+                cache.backend = backend
+                cache.clear()
+
+                cache.set("a", {"n": 1})
+                cache.set("b", None)
+                cache.set("short", 1, ttl=0.05)
+
+                self.assertEqual(cache.get("a"), {"n": 1})
+                self.assertEqual(cache.get_many(["a", "b", "c"]),
+                                 {"a": {"n": 1}, "b": None})
+                self.assertEqual(cache.get("c", "default"), "default")
+
+                cache.delete("a")
+                self.assertIsNone(cache.get("a"))
+
+                time.sleep(0.1)
+                self.assertIsNone(cache.get("short"))
+
+                # a version tag drops every entry carrying it
+                cache.set("x", 1, tags=["t"])
+                cache.set("y", 2, tags=["t", "u"])
+                cache.set("z", 3, tags=["u"])
+                cache.invalidate("t")
+                self.assertEqual(cache.get_many(["x", "y", "z"]), {"z": 3})
+
+                self.assertEqual(cache.counters["errors"], 0)
+
+    def test_memory_lru(self):
+        cache.backend = backend = MemoryBackend(3 * (ENTRY_OVERHEAD + 100))
+
+        for key in "abc":
+            cache.set(key, "x" * 50)
+
+        cache.get("a")
+        cache.set("d", "x" * 50)
+
+        # b was least recently used
+        self.assertEqual(cache.get_many("abcd").keys(), {"a", "c", "d"})
+        self.assertEqual(backend.stats()["evictions"], 1)
+        self.assertLessEqual(backend.bytes, backend.max_bytes)
+
+        cache.set("big", "x" * 1000)
+        self.assertIsNone(cache.get("big"))
+        self.assertEqual(len(backend.get_many("acd")), 3)
+
+    def test_sqlite_shared_and_pruned(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+
+        cache.backend = SQLiteBackend(path, 2)
+        cache.set("a", 1)
+
+        # as another worker would see it
+        other = SQLiteBackend(path, 2)
+        self.assertIn("a", other.get_many(["a"]))
+
+        cache.set("b", 2, ttl=100)
+        cache.set("c", 3, ttl=200)
+        cache.backend._prune(cache.backend._connect())
+
+        # b was closest to expiring
+        self.assertEqual(cache.get_many("abc").keys(), {"a", "c"})
+
+    def test_memory_backend_listens(self):
+        starts = []
+        bus.start = lambda: starts.append(os.getpid())
+
+        try:
+            cache._pid = None
+            cache.backend = NullBackend()
+            cache.get("a")
+            self.assertEqual(starts, [])
+
+            # even with the catalog snapshot off
+            cache.backend = MemoryBackend(1024)
+            cache.get("a")
+            cache.get("b")
+            self.assertEqual(starts, [os.getpid()])
+
+        finally:
+            del bus.start
+
+    def test_sqlite_file_permissions(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+
+        cache.backend = SQLiteBackend(path, 2)
+        cache.set("a", 1)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+        # a file others could have seeded is never read
+        os.chmod(path, 0o666)
+        cache.backend = SQLiteBackend(path, 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.counters["errors"], 1)
+
+    def test_memoize(self):
+        calls = []
+
+        @cache.memoize(tags=lambda n: ["numbers"])
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        self.assertEqual([double(2), double(2), double(3)], [4, 4, 6])
+        self.assertEqual(calls, [2, 3])
+
+        cache.invalidate("numbers")
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2, 3, 2])
+        self.assertEqual(double.uncached(5), 10)
+
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 3)
+
+    def test_get_or_404(self):
+        cafe = get_or_404(Cafe, self.cafe_id)
+        self.assertEqual(cafe.name, "Test Cafe")
+
+        db.session.expunge_all()
+
+        # from the cache, attached to the session without a query
+        cafe = get_or_404(Cafe, self.cafe_id)
+        self.assertEqual(cafe.name, "Test Cafe")
+        self.assertIn(cafe, db.session)
+        self.assertEqual(cache.counters["hits"], 1)
+        self.assertEqual(cafe.city.name, "San Francisco")
+
+        # committing the change invalidates it
+        cafe.name = "Renamed"
+        db.session.commit()
+        db.session.expunge_all()
+
+        self.assertEqual(get_or_404(Cafe, self.cafe_id).name, "Renamed")
+        self.assertEqual(cache.counters["hits"], 1)
+
+        # a change heard from another worker does too
+        Cafe.query.filter_by(id=self.cafe_id).update({"name": "Again"},
+                                                     synchronize_session=False)
+        cache.set("unrelated", 1)
+        db.session.commit()
+        bus.dispatch("*", None)
+
+        self.assertEqual(get_or_404(Cafe, self.cafe_id).name, "Again")
+        self.assertEqual(cache.get("unrelated"), 1)
+
+        with self.assertRaises(NotFound):
+            get_or_404(Cafe, 0)
+
+    def test_backend_down(self):
+        # nothing listens on port 1
+        cache.backend = RedisBackend("redis://127.0.0.1:1/0", 0.5)
+
+        with self.assertLogs(app.logger, "ERROR"):
+            cache.set("a", 1)
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(get_or_404(Cafe, self.cafe_id).name, "Test Cafe")
+        self.assertGreater(cache.stats()["errors"], 0)
+
+
+class CafeGeocodingTestCase(TestCase):
+    """Tests for cafe coordinates and nearby search."""
+
+    def setUp(self):
+        """Before each test, add sample city, user, and geocoded cafes"""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        far_cafe = Cafe(**{**CAFE_DATA, "name": "Far Cafe"})
+        db.session.add(far_cafe)
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.flush()
+
+        cafe.geocode()
+        far_cafe.latitude, far_cafe.longitude = (40.7128, -74.0060)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+        self.lat, self.lng = cafe.latitude, cafe.longitude
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.commit()
+
+    def test_local_geocoder_is_stable(self):
+        geocoder = LocalGeocoder()
+        coords = geocoder.geocode("500 Sansome St", "San Francisco", "CA")
+
+        self.assertEqual(
+            coords, geocoder.geocode("500 Sansome St", "San Francisco", "CA"))
+        self.assertLess(distance_km(*coords, 37.7749, -122.4194), 5)
+
+    def test_mapquest_unreachable(self):
+        geocoder = MapQuestGeocoder()
+        geocoder.url = geocoder.batch_url = "http://127.0.0.1:1/"
+        geocoder.batch_size = 2
+
+        self.assertIsNone(
+            geocoder.geocode("500 Sansome St", "San Francisco", "CA"))
+        self.assertEqual(
+            geocoder.geocode_many([("500 Sansome St", "San Francisco", "CA")]
+                                  * 3),
+            [None] * 3)
+
+    def test_geocode(self):
+        self.assertIsNotNone(self.lat)
+        self.assertIsNotNone(self.lng)
+
+    def test_find_nearby(self):
+        nearby = find_nearby(Cafe, self.lat + 0.001, self.lng, 1)
+
+        self.assertEqual([cafe.id for cafe, distance in nearby],
+                         [self.cafe_id])
+        self.assertAlmostEqual(nearby[0][1], 0.111, places=2)
+
+    def test_nearby_api(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(
+                "/api/nearby",
+                query_string={"lat": self.lat, "lng": self.lng, "radius": 2})
+            self.assertEqual(resp.status_code, 200)
+
+            venues = resp.json["venues"]
+            self.assertEqual(len(venues), 1)
+            self.assertEqual(venues[0]["name"], "Test Cafe")
+            self.assertEqual(venues[0]["city"], "San Francisco, CA")
+
+    def test_nearby_api_invalid(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/api/nearby", query_string={"lat": "abc"})
+            self.assertEqual(resp.status_code, 400)
+
+
+class CafeViewsTestCase(TestCase):
+    """Tests for views on cafes."""
+
+    def setUp(self):
+        """Before all tests, add sample city & users"""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.commit()
+
+    def test_list(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cafes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_detail(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b'testcafe.com', resp.data)
+
+    def test_list_streamed(self):
+        app.config['STREAM_TEMPLATES'] = True
+
+        try:
+            client = app.test_client()
+            login_for_test(client, self.user_id)
+
+            with client.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Welcome!")]
+
+            resp = client.get("/cafes")
+            self.assertTrue(resp.is_streamed)
+
+            # the head and navbar come first, before any cards
+            first = next(resp.response).decode()
+            self.assertIn("</nav>", first)
+            self.assertNotIn("Test Cafe", first)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("Test Cafe", html)
+            self.assertIn("Welcome!", html)
+            self.assertNotIn("\x00", html)
+
+            # the session was updated before the page started streaming
+            with client.session_transaction() as sess:
+                self.assertNotIn("_flashes", sess)
+                self.assertIn("csrf_token", sess)
+
+        finally:
+            app.config['STREAM_TEMPLATES'] = False
+
+    def test_buffer_chunks(self):
+        chunks = ["<head>", FLUSH, "a" * 5, "b" * 5, FLUSH, FLUSH, "c"]
+
+        self.assertEqual(list(buffer_chunks(chunks, 8)),
+                         ["<head>", "aaaaabbbbb", "c"])
+
+    def test_detail_preload(self):
+        map_path = os.path.join(app.static_folder,
+                                f"maps/cafe{self.cafe_id}.jpg")
+        early_hints = []
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            made_map = not os.path.exists(map_path)
+
+            try:
+                if made_map:
+                    open(map_path, "wb").close()
+
+                resp = client.get(
+                    f"/cafes/{self.cafe_id}",
+                    headers={"Accept": "text/html"},
+                    environ_base={"wsgi.early_hints": early_hints.append})
+            finally:
+                if made_map:
+                    os.remove(map_path)
+
+            link = resp.headers["Link"]
+            self.assertIn("</static/style.css>; rel=preload; as=style", link)
+            self.assertIn("</static/cafeLikes.js>; rel=preload; as=script",
+                          link)
+            self.assertIn(f"</static/maps/cafe{self.cafe_id}.jpg>; "
+                          "rel=preload; as=image", link)
+            self.assertEqual(early_hints, [[("Link", link)]])
+
+            # no hints for API calls
+            resp = client.get(f"/api/likes-cafe?q={self.cafe_id}")
+            self.assertNotIn("Link", resp.headers)
+
+    def test_list_filters(self):
+        oak = City(code="oak", name="Oakland", state="CA")
+        db.session.add(oak)
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Oak Cafe",
+                               "city_code": "oak"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cafes")
+            self.assertIn(b"San Francisco (1)", resp.data)
+            self.assertIn(b"Oakland (1)", resp.data)
+            self.assertIn(b"CA (2)", resp.data)
+
+            resp = client.get("/cafes?city=oak")
+            self.assertIn(b"Oak Cafe", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            resp = client.get("/cafes?state=ny")
+            self.assertNotIn(b"Oak Cafe", resp.data)
+            self.assertIn(b"No cafes match these filters", resp.data)
+
+    def test_list_liked_only(self):
+        user = db.session.get(User, self.user_id)
+        user.liked_cafes.append(db.session.get(Cafe, self.cafe_id))
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Unliked Cafe"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cafes?liked=1")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertNotIn(b"Unliked Cafe", resp.data)
+            self.assertIn(b"San Francisco (1)", resp.data)
+
+
+class CafeAdminViewsTestCase(TestCase):
+    """Tests for add/edit views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        City.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
+
+        admin = User(**ADMIN_USER_DATA)
+        db.session.add(admin)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+        self.admin_id = admin.id
+
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.commit()
+
+    def test_add(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.get("/cafes/add")
+            self.assertIn(b'Add Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'added', resp.data)
+
+    def test_add_unauthorized(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/cafes/add", follow_redirects=True)
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn(b'UNAUTHORIZED', resp.data)
+            self.assertNotIn(b'Add Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn(b'UNAUTHORIZED', resp.data)
+            self.assertNotIn(b'added', resp.data)
+
+    def test_dynamic_cities_vocab(self):
+        id = self.cafe_id
+
+        # the following is a regular expression for the HTML for the drop-down
+        # menu pattern we want to check for
+        choices_pattern = re.compile(
+           r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
+           r'San Francisco</option></select>')
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.get("/cafes/add")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+            resp = client.get(f"/cafes/{id}/edit")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+    def test_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Edit Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'edited', resp.data)
+
+    def test_edit_unauthorized(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn(b'UNAUTHORIZED', resp.data)
+            self.assertNotIn(b'Edit Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn(b'UNAUTHORIZED', resp.data)
+            self.assertNotIn(b'edited', resp.data)
+
+    def test_edit_form_shows_curr_data(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Test description', resp.data)
+
+
+#######################################
+# bulk import
+
+
+IMPORT_CSV = """type,name,description,url,address,city_code,city_name,state,image_url
+cafe,Import Cafe,Nice,http://importcafe.com/,1 Main St,sf,,,
+restaurant,Import Restaurant,,,2 Main St,oak,Oakland,CA,
+cafe,,No name,,3 Main St,sf,,,
+cafe,Bad City Cafe,,,4 Main St,nowhere,Nowhere,XX,
+"""
+
+
+class ImportTestCase(TestCase):
+    """Tests for the bulk venue import command."""
+
+    def setUp(self):
+        """Before each test, add sample city"""
+
+        MapJob.query.delete()
+        Cafe.query.delete()
+        Restaurant.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove imported data."""
+
+        MapJob.query.delete()
+        Cafe.query.delete()
+        Restaurant.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def run_import(self, contents, suffix, *args):
+        with tempfile.NamedTemporaryFile("w", suffix=suffix) as file:
+            file.write(contents)
+            file.flush()
+
+            return app.test_cli_runner().invoke(
+                args=["import", "venues", file.name, *args])
+
+    def test_import_csv(self):
+        result = self.run_import(IMPORT_CSV, ".csv", "--batch-size", "1")
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Imported 2 venues (1 cafes, 1 restaurants)",
+                      result.output)
+        self.assertIn("Created 1 cities", result.output)
+        self.assertIn("Rejected 2 rows", result.output)
+        self.assertIn("line 4: name: This field is required.", result.output)
+        self.assertIn("line 5: city_state: Must enter a valid U.S. state.",
+                      result.output)
+
+        cafe = Cafe.query.one()
+        self.assertEqual(cafe.name, "Import Cafe")
+        self.assertIsNotNone(cafe.latitude)
+        self.assertEqual(Restaurant.query.one().get_city_state(),
+                         "Oakland, CA")
+        self.assertEqual(MapJob.query.count(), 2)
+
+    def test_import_jsonl(self):
+        rows = [
+            dict(CAFE_DATA),
+            dict(CAFE_DATA, url="not a url"),
+            "not json",
+        ]
+        contents = "\n".join(
+            row if isinstance(row, str) else json.dumps(row) for row in rows)
+
+        result = self.run_import(contents, ".jsonl", "--type", "cafe")
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Imported 1 venues", result.output)
+        self.assertIn("line 2: url: Invalid URL.", result.output)
+        self.assertIn("line 3: row: Could not parse row.", result.output)
+
+
+#######################################
+# database config & metrics
+
+
+class DatabaseConfigTestCase(TestCase):
+    """Tests for engine options read from the environment."""
+
+    def test_defaults(self):
+        options = engine_options_from_env({})
+
+        self.assertEqual(options["pool_size"], 5)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertNotIn("connect_args", options)
+
+    def test_statement_timeout(self):
+        options = engine_options_from_env({
+            "DB_STATEMENT_TIMEOUT_MS": "5000",
+            "DB_POOL_PRE_PING": "0",
+        })
+
+        self.assertFalse(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"],
+                         {"options": "-c statement_timeout=5000"})
+
+    def test_pgbouncer_skips_startup_options(self):
+        options = engine_options_from_env({
+            "DB_STATEMENT_TIMEOUT_MS": "5000",
+            "DB_PGBOUNCER": "1",
+        })
+
+        self.assertNotIn("connect_args", options)
+
+
+class MetricsViewsTestCase(TestCase):
+    """Tests for the metrics API."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User(**TEST_USER_DATA)
+        admin = User(**ADMIN_USER_DATA)
+        db.session.add_all([user, admin])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.get("/api/metrics")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("throttle", resp.json)
+            self.assertGreater(resp.json["db_pool"]["checkouts"], 0)
+
+    def test_metrics_unauthorized(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/api/metrics")
+            self.assertEqual(resp.status_code, 401)
+
+    def test_paint_timings(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+
+            resp = client.post("/api/metrics/paint",
+                               json={"variant": "none", "fcp_ms": 120})
+            self.assertEqual(resp.status_code, 404)
+
+            app.config['PRELOAD_INSTRUMENT'] = True
+
+            try:
+                resp = client.get("/", headers={"Accept": "text/html"})
+                self.assertIn(b"first-contentful-paint", resp.data)
+
+                for ms in (100, 120, 140):
+                    resp = client.post("/api/metrics/paint",
+                                       json={"variant": "none", "fcp_ms": ms})
+                    self.assertEqual(resp.status_code, 204)
+
+                resp = client.post("/api/metrics/paint",
+                                   json={"variant": "bogus", "fcp_ms": 1})
+                self.assertEqual(resp.status_code, 400)
+
+                resp = client.get("/api/metrics")
+                self.assertEqual(resp.json["paint"]["none"]["count"], 3)
+                self.assertEqual(resp.json["paint"]["none"]["p50_ms"], 120)
+
+            finally:
+                app.config['PRELOAD_INSTRUMENT'] = False
+                paint_timings.clear()
+
 
-        Cafe.query.delete()
-        City.query.delete()
-        User.query.delete()
+class ReadReplicaTestCase(TestCase):
+    """Tests for routing GET reads to a replica.
 
-        db.session.commit()
+    There's no real replication here: rows are copied to the replica database
+    by hand, so anything written to the primary afterwards is "lagging".
+    """
 
-    def test_get_city_state(self):
-        self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
+    @classmethod
+    def setUpClass(cls):
+        cls.replica = create_engine(REPLICA_DATABASE_URL)
+        db.metadata.drop_all(cls.replica)
+        db.metadata.create_all(cls.replica)
 
+        db.engines[REPLICA_BIND] = cls.replica
 
-class CafeViewsTestCase(TestCase):
-    """Tests for views on cafes."""
+    @classmethod
+    def tearDownClass(cls):
+        del db.engines[REPLICA_BIND]
+        cls.replica.dispose()
 
     def setUp(self):
-        """Before all tests, add sample city & users"""
+        """Before each test, add a city, cafe & user to both databases."""
 
+        CafeLike.query.delete()
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
 
-        sf = City(**CITY_DATA)
-        db.session.add(sf)
-
+        db.session.add(City(**CITY_DATA))
         cafe = Cafe(**CAFE_DATA)
-        db.session.add(cafe)
-
         user = User(**TEST_USER_DATA)
-        db.session.add(user)
-
+        db.session.add_all([cafe, user])
         db.session.commit()
 
         self.cafe_id = cafe.id
         self.user_id = user.id
 
+        self.replicate()
+
     def tearDown(self):
-        """After each test, remove all cafes."""
+        """After each test, remove everything."""
 
+        CafeLike.query.delete()
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
+        db.session.commit()
 
+    def replicate(self):
+        """Copy every table from the primary to the replica."""
+
+        tables = db.metadata.sorted_tables
+
+        with db.engine.connect() as primary, self.replica.begin() as replica:
+            for table in reversed(tables):
+                replica.execute(table.delete())
+
+            for table in tables:
+                rows = primary.execute(table.select()).mappings().all()
+                if rows:
+                    replica.execute(table.insert(), rows)
+
+    def test_get_reads_replica(self):
+        Cafe.query.filter_by(id=self.cafe_id).update({"name": "Renamed Cafe"})
         db.session.commit()
 
-    def test_list(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
 
-            resp = client.get("/cafes")
-            self.assertEqual(resp.status_code, 200)
+            resp = client.get(f"/cafes/{self.cafe_id}")
             self.assertIn(b"Test Cafe", resp.data)
+            self.assertNotIn(b"Renamed Cafe", resp.data)
 
-    def test_detail(self):
+    def test_reads_own_writes(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
 
-            resp = client.get(f"/cafes/{self.cafe_id}")
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(b"Test Cafe", resp.data)
-            self.assertIn(b'testcafe.com', resp.data)
+            resp = client.post("/api/likes-cafe-toggle",
+                               json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.json, {"liked": self.cafe_id})
 
+            with client.session_transaction() as sess:
+                self.assertIn(STICKY_KEY, sess)
 
-class CafeAdminViewsTestCase(TestCase):
-    """Tests for add/edit views on cafes."""
+            # the like went to the primary only...
+            self.assertEqual(CafeLike.query.count(), 1)
+            with self.replica.connect() as replica:
+                self.assertEqual(replica.execute(
+                    CafeLike.__table__.select()).all(), [])
+
+            # ...but this user reads from the primary for now
+            resp = client.get(f"/api/likes-cafe?q={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": "true"})
+
+    def test_sticky_window_expires(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            client.post("/api/likes-cafe-toggle",
+                        json={"cafe_id": self.cafe_id})
+
+            with client.session_transaction() as sess:
+                sess[STICKY_KEY] = 0
+
+            resp = client.get(f"/api/likes-cafe?q={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": "false"})
+
+    def test_reads_without_writes_dont_stick(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            client.get(f"/cafes/{self.cafe_id}")
+
+            with client.session_transaction() as sess:
+                self.assertNotIn(STICKY_KEY, sess)
+
+
+#######################################
+# exports
+
+
+class ExportTestCase(TestCase):
+    """Tests for streaming catalog exports."""
 
     def setUp(self):
-        """Before each test, add sample city, users, and cafes"""
+        """Before each test, add sample city, cafe, users & like"""
 
-        City.query.delete()
+        CafeLike.query.delete()
         Cafe.query.delete()
+        City.query.delete()
         User.query.delete()
 
-        sf = City(**CITY_DATA)
-        db.session.add(sf)
+        db.session.add(City(**CITY_DATA))
 
         cafe = Cafe(**CAFE_DATA)
         db.session.add(cafe)
 
         user = User(**TEST_USER_DATA)
+        user.liked_cafes.append(cafe)
         db.session.add(user)
 
         admin = User(**ADMIN_USER_DATA)
@@ -287,104 +1725,107 @@ class CafeAdminViewsTestCase(TestCase):
         self.admin_id = admin.id
 
     def tearDown(self):
-        """After each test, delete the cities."""
+        """After each test, remove everything."""
 
+        CafeLike.query.delete()
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
-
         db.session.commit()
 
-    def test_add(self):
+    def test_export_csv(self):
         with app.test_client() as client:
             login_for_test(client, self.admin_id)
 
-            resp = client.get("/cafes/add")
-            self.assertIn(b'Add Cafe', resp.data)
+            resp = client.get("/api/export/cafes.csv")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "text/csv")
 
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'added', resp.data)
+            lines = resp.data.decode('utf8').splitlines()
+            self.assertTrue(lines[0].startswith("id,name,description"))
+            self.assertIn(f"{self.cafe_id},Test Cafe", lines[1])
 
-    def test_add_unauthorized(self):
+    def test_export_jsonl_gzip(self):
         with app.test_client() as client:
-            login_for_test(client, self.user_id)
+            login_for_test(client, self.admin_id)
 
-            resp = client.get("/cafes/add", follow_redirects=True)
-            self.assertEqual(resp.status_code, 401)
-            self.assertIn(b'UNAUTHORIZED', resp.data)
-            self.assertNotIn(b'Add Cafe', resp.data)
+            resp = client.get("/api/export/cafe_likes.jsonl?gzip=1")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("cafe_likes.jsonl.gz",
+                          resp.headers["Content-Disposition"])
 
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertEqual(resp.status_code, 401)
-            self.assertIn(b'UNAUTHORIZED', resp.data)
-            self.assertNotIn(b'added', resp.data)
+            rows = gzip.decompress(resp.data).decode('utf8').splitlines()
+            self.assertEqual(
+                [json.loads(row) for row in rows],
+                [{"user_id": self.user_id, "cafe_id": self.cafe_id}])
 
-    def test_dynamic_cities_vocab(self):
-        id = self.cafe_id
+    def test_export_unauthorized(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
 
-        # the following is a regular expression for the HTML for the drop-down
-        # menu pattern we want to check for
-        choices_pattern = re.compile(
-           r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
-           r'San Francisco</option></select>')
+            resp = client.get("/api/export/cafes.csv")
+            self.assertEqual(resp.status_code, 401)
 
-        with app.test_client() as client:
-            login_for_test(client, self.admin_id)
+    def test_export_cli(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = app.test_cli_runner().invoke(
+                args=["export", "cities", "-o", output_dir])
+            self.assertEqual(result.exit_code, 0, result.output)
 
-            resp = client.get("/cafes/add")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+            with open(os.path.join(output_dir, "cities.csv")) as file:
+                self.assertEqual(file.read().splitlines(),
+                                 ["code,name,state", "sf,San Francisco,CA"])
 
-            resp = client.get(f"/cafes/{id}/edit")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
 
-    def test_edit(self):
-        id = self.cafe_id
+#######################################
+# synthetic data
 
-        with app.test_client() as client:
-            login_for_test(client, self.admin_id)
 
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Edit Cafe', resp.data)
+class DataGeneratorTestCase(TestCase):
+    """Tests for the synthetic dataset generator."""
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'edited', resp.data)
+    def setUp(self):
+        """Before each test, clear out the tables the generator fills."""
 
-    def test_edit_unauthorized(self):
-        id = self.cafe_id
+        self.tearDown()
 
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
+    def tearDown(self):
+        """After each test, remove everything."""
 
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertEqual(resp.status_code, 401)
-            self.assertIn(b'UNAUTHORIZED', resp.data)
-            self.assertNotIn(b'Edit Cafe', resp.data)
+        CafeLike.query.delete()
+        RestaurantLike.query.delete()
+        Cafe.query.delete()
+        Restaurant.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertEqual(resp.status_code, 401)
-            self.assertIn(b'UNAUTHORIZED', resp.data)
-            self.assertNotIn(b'edited', resp.data)
+    def test_same_seed_same_rows(self):
+        def venue_rows(seed):
+            generator = DataGenerator(seed=seed)
+            generator.cities = [("sf", "San Francisco", "CA"),
+                                ("oak", "Oakland", "CA")]
+            return list(generator.venue_rows(10, ["Cafe"]))
 
-    def test_edit_form_shows_curr_data(self):
-        id = self.cafe_id
+        self.assertEqual(venue_rows(3), venue_rows(3))
+        self.assertNotEqual(venue_rows(3), venue_rows(4))
 
-        with app.test_client() as client:
-            login_for_test(client, self.admin_id)
+    def test_generate_cli(self):
+        result = app.test_cli_runner().invoke(args=[
+            "generate", "--cities", "3", "--cafes", "20",
+            "--restaurants", "10", "--users", "5", "--likes", "40",
+            "--seed", "1"])
+        self.assertEqual(result.exit_code, 0, result.output)
 
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Test description', resp.data)
+        self.assertEqual(City.query.count(), 3)
+        self.assertEqual(Cafe.query.count(), 20)
+        self.assertEqual(Restaurant.query.count(), 10)
+        self.assertGreater(CafeLike.query.count(), 0)
+
+        user = User.query.first()
+        self.assertTrue(user.password.startswith("$2b$04$"))
+        self.assertEqual(
+            User.authenticate(user.username, DEFAULT_PASSWORD), user)
 
 
 #######################################
@@ -423,6 +1864,19 @@ class UserModelTestCase(TestCase):
         rez = User.authenticate("test", "password")
         self.assertFalse(rez)
 
+    def test_authenticate_matches_case(self):
+        rez = User.authenticate("TeSt", "secret")
+        self.assertFalse(rez)
+
+    def test_authenticate_rehashes_old_cost(self):
+        self.user.password = bcrypt.generate_password_hash(
+            "secret", 5).decode('utf-8')
+        db.session.commit()
+
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+        self.assertEqual(get_log_rounds(self.user.password), 4)
+
     def test_full_name(self):
         self.assertEqual(self.user.get_full_name(), "Testy MacTest")
 
@@ -439,6 +1893,7 @@ class AuthViewsTestCase(TestCase):
     def setUp(self):
         """Before each test, add sample users."""
 
+        throttle.reset()
         User.query.delete()
 
         user = User.register(**TEST_USER_DATA)
@@ -508,6 +1963,73 @@ class AuthViewsTestCase(TestCase):
             with client.session_transaction() as sess:
                 self.assertEqual(sess.get(CURR_USER_KEY), self.user_id)
 
+    def test_login_throttled(self):
+        limit = throttle.limits["login_user"][0]
+
+        with app.test_client() as client:
+            for _ in range(limit):
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "WRONG"})
+                self.assertEqual(resp.status_code, 200)
+
+            # even the right password is refused once the bucket is empty
+            resp = client.post(
+                "/login", data={"username": "test", "password": "secret"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn(b"Too many attempts", resp.data)
+            self.assertIn("Retry-After", resp.headers)
+
+            # other usernames from the same IP aren't affected yet
+            resp = client.post(
+                "/login", data={"username": "other", "password": "WRONG"})
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(throttle.counters(), {"login_user": 1})
+
+    def test_login_throttle_unavailable(self):
+        # a file others could have tampered with isn't used, and logins
+        # go through unthrottled rather than failing
+        path = os.path.join(tempfile.mkdtemp(), "throttle.sqlite3")
+        open(path, "w").close()
+        os.chmod(path, 0o666)
+
+        saved = throttle.path, throttle._local
+        throttle.path, throttle._local = path, threading.local()
+
+        try:
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                    follow_redirects=True,
+                )
+
+            self.assertIn(b"Hello, test", resp.data)
+
+        finally:
+            throttle.path, throttle._local = saved
+
+    def test_login_overloaded(self):
+        # fill every hashing slot so the next login can't queue
+        slots = hasher._slots
+        limit = app.config['HASHING_QUEUE_LIMIT']
+
+        for _ in range(limit):
+            slots.acquire()
+
+        try:
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn("Retry-After", resp.headers)
+        finally:
+            for _ in range(limit):
+                slots.release()
+
     def test_logout(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -702,4 +2224,185 @@ class LikeViewsTestCase(TestCase):
 
             self.assertIn(b"new-fn new-ln", resp.data)
             self.assertIn(b"Your Liked Cafes", resp.data)
-            self.assertIn(b"You have no liked cafes", resp.data)
\ No newline at end of file
+            self.assertIn(b"You have no liked cafes", resp.data)
+    def test_likes_api_msgpack(self):
+        """Tests the likes APIs speak MessagePack when asked to"""
+        cafe_id = self.cafe.id
+        headers = {"Accept": "application/msgpack"}
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f"/api/likes-cafe?q={cafe_id}",
+                              headers=headers)
+            self.assertEqual(resp.mimetype, "application/msgpack")
+            self.assertEqual(msgpack.unpackb(resp.data), {"likes": "true"})
+            self.assertIn("Accept", resp.vary)
+
+            resp = client.post("/api/likes-cafe-toggle", headers=headers,
+                               data=msgpack.packb({"cafe_id": cafe_id}),
+                               content_type="application/msgpack")
+            self.assertEqual(msgpack.unpackb(resp.data), {"unliked": cafe_id})
+
+            resp = client.post("/api/likes-cafe-toggle", data=b"\xc1",
+                               content_type="application/msgpack")
+            self.assertEqual(resp.status_code, 400)
+
+            # JSON is still the default
+            resp = client.get(f"/api/likes-cafe?q={cafe_id}")
+            self.assertEqual(resp.json, {"likes": "false"})
+
+
+class VenueApiTestCase(TestCase):
+    """Tests for the /api/v1 venue and city API."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="nyc", name="New York", state="NY"))
+
+        for name, city_code in [("B Cafe", "sf"), ("A Cafe", "nyc"),
+                                ("C Cafe", "sf"), ("B Cafe", "nyc")]:
+            db.session.add(Cafe(**{**CAFE_DATA, "name": name,
+                                   "city_code": city_code}))
+
+        user = User(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def get_all(self, client, url):
+        """Follow `next` links from url; returns all the items."""
+
+        items = []
+
+        while url:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+
+            items += resp.json["data"]
+            url = resp.json["next"]
+
+        return items
+
+    def test_pages(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/api/v1/cafes?limit=3")
+            self.assertEqual(len(resp.json["data"]), 3)
+            self.assertIn("limit=3", resp.json["next"])
+
+            cafes = self.get_all(client, "/api/v1/cafes?limit=1")
+
+            # other args are passed along, whatever they're called
+            resp = client.get("/api/v1/cafes?limit=1&endpoint=x&_anchor=y")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("endpoint=x", resp.json["next"])
+            self.assertIn("_anchor=y", resp.json["next"])
+
+        # in name order, then id order for the two B Cafes
+        self.assertEqual([cafe["name"] for cafe in cafes],
+                         ["A Cafe", "B Cafe", "B Cafe", "C Cafe"])
+        self.assertLess(cafes[1]["id"], cafes[2]["id"])
+
+        self.assertEqual(set(cafes[0]), set(VENUE_FIELDS))
+        self.assertEqual(cafes[0]["city"], {"code": "nyc",
+                                            "name": "New York",
+                                            "state": "NY"})
+
+    def test_fields(self):
+        statements = []
+
+        # not background threads' queries, e.g. a catalog reload
+        def record(conn, cursor, statement, *args):
+            if threading.current_thread() is threading.main_thread():
+                statements.append(statement)
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = client.get("/api/v1/cafes?fields=name,id")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(set(resp.json["data"][0]), {"id", "name"})
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            # stray commas are ignored
+            resp = client.get("/api/v1/cafes?fields=,name,")
+            self.assertEqual(set(resp.json["data"][0]), {"name"})
+
+        # one query for the cafes, without unasked-for columns or a join
+        [query] = [sql for sql in statements if "FROM cafes" in sql]
+        self.assertNotIn("description", query)
+        self.assertNotIn("JOIN", query)
+
+    def test_filters(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            in_sf = self.get_all(client, "/api/v1/cafes?city=sf&limit=1")
+            in_ny = self.get_all(client, "/api/v1/cafes?state=NY&fields=id")
+
+        self.assertEqual([cafe["name"] for cafe in in_sf],
+                         ["B Cafe", "C Cafe"])
+        self.assertEqual(len(in_ny), 2)
+
+    def test_cities(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            cities = self.get_all(client, "/api/v1/cities?limit=1")
+            resp = client.get("/api/v1/restaurants")
+
+        self.assertEqual([city["code"] for city in cities], ["nyc", "sf"])
+        self.assertEqual(resp.json, {"data": [], "next": None})
+
+    def test_invalid(self):
+        with app.test_client() as client:
+            resp = client.get("/api/v1/cafes")
+            self.assertEqual(resp.status_code, 401)
+
+            login_for_test(client, self.user_id)
+
+            for query in ["fields=id,secret", "limit=0", "limit=x",
+                          "after=nonsense", "after=WyJBIiwiQiJd"]:
+                resp = client.get(f"/api/v1/cafes?{query}")
+                self.assertEqual(resp.status_code, 400, query)
+                self.assertIn("error", resp.json)
+
+    def test_msgpack(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            as_json = client.get("/api/v1/cafes?limit=2").json
+            resp = client.get("/api/v1/cafes?limit=2", headers={
+                "Accept": "application/json;q=0.5, application/x-msgpack"})
+
+            self.assertEqual(resp.mimetype, "application/x-msgpack")
+            self.assertEqual(msgpack.unpackb(resp.data), as_json)
+
+            resp = client.get("/api/v1/cafes?limit=0",
+                              headers={"Accept": "application/msgpack"})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("error", msgpack.unpackb(resp.data))
+
+    def test_json_provider(self):
+        self.assertEqual(app.json.dumps({"b": 1, "a": Decimal("1.5")}),
+                         '{"a":"1.5","b":1}')
+        self.assertEqual(app.json.loads(b'{"a": [1]}'), {"a": [1]})
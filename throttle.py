@@ -0,0 +1,200 @@
+"""Token-bucket rate limiting for Flask Cafe's login and signup.
+
+Every password check costs a full bcrypt hash, so attempts are throttled
+before any hashing happens. Buckets and rejection counters live in a small
+SQLite database, so all gunicorn workers on a host share them.
+
+If that database can't be used, attempts are let through (and the error
+logged) rather than failing every login.
+
+Config:
+    THROTTLE_ENABLED    turn throttling on/off (default True)
+    THROTTLE_DB_PATH    SQLite file for bucket state (default: in the
+                        instance folder)
+    THROTTLE_LIMITS     dict of bucket name -> (capacity, period in seconds);
+                        a bucket holds `capacity` attempts and refills
+                        completely over `period`
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+
+DEFAULT_LIMITS = {
+    "login_ip": (20, 60),
+    "login_user": (5, 60),
+    "signup_ip": (5, 300),
+}
+
+# fraction of hits that also clear out long-idle buckets
+PRUNE_CHANCE = 0.01
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+"""
+
+
+class Throttle:
+    """Shared token buckets keyed by e.g. IP address or username."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.path = None
+        self.limits = DEFAULT_LIMITS
+        self._local = threading.local()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read throttle settings from the app config."""
+
+        self.app = app
+        self.enabled = app.config.setdefault('THROTTLE_ENABLED', True)
+        self.path = app.config.setdefault(
+            'THROTTLE_DB_PATH',
+            os.path.join(app.instance_path, "throttle.sqlite3"))
+        self.limits = {**DEFAULT_LIMITS,
+                       **app.config.setdefault('THROTTLE_LIMITS', {})}
+
+    def _connect(self):
+        # one connection per thread, reopened after gunicorn forks
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None or self._local.pid != os.getpid():
+            self._check_file()
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def _check_file(self):
+        """Create the file, readable only by us, or make sure no other user
+        can have tampered with it."""
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT
+                     | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            stat = os.fstat(fd)
+        finally:
+            os.close(fd)
+
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+            raise PermissionError(
+                f"{self.path} is not owned by this user, or others can "
+                "write to it")
+
+    def hit(self, **keys):
+        """Take one token from each named bucket, e.g.
+        hit(login_ip="1.2.3.4", login_user="test").
+
+        Tokens are only taken if every bucket has one. Returns None if the
+        attempt is allowed, or the name of the first empty bucket.
+        """
+
+        if not self.enabled:
+            return None
+
+        try:
+            return self._hit(keys)
+        except (sqlite3.Error, OSError):
+            # better to let attempts through than to take logins down
+            self.app.logger.exception("Throttle failed")
+            return None
+
+    def _hit(self, keys):
+        conn = self._connect()
+        now = time.time()
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            updates = []
+            rejected = None
+
+            for name, value in keys.items():
+                capacity, period = self.limits[name]
+                key = f"{name}:{value}"
+
+                row = conn.execute(
+                    "SELECT tokens, updated_at FROM buckets WHERE key = ?",
+                    (key,)).fetchone()
+
+                tokens = capacity
+                if row:
+                    tokens, updated_at = row
+                    tokens = min(capacity, tokens
+                                 + (now - updated_at) * capacity / period)
+
+                if tokens < 1:
+                    rejected = name
+                    break
+
+                updates.append((key, tokens - 1, now))
+
+            if rejected:
+                conn.execute(
+                    "INSERT INTO counters (name, count) VALUES (?, 1) "
+                    "ON CONFLICT (name) DO UPDATE SET count = count + 1",
+                    (rejected,))
+            else:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) "
+                    "VALUES (?, ?, ?)", updates)
+
+            if random.random() < PRUNE_CHANCE:
+                self._prune(conn, now)
+
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return rejected
+
+    def _prune(self, conn, now):
+        """Delete buckets idle long enough to have refilled completely."""
+
+        longest_period = max(period for capacity, period
+                             in self.limits.values())
+
+        conn.execute("DELETE FROM buckets WHERE updated_at < ?",
+                     (now - longest_period,))
+
+    def retry_after(self, name):
+        """Seconds until a bucket has a token again, rounded up."""
+
+        capacity, period = self.limits[name]
+        return max(1, round(period / capacity))
+
+    def counters(self):
+        """Return a dict of bucket name -> rejected attempts."""
+
+        return {name: count for name, count in self._connect().execute(
+            "SELECT name, count FROM counters ORDER BY name")}
+
+    def reset(self):
+        """Clear all buckets and counters."""
+
+        conn = self._connect()
+        conn.execute("DELETE FROM buckets")
+        conn.execute("DELETE FROM counters")
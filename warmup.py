@@ -0,0 +1,84 @@
+"""Warm-up routines run before a worker serves traffic.
+
+A fresh worker pays for several things on its first requests: compiling
+every template, connecting to Postgres, and each new Postgres connection
+loading the system catalog entries for the tables it touches. These
+functions do that work up front; gunicorn.conf.py calls them from its
+server hooks.
+"""
+
+import time
+
+from sqlalchemy import select, text
+
+from models import db, Cafe, Restaurant, City, User, CafeLike, RestaurantLike
+from models import card_query
+from templating import compile_templates
+from catalog import catalog
+from invalidation import bus
+
+
+def hot_queries():
+    """The queries behind the busiest pages."""
+
+    return [
+        select(City).order_by(City.name),
+        card_query(Cafe).limit(1),
+        card_query(Restaurant).limit(1),
+        select(User).limit(1),
+        select(CafeLike).limit(1),
+        select(RestaurantLike).limit(1),
+    ]
+
+
+def open_connections(engine, queries):
+    """Fill the engine's pool, running `queries` on every connection so each
+    Postgres backend has loaded the catalog entries they need; returns how
+    many connections were opened."""
+
+    # pools without a fixed size (e.g. NullPool) just get one connection
+    size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    connections = [engine.connect() for _ in range(size)]
+
+    try:
+        for conn in connections:
+            conn.execute(text("SELECT 1"))
+
+            for query in queries:
+                conn.execute(query).all()
+
+            conn.rollback()
+
+    finally:
+        for conn in connections:
+            conn.close()
+
+    return len(connections)
+
+
+def warm_up(app):
+    """Compile templates, fill every database pool, start listening for
+    invalidations and load the catalog snapshot; returns a dict of what was
+    done and how long it took."""
+
+    start = time.perf_counter()
+
+    with app.app_context():
+        templates = compile_templates(app)
+
+        queries = hot_queries()
+        connections = {name or "primary": open_connections(engine, queries)
+                       for name, engine in db.engines.items()}
+
+        # the per-process cache needs it even without the snapshot
+        bus.start()
+
+        if app.config['CATALOG_SNAPSHOT']:
+            catalog.start()
+
+    return {
+        "templates": templates,
+        "connections": connections,
+        "catalog_version": catalog.snapshot and catalog.snapshot.version,
+        "seconds": time.perf_counter() - start,
+    }